@@ -34,8 +34,29 @@ DEFAULT_SETTINGS = dict(
     MAX_BOUQUET = 16,
     MAX_NEIGH = 16,
     MAX_WAIT_TIME = 8, # seconds
+    MIN_BOUQUET = 4, # bouquet size while the neighbourhood is stable
+    MAX_SCAN_INTERVAL = 2, # seconds, maximum pause between two scans. A dead
+                           # neighbour is noticed after at most this pause
+                           # plus MAX_WAIT_TIME: higher values save traffic
+                           # but delay the failure detection
+    SCAN_GRACE_TIME = 1500, # milliseconds, wait for new neighbours. Keep it
+                            # well above the 500ms a new BcastClient waits
+                            # before sending its first reply
+    LOSS_WINDOW = 64, # the loss ratio is computed on the last 64 packets
     MULTIPATH = False,
     SIMULATED = False,
+    # QSPN
+    METRICS = 1, # number of metrics of the routes, > 1 enables MultiRem
+    ETP_CACHE_SIZE = 512,
+    ETP_CACHE_TTL = 16, # seconds
+    ETP_MERGE_WINDOW = 200, # milliseconds, 0 disables the merge
+    # Route flap damping
+    FLAP_HALF_LIFE = 60, # seconds
+    FLAP_PENALTY_CHANGE = 500, # penalty of a rem change of a link
+    FLAP_PENALTY_LINK = 1000,  # penalty of a new or dead link
+    FLAP_SUPPRESS = 2000, # 0 disables the flap damping
+    FLAP_REUSE = 750,
+    FLAP_MAX_PENALTY = 6000,
 
 )
 
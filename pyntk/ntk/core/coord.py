@@ -39,14 +39,15 @@ class Node(object):
         self.alive = False
 
     def is_free(self):
-        return self.alive
+        return not self.alive
 
     def _pack(self):
         return (self.alive,)
 
 class MapCache(Map):
     def __init__(self, maproute):
-        Map.__init__(self, maproute.levels, maproute.gsize, Node, maproute.me)
+        Map.__init__(self, maproute.levels, maproute.gsize, Node, maproute.me,
+                     sparse=True)
 
         self.copy_from_maproute(maproute)
         self.remotable_funcs = [self.map_data_merge]
@@ -56,18 +57,20 @@ class MapCache(Map):
     def copy_from_maproute(self, maproute):
         for lvl in xrange(self.levels):
             for id in xrange(self.gsize):
-                if not maproute.node_get(lvl, id).is_empty():
+                n = maproute.node_peek(lvl, id)
+                if n is not None and not n.is_empty():
                     self.node_add(lvl, id)
 
     def node_add(self, lvl, id, silent=0):
-        if not self.node_get(lvl, id).alive:
+        n = self.node_peek(lvl, id)
+        if n is None or not n.alive:
             Map.node_add(self, lvl, id, silent)
-            self.node_get(lvl, id).alive = True
+            self.node_peek(lvl, id).alive = True
 
     def node_del(self, lvl, id, silent=False):
-        if self.node_get(lvl, id).alive:
+        n = self.node_peek(lvl, id)
+        if n is not None and n.alive:
             Map.node_del(self, lvl, id, silent)
-            self.node_get(lvl, id).alive = False
 
     def tmp_deleted_add(self, lvl, id):
         self.tmp_deleted[lvl, id] = time()
@@ -170,9 +173,10 @@ class Coord(P2P):
         We'll give an affermative answer if `gnumb' < |G| or if `gnumb'=None
         """
 
+        n = self.mapp2p.node_peek(lvl, id)
 
         if (gnumb < self.mapp2p.nodes_nb[lvl]-1 or gnumb is None) \
-            and self.mapp2p.node_get(lvl, id).alive:
+            and n is not None and n.alive:
                 self.mapp2p.node_del(lvl, id)
                 return self.mapp2p.nodes_nb[lvl]
         else:
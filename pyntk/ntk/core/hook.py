@@ -115,9 +115,9 @@ class Hook(object):
         ## Find all the highest non saturated gnodes
         hfn = [(self.maproute.me, self.highest_free_nodes())]
 
-        if neigh_list == []:
+        if not neigh_list:
                 neigh_list = self.neigh.neigh_list()
-        if neigh_list == []:
+        if not neigh_list:
                 we_are_alone = True
 
         def is_neigh_forbidden(nrip):
@@ -229,10 +229,12 @@ class Hook(object):
         # change the IPs of the NICs
         newnip_ip = self.maproute.nip_to_ip(newnip)
         self.nics.activate(ip_to_str(newnip_ip))
+        self.radar.reply_clients_close()
 
         # reset the map
         self.maproute.me_change(newnip[:])
         for l in reversed(xrange(lvl)): self.maproute.level_reset(l)
+        self.etp.etp_reset()
 
         # Restore the neighbours in the map and send the ETP
         self.neigh.readvertise()
@@ -253,11 +255,10 @@ class Hook(object):
     def highest_free_nodes(self):
         """Returns (lvl, fnl), where fnl is a list of free node IDs of
            level `lvl'."""
-        for lvl in reversed(xrange(self.maproute.levels)):
-                fnl = self.maproute.free_nodes_list(lvl)
-                if fnl:
-                        return (lvl, fnl)
-        return (-1, None)
+        lvl = self.maproute.free_level_highest()
+        if lvl == -1:
+                return (-1, None)
+        return (lvl, self.maproute.free_nodes_list(lvl))
 
     def gnodes_split(self, old_node_nb, cur_node_nb):
         """Handles the case of gnode splitting
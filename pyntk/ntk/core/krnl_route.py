@@ -52,7 +52,12 @@ class KrnlRoute(object):
     @microfunc(True)
     def route_new(self, lvl, dst, gw, rem, event_wait=None):
 
-        if not self.multipath and self.maproute.node_get(lvl, dst).nroutes_synced() >= 1:
+        node = self.maproute.node_peek(lvl, dst)
+        if node is None:
+                # The route has already been deleted
+                return
+
+        if not self.multipath and node.nroutes_synced() >= 1:
                 # We don't have multipath and we've already set one route.
                 return
 
@@ -62,9 +67,12 @@ class KrnlRoute(object):
         neigh = self.neigh.id_to_neigh(gw)
         dev = neigh.bestdev[0]
         gwipstr = ip_to_str(neigh.ip)
-        neigh_node = self.maproute.node_get(*self.maproute.routeneigh_get(neigh))
+        # peek, don't allocate: if the node doesn't exist there isn't any
+        # route to the neighbour to wait
+        neigh_node = self.maproute.node_peek(
+                                *self.maproute.routeneigh_get(neigh))
 
-        if neigh_node.nroutes() > 1:
+        if neigh_node is not None and neigh_node.nroutes() > 1:
                 # Let's wait to add the neighbour first
                 while 1:
                         ev_neigh = event_wait[(self.neigh.events, 'NEIGH_NEW')]()
@@ -72,7 +80,7 @@ class KrnlRoute(object):
                                 # found
                                 break
 
-        if neigh_node.routes_tobe_synced > 0:
+        if neigh_node is not None and neigh_node.routes_tobe_synced > 0:
                 # The routes to neigh are still to be synced, let's wait
                 while 1:
                         ev_neigh = event_wait[(self.events, 'KRNL_NEIGH_NEW')]()
@@ -83,7 +91,7 @@ class KrnlRoute(object):
         # We can add the route in the kernel
         KRoute.add(ipstr, lvl_to_bits(lvl), dev, gwipstr)
 
-        self.maproute.node_get(lvl, dst).routes_tobe_synced-=1
+        node.routes_tobe_synced-=1
 
 
     @microfunc(True)
@@ -20,8 +20,10 @@
 # Implementation of the map. See {-topodoc-}
 #
 
+from bisect import bisect_left
 from random import randint
 
+from ntk.lib.bits import bit_count, bit_length
 from ntk.lib.event import Event
 
 
@@ -43,15 +45,37 @@ class DataClass(object):
         """Returns True if this data class is free. False otherwise"""
         return True
 
+class SparseLevel(dict):
+    """A level of a sparse Map.
+
+    It is indexed like the list of a dense level, i.e. level[id], but only
+    the existing nodes are stored. Reading an absent id returns None and
+    doesn't insert anything."""
+
+    __slots__ = []
+
+    def __missing__(self, id):
+        return None
+
 class Map(object):
 
     __slots__ = ['levels', 'gsize', 'dataclass', 'me', 'node', 'node_nb',
-                 'events']
+                 'busy', 'events', 'sparse',
+                 'changelog', 'epoch', 'version', 'log', 'log_ver', 'reset_ver',
+                 'lvl_shift', 'lvl_pow']
 
-    def __init__(self, levels, gsize, dataclass, me=None):
+    def __init__(self, levels, gsize, dataclass, me=None, sparse=False,
+                 changelog=False):
         """Initialise the map
 
         If me = None, then self.me is set to a random nip (ntk ip)
+
+        If sparse = True, only the existing nodes are kept in memory (see
+        SparseLevel), otherwise `levels' x `gsize' slots are preallocated.
+
+        If changelog = True, the changes of the map are logged, so that
+        map_delta_since() can export only the changed nodes. Otherwise
+        map_delta_since() always exports the whole map.
         """
 
         self.levels = levels   # Number of levels
@@ -59,51 +83,145 @@ class Map(object):
         self.dataclass = dataclass
         self.me = me        # Ourself. self.me[lvl] is the ID of our
                             # (g)node of level lvl
+        self.sparse = sparse
+
+        # Used by ip_to_nip() and nip_to_ip(). If gsize is a power of two,
+        # the ID of level l is (ip >> lvl_shift[l]) & (gsize-1)
+        self.lvl_pow = [gsize**l for l in xrange(levels)]
+        self.lvl_shift = None
+        if gsize & (gsize - 1) == 0:
+            bits = bit_length(gsize) - 1
+            self.lvl_shift = [bits*l for l in xrange(levels)]
+
         # Choose a random nip
         if me is None:
             self.me = self.nip_rand()
 
         # The member self.node[l][i] is a node of level l and its ID is i
-        self.node = [[None] * self.gsize for i in xrange(self.levels)]
+        self.node = [self._level_new() for i in xrange(self.levels)]
         # Number of nodes of each level, that is:
         #   self.node_nb[i] = number of (g)nodes inside the gnode self.me[i+1]
         self.node_nb = [0] * self.levels
+        # Occupancy bitmap of each level: the bit `id' of self.busy[l] is set
+        # iff the node (l, id) has been added to the map
+        self.busy = [0] * self.levels
+
+        # Change log, used by map_delta_since(). self.version is increased
+        # at each change of the map. The random epoch distinguishes the
+        # versions of this map from those of a previous instance, i.e. of a
+        # node which has been restarted.
+        self.changelog = changelog
+        self.epoch = randint(1, 2**31-1)
+        self.version = 0
+        self.log = []                       # [(version, lvl, id)]
+        self.log_ver = {}                   # {(lvl, id): version of its
+                                            #             last change}
+        self.reset_ver = [0] * self.levels  # version of the last reset of
+                                            # each level
 
         self.events = Event(['NODE_NEW', 'NODE_DELETED', 'ME_CHANGED'])
 
-    def node_get(self, lvl, id):
+    def _level_new(self):
+        """Returns the empty storage of a level"""
+        if self.sparse:
+            return SparseLevel()
+        return [None] * self.gsize
+
+    def node_peek(self, lvl, id):
+        """Returns the node of level `lvl' and id `id', or None if it
+        doesn't exist. Nothing is allocated."""
+        return self.node[lvl][id]
+
+    def node_get_or_create(self, lvl, id):
         """Returns from the map a node of level `lvl' and id `id'.
 
         An instance of type `self.dataclass' will always be returned: if
         it doesn't exist, it is created"""
 
-        if self.node[lvl][id] is None:
-            self.node[lvl][id] = self.dataclass(lvl, id)
-        return self.node[lvl][id]
+        n = self.node[lvl][id]
+        if n is None:
+            n = self.node[lvl][id] = self.dataclass(lvl, id)
+        return n
+
+    node_get = node_get_or_create
+
+    def _node_set(self, lvl, id, n):
+        """Stores `n' as the node (lvl, id). If `n' is None, the node is
+        removed"""
+        if n is not None:
+            self.node[lvl][id] = n
+        elif self.sparse:
+            self.node[lvl].pop(id, None)
+        else:
+            self.node[lvl][id] = None
+
+    def node_touch(self, lvl, id):
+        """Records in the change log that the node (lvl, id) has been
+        modified"""
+        if not self.changelog:
+            return
+        self.version += 1
+        self.log.append((self.version, lvl, id))
+        self.log_ver[lvl, id] = self.version
+        if len(self.log) > 2 * len(self.log_ver) + self.gsize:
+            # compact the log, keeping only the last change of each node
+            self.log = sorted((v, l, i) for (l, i), v in self.log_ver.iteritems())
+
+    def _level_touch(self, level):
+        """Records in the change log that the whole level has been
+        replaced"""
+        if not self.changelog:
+            return
+        self.version += 1
+        self.reset_ver[level] = self.version
+        for key in [k for k in self.log_ver if k[0] == level]:
+            del self.log_ver[key]
 
     def node_add(self, lvl, id, silent=0):
-        self.node_get(lvl, id)
-        self.node_nb[lvl] += 1
+        self.node_get_or_create(lvl, id)
+        self.node_touch(lvl, id)
+        bit = 1 << id
+        if not self.busy[lvl] & bit:
+            self.busy[lvl] |= bit
+            self.node_nb[lvl] += 1
         if not silent:
             self.events.send('NODE_NEW', (lvl, id))
 
     def node_del(self, lvl, id, silent=0):
         ''' Delete node 'id` at level 'lvl` '''
-        if self.node_nb[lvl] > 0:
+        bit = 1 << id
+        if self.busy[lvl] & bit:
+            self.busy[lvl] &= ~bit
             self.node_nb[lvl] -= 1
 
         if not silent:
             self.events.send('NODE_DELETED', (lvl, id))
-        self.node[lvl][id]=None
+        self._node_set(lvl, id, None)
+        self.node_touch(lvl, id)
 
     def free_nodes_nb(self, lvl):
         """Returns the number of free nodes of level `lvl'"""
         return self.gsize-self.node_nb[lvl]
 
     def free_nodes_list(self, lvl):
-        """Returns the list of free nodes of level `lvl'"""
-        return [nid for nid in xrange(self.gsize)
-                        if self.node_get(lvl, nid).is_free()]
+        """Returns the ordered list of free nodes of level `lvl'
+
+        A node is free if it hasn't been added with node_add()."""
+        free = ~self.busy[lvl] & ((1 << self.gsize) - 1)
+        fnl = []
+        while free:
+            low = free & -free
+            fnl.append(bit_length(low) - 1)
+            free ^= low
+        return fnl
+
+    def free_level_highest(self):
+        """Returns the highest level having at least one free node, or -1 if
+        the map is full"""
+        for lvl in reversed(xrange(self.levels)):
+            if self.node_nb[lvl] < self.gsize:
+                return lvl
+        return -1
 
     def is_in_level(self, nip, lvl):
         """Does the node nip belongs to our gnode of level `lvl'?"""
@@ -125,14 +243,31 @@ class Map(object):
         and such that a_{n-1}*g^{n-1}+a_{n-2}*g^(n-2)+...+a_0 = ip,
         where g = self.gsize"""
 
+        if self.lvl_shift is not None:
+            mask = self.gsize - 1
+            return [(ip >> s) & mask for s in self.lvl_shift]
         g = self.gsize
-        return [(ip % g**(l+1)) / g**l for l in xrange(self.levels)]
+        return [(ip / p) % g for p in self.lvl_pow]
 
     def nip_to_ip(self, nip):
         """The reverse of ip_to_nip"""
 
-        g=self.gsize
-        return sum([nip[l] * g**l for l in xrange(self.levels)])
+        ip = 0
+        if self.lvl_shift is not None:
+            for a, s in zip(nip, self.lvl_shift):
+                ip |= a << s
+            return ip
+        for a, p in zip(nip, self.lvl_pow):
+            ip += a * p
+        return ip
+
+    def ips_to_nips(self, ips):
+        """Converts a list of ips to a list of nips"""
+        return map(self.ip_to_nip, ips)
+
+    def nips_to_ips(self, nips):
+        """Converts a list of nips to a list of ips"""
+        return map(self.nip_to_ip, nips)
 
     def nip_cmp(self, nipA, nipB):
         """Returns the first level where nipA and nipB differs. The search
@@ -150,8 +285,10 @@ class Map(object):
 
     def level_reset(self, level):
         """Resets the specified level, without raising any event"""
-        self.node[level] = [None] * self.gsize
+        self.node[level] = self._level_new()
         self.node_nb[level] = 0
+        self.busy[level] = 0
+        self._level_touch(level)
 
     def map_reset(self):
         """Silently resets the whole map"""
@@ -168,16 +305,104 @@ class Map(object):
     def map_data_pack(self):
         '''Pack the data map'''
         return (self.me,
-                [[self.node[lvl][id] for id in xrange(self.gsize)]
-                                     for lvl in xrange(self.levels)],
+                [[self.node_peek(lvl, id) for id in xrange(self.gsize)]
+                                         for lvl in xrange(self.levels)],
                 [self.node_nb[lvl] for lvl in xrange(self.levels)])
 
     def map_data_merge(self, (nip, plist, nblist)):
+        """Merges the levels of a map packed with map_data_pack()
+
+        The occupancy bitmap is rebuilt from the received nodes: a node is
+        busy if it isn't free (see DataClass.is_free). The number of nodes
+        of each level is counted from the bitmap, so that it always agrees
+        with free_nodes_list(); `nblist' isn't used."""
         lvl = self.nip_cmp(nip, self.me)
         for l in xrange(lvl, self.levels):
-            self.node_nb[l] = nblist[l]
+            busy = 0
+            for id, n in enumerate(plist[l]):
+                if n is not None and not n.is_free():
+                    busy |= 1 << id
+            self.busy[l] = busy
+            self.node_nb[l] = bit_count(busy)
+            self._level_touch(l)
+            if self.sparse:
+                self.node[l] = SparseLevel((id, n)
+                                           for id, n in enumerate(plist[l])
+                                               if n is not None)
+                continue
             for id in xrange(self.gsize):
                 self.node[l][id] = plist[l][id]
         for l in xrange(0, lvl):
             self.level_reset(l)
 
+    def map_delta_since(self, version=None):
+        """Returns the changes of the map made after `version'.
+
+        `version' is the (epoch, ver) pair returned by map_delta_apply().
+
+        The returned delta is the tuple (nip, version, resets, changes,
+        nblist):
+            nip: self.me
+            version: the current (epoch, ver) pair, to be used for the next
+                     request
+            resets: list of the levels which must be entirely replaced
+            changes: list of (lvl, id, node) triplets; node is None if the
+                     node (lvl, id) has been deleted
+            nblist: self.node_nb
+
+        If version is None, or it is unknown (of another epoch or newer than
+        ours), or the map hasn't a change log, all the levels are sent.
+        Apply the delta with map_delta_apply()."""
+
+        epoch, version = version or (0, 0)
+        if (not self.changelog or epoch != self.epoch
+                or version <= 0 or version > self.version):
+            resets = range(self.levels)
+        else:
+            resets = [l for l in xrange(self.levels)
+                            if self.reset_ver[l] > version]
+
+        changes = []
+        for l in resets:
+            if self.sparse:
+                changes += [(l, id, self.node[l][id])
+                                for id in sorted(self.node[l])]
+            else:
+                changes += [(l, id, n) for id, n in enumerate(self.node[l])
+                                            if n is not None]
+
+        if len(resets) < self.levels:
+            for v, l, id in self.log[bisect_left(self.log, (version+1,)):]:
+                if l not in resets and self.log_ver.get((l, id)) == v:
+                    changes.append((l, id, self.node_peek(l, id)))
+
+        return (self.me, (self.epoch, self.version), resets, changes,
+                self.node_nb[:])
+
+    def map_delta_apply(self, (nip, version, resets, changes, nblist)):
+        """Applies a delta returned by map_delta_since().
+
+        As in map_data_merge(), only the levels shared with `nip' are
+        updated and the others are reset. Returns the (epoch, ver) version
+        of the delta, which must be passed to the next map_delta_since()
+        call."""
+
+        lvl = self.nip_cmp(nip, self.me)
+        for l in resets:
+            if l >= lvl:
+                self.level_reset(l)
+        for l, id, n in changes:
+            if l < lvl:
+                continue
+            self._node_set(l, id, n)
+            if n is not None and not n.is_free():
+                self.busy[l] |= 1 << id
+            else:
+                self.busy[l] &= ~(1 << id)
+            self.node_touch(l, id)
+        for l in xrange(max(lvl, 0), self.levels):
+            self.node_nb[l] = bit_count(self.busy[l])
+        for l in xrange(0, lvl):
+            self.level_reset(l)
+        return tuple(version)
+
@@ -36,6 +36,9 @@ class ParticipantNode(object):
 
         self.participant = participant
 
+    def is_free(self):
+        return not self.participant
+
     def _pack(self):
         return (0, 0, self.participant)
 
@@ -50,7 +53,8 @@ class MapP2P(Map):
         pid: P2P id of the service associated to this map
         """
 
-        Map.__init__(self, levels, gsize, ParticipantNode, me)
+        Map.__init__(self, levels, gsize, ParticipantNode, me, sparse=True,
+                     changelog=True)
 
         self.pid = pid
 
@@ -58,7 +62,9 @@ class MapP2P(Map):
         """Set self.me to be a participant node."""
 
         for l in xrange(self.levels):
-            self.node_get(l, self.me[l]).participant = True
+            self.node_get_or_create(l, self.me[l]).participant = True
+            # our ID isn't free anymore
+            self.node_add(l, self.me[l], silent=1)
 
     @microfunc()
     def me_changed(self, old_me, new_me):
@@ -120,7 +126,8 @@ class P2P(RPCDispatcher):
             for id in xrange(mp.gsize):
                 for sign in [-1, 1]:
                     hid = (IP[l] + id * sign) % mp.gsize
-                    if mp.node_get(l, hid).participant:
+                    n = mp.node_peek(l, hid)
+                    if n is not None and n.participant:
                         hIP[l] = hid
                         break
                 if hIP[l]:
@@ -143,7 +150,10 @@ class P2P(RPCDispatcher):
         """
 
         lvl = self.mapp2p.nip_cmp(hip, self.maproute.me)
-        br = self.maproute.node_get(lvl, hip[lvl]).best_route()
+        n = self.maproute.node_peek(lvl, hip[lvl])
+        if n is None:
+            return None
+        br = n.best_route()
         if not br:
             return None
         return self.neigh.id_to_neigh(br.gw)
@@ -166,8 +176,9 @@ class P2P(RPCDispatcher):
         mp  = self.mapp2p
         lvl = self.maproute.nip_cmp(pIP, mp.me)
         for l in xrange(lvl, mp.levels):
-            if not mp.node_get(l, pIP[l]).participant:
-                mp.node_get(l, pIP[l]).participant = True
+            n = mp.node_peek(l, pIP[l])
+            if n is None or not n.participant:
+                mp.node_get_or_create(l, pIP[l]).participant = True
                 mp.node_add(l, pIP[l])
                 continue_to_forward = True
 
@@ -229,6 +240,7 @@ class P2PAll(object):
                  'neigh',
                  'maproute',
                  'service',
+                 'peer_versions',
                  'remotable_funcs',
                  'events']
 
@@ -239,9 +251,18 @@ class P2PAll(object):
 
         self.service = {}
 
-        self.remotable_funcs = [self.pid_getall]
+        # {neighbour ip: (our nip, lvl, {pid: version})}: the versions of the
+        # neighbour's P2P maps we already have. See p2p_hook()
+        self.peer_versions = {}
+        self.neigh.events.listen('NEIGH_DELETED', self.neigh_deleted)
+
+        self.remotable_funcs = [self.pid_getall, self.pid_getall_delta]
         self.events = Event(['P2P_HOOKED'])
 
+    def neigh_deleted(self, neigh):
+        """Forgets the versions of the maps of the dead neighbour"""
+        self.peer_versions.pop(neigh.ip, None)
+
     def listen_hook_ev(self, hook):
         hook.events.listen('HOOKED', self.p2p_hook)
 
@@ -263,6 +284,13 @@ class P2PAll(object):
         return [(s, self.service[s].mapp2p.map_data_pack())
                     for s in self.service]
 
+    def pid_getall_delta(self, versions={}):
+        """Like pid_getall(), but returns the deltas of the maps.
+
+        `versions' is a {pid: version} dict, see Map.map_delta_since()"""
+        return [(s, self.service[s].mapp2p.map_delta_since(versions.get(s)))
+                    for s in self.service]
+
     def p2p_register(self, p2p):
         """Used to add for the first time a P2P instance of a module in the
            P2PAll dictionary."""
@@ -299,9 +327,24 @@ class P2PAll(object):
             # nothing to do
             return
 
-        nrmaps_pack = minnr.ntkd.p2p.pid_getall()
-        for (pid, map_pack) in nrmaps_pack:
-            self.pid_get(pid).mapp2p.map_data_merge(map_pack)
+        ## Ask only the changes since the last time, if our copy of the
+        ## levels we share with `minnr' is still valid
+        versions = {}
+        if minnr.ip in self.peer_versions:
+            oldme, oldlvl, oldversions = self.peer_versions[minnr.ip]
+            # the levels below the highest changed level of our nip now
+            # describe different gnodes
+            chglvl = self.maproute.nip_cmp(oldme, self.maproute.me)
+            if minlvl >= max(oldlvl, chglvl):
+                versions = oldversions
+        ##
+
+        nrmaps_delta = minnr.ntkd.p2p.pid_getall_delta(versions)
+        newversions = {}
+        for (pid, map_delta) in nrmaps_delta:
+            newversions[pid] = self.pid_get(pid).mapp2p.map_delta_apply(map_delta)
+        self.peer_versions[minnr.ip] = (self.maproute.me[:], minlvl,
+                                        newversions)
 
         for s in self.service:
             if self.service[s].participant:
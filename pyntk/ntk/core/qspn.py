@@ -17,11 +17,23 @@
 # Free Software Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
 ##
 
+from array import array
+from collections import deque
+from itertools import count
+from math import log
 from operator import add
+from struct import pack, unpack_from, error as struct_error
 
-from ntk.core.route import NullRem, DeadRem
+import ntk.wrap.xtime as xtime
+from ntk.config import settings
+from ntk.core.route import NullRem, DeadRem, Rtt, Bw, MultiRem, RemError
 from ntk.lib.event import Event
+from ntk.lib.log import logger as logging
 from ntk.lib.micro import microfunc
+from ntk.lib.rpc import RPCError
+from ntk.lib.rencode import serializable
+from ntk.lib.stats import Stats, timed
+from ntk.network.inet import ip_to_str
 
 def is_listlist_empty(l):
     """Returns true if l=[[],[], ...]
@@ -29,6 +41,496 @@ def is_listlist_empty(l):
     """
     return not any(l)
 
+class TPBlock(object):
+    """A block of a Tracer Packet: the hops crossed by the ETP at the level
+    `lvl' and their rems.
+
+    The hop ids are packed in a byte array. `hopset' is a bitmap of the hops,
+    used to check in O(1) if a hop is in the block (ATP rule). `rem' is the
+    sum of the rems of the block."""
+
+    __slots__ = ['lvl', 'hops', 'rems', 'hopset', 'rem']
+
+    def __init__(self, lvl, hops=[], rems=[]):
+        """
+        hops: a list of hop ids, or the packed string of the hop ids
+        rems: the list of the rems of the hops
+        """
+        self.lvl = lvl
+        self.hops = array('B', hops)
+        self.rems = list(rems)
+        self.hopset = 0
+        for hop in self.hops:
+            self.hopset |= 1 << hop
+        self._rem_update()
+
+    def _pack(self):
+        return (self.lvl, self.hops.tostring(), self.rems)
+
+    def _rem_update(self):
+        self.rem = NullRem()
+        for rem in self.rems:
+            self.rem += rem
+
+    def __len__(self):
+        return len(self.hops)
+
+    def __contains__(self, hop):
+        return (self.hopset >> hop) & 1
+
+    def __eq__(self, b):
+        return (self.lvl == b.lvl and self.hops == b.hops and
+                self.rems == b.rems)
+
+    def __ne__(self, b):
+        return not self.__eq__(b)
+
+    def __repr__(self):
+        return '<TPBlock(%d): %s>' % (self.lvl, self.items())
+
+    def items(self):
+        """Returns the list of (hop, rem) pairs of the block"""
+        return zip(self.hops, self.rems)
+
+    def append(self, hop, rem):
+        self.hops.append(hop)
+        self.rems.append(rem)
+        self.hopset |= 1 << hop
+        self.rem += rem
+
+    def extend(self, block):
+        """Appends the hops of `block'"""
+        self.hops.extend(block.hops)
+        self.rems.extend(block.rems)
+        self.hopset |= block.hopset
+        self.rem += block.rem
+
+    def rem_set(self, i, rem):
+        """Sets the rem of the i-th hop"""
+        self.rems[i] = rem
+        self._rem_update()
+
+    def collapse(self, lvl, hop):
+        """Replaces the block with a block of level `lvl' containing only
+        `hop', whose rem is the sum of the rems of the block (group rule)"""
+        self.lvl = lvl
+        self.hops = array('B', [hop])
+        self.rems = [self.rem]
+        self.hopset = 1 << hop
+
+    def dups_remove(self):
+        """Removes the contiguous duplicated hops, summing their rems.
+        Neither the set of hops nor the sum of the rems changes."""
+        hops, rems = self.hops, self.rems
+        j = 0
+        for i in xrange(len(hops)):
+            if j and hops[i] == hops[j-1]:
+                rems[j-1] += rems[i]
+            else:
+                hops[j] = hops[i]
+                rems[j] = rems[i]
+                j += 1
+        del hops[j:]
+        del rems[j:]
+
+serializable.register(TPBlock)
+
+def tpl_compact(TPL):
+    """Collapses the contiguous blocks of the same level of `TPL' and removes
+    the contiguous duplicated hops of each block, summing their rems.
+
+    TPL is modified in place and returned."""
+
+    #Note: we're assuming the two blocks with the same level are one after
+    #      another.
+    i = 0
+    for block in TPL:
+        if i and block.lvl == TPL[i-1].lvl:
+            TPL[i-1].extend(block)
+        else:
+            TPL[i] = block
+            i += 1
+    del TPL[i:]
+
+    for block in TPL:
+        block.dups_remove()
+
+    return TPL
+
+def tpl_to_legacy(TPL):
+    """Converts `TPL' to the format understood by the nodes which don't
+    know TPBlock: a list of [lvl, [[hop, rem], ...]] blocks"""
+    return [[block.lvl, [[hop, rem] for hop, rem in block.items()]]
+                for block in TPL]
+
+def tpl_from_legacy(TPL):
+    """Converts the legacy blocks of `TPL' (see tpl_to_legacy) to
+    TPBlocks"""
+    return [ isinstance(block, TPBlock) and block or
+             TPBlock(block[0], [hop for hop, rem in block[1]],
+                               [rem for hop, rem in block[1]])
+                for block in TPL ]
+
+### ETP wire codec
+#
+# Binary encoding of the (R, TPL, flag_of_interest) tuple of an ETP:
+#
+#   version, flag_of_interest, number of levels     1 byte each
+#   for each level: number of routes                 varint
+#       for each route: dst                          1 byte
+#                       rem                          see below
+#   number of blocks                                 1 byte
+#   for each block: lvl, number of hops              1 byte each
+#                   hops                             1 byte each
+#                   rems                             see below
+#
+# A rem is its type byte followed by its fields as unsigned varints:
+# Rtt: value; Bw: value, lb, nb; MultiRem: the number of rems and the rems.
+# Rems with non default max_value/avgcoeff can't be encoded: etp_pack raises
+# EtpCodecError and the ETP has to be sent with rencode.
+#
+ETP_CODEC_VERSION = 1
+
+REM_NULL, REM_DEAD, REM_RTT, REM_BW, REM_MULTI = range(5)
+
+class EtpCodecError(Exception):
+    '''The ETP can't be encoded or decoded'''
+
+def _varint_pack(n, out):
+    if not isinstance(n, (int, long)) or n < 0:
+        raise EtpCodecError('%r is not an unsigned integer' % (n,))
+    while n > 0x7f:
+        out.append(chr(0x80 | (n & 0x7f)))
+        n >>= 7
+    out.append(chr(n))
+
+def _varint_unpack(data, i):
+    n = shift = 0
+    while True:
+        b = ord(data[i])
+        i += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return n, i
+        shift += 7
+
+def _rem_pack(rem, out):
+    cls = rem.__class__
+    if cls is Rtt and rem.max_value == 60*1000 and rem.avgcoeff == 1:
+        out.append(chr(REM_RTT))
+        _varint_pack(rem.value, out)
+    elif cls is Bw and rem.max_value == 0 and rem.avgcoeff == 1:
+        out.append(chr(REM_BW))
+        _varint_pack(rem.value, out)
+        _varint_pack(rem.lb, out)
+        _varint_pack(rem.nb, out)
+    elif cls is MultiRem:
+        out.append(chr(REM_MULTI))
+        _varint_pack(len(rem.rems), out)
+        for r in rem.rems:
+            _rem_pack(r, out)
+    elif cls in (NullRem, DeadRem) and rem.value is None and \
+            rem.max_value == 0 and rem.avgcoeff == 1:
+        if cls is NullRem:
+            out.append(chr(REM_NULL))
+        else:
+            out.append(chr(REM_DEAD))
+    else:
+        raise EtpCodecError('%r cannot be encoded' % (rem,))
+
+def _rem_unpack(data, i):
+    t = ord(data[i])
+    i += 1
+    if t == REM_RTT:
+        value, i = _varint_unpack(data, i)
+        return Rtt(value), i
+    elif t == REM_BW:
+        value, i = _varint_unpack(data, i)
+        lb, i = _varint_unpack(data, i)
+        nb, i = _varint_unpack(data, i)
+        return Bw(value, lb, nb), i
+    elif t == REM_MULTI:
+        n, i = _varint_unpack(data, i)
+        rems = []
+        for j in xrange(n):
+            rem, i = _rem_unpack(data, i)
+            rems.append(rem)
+        return MultiRem(rems), i
+    elif t == REM_NULL:
+        return NullRem(), i
+    elif t == REM_DEAD:
+        return DeadRem(), i
+    raise EtpCodecError('unknown rem type %d' % t)
+
+def etp_pack(R, TPL, flag_of_interest):
+    """Encodes an ETP. Returns a string"""
+
+    out = [pack('BBB', ETP_CODEC_VERSION, flag_of_interest, len(R))]
+    try:
+        for Rl in R:
+            _varint_pack(len(Rl), out)
+            for dst, rem in Rl:
+                out.append(chr(dst))
+                _rem_pack(rem, out)
+
+        out.append(chr(len(TPL)))
+        for block in TPL:
+            out.append(pack('BB', block.lvl, len(block)))
+            out.append(block.hops.tostring())
+            for rem in block.rems:
+                _rem_pack(rem, out)
+    except (ValueError, struct_error), e:
+        # chr() or pack() of an id or a length out of range
+        raise EtpCodecError(str(e))
+    return ''.join(out)
+
+def etp_unpack(data):
+    """Decodes an ETP encoded by etp_pack.
+    Returns the (R, TPL, flag_of_interest) tuple."""
+
+    try:
+        version, flag_of_interest, levels = unpack_from('BBB', data)
+        if version != ETP_CODEC_VERSION:
+            raise EtpCodecError('unknown version %d' % version)
+        i = 3
+
+        R = []
+        for lvl in xrange(levels):
+            n, i = _varint_unpack(data, i)
+            Rl = []
+            for j in xrange(n):
+                dst = ord(data[i])
+                rem, i = _rem_unpack(data, i+1)
+                Rl.append((dst, rem))
+            R.append(Rl)
+
+        TPL = []
+        nblocks = ord(data[i])
+        i += 1
+        for b in xrange(nblocks):
+            lvl, nhops = unpack_from('BB', data, i)
+            i += 2
+            hops = data[i:i+nhops]
+            i += nhops
+            rems = []
+            for j in xrange(nhops):
+                rem, i = _rem_unpack(data, i)
+                rems.append(rem)
+            TPL.append(TPBlock(lvl, hops, rems))
+    except (IndexError, struct_error), e:
+        raise EtpCodecError('truncated ETP: %s' % e)
+    if i != len(data):
+        raise EtpCodecError('trailing data in the ETP')
+
+    return R, TPL, flag_of_interest
+#
+###
+
+def rem_fingerprint(rem):
+    """Returns a hashable value identifying the content of `rem'"""
+    if isinstance(rem, MultiRem):
+        return tuple([rem_fingerprint(r) for r in rem.rems])
+    return (rem.__class__, rem.value)
+
+def tpl_fingerprint(TPL):
+    """Returns a hashable value identifying the content of `TPL'"""
+    return tuple([ (block.lvl, block.hops.tostring(),
+                    tuple([rem_fingerprint(rem) for rem in block.rems]))
+                    for block in TPL ])
+
+class EtpCache(object):
+    """A bounded and time-expiring cache of the executed ETPs.
+
+    The ETPs are grouped by fingerprint: the gateway they came from, its rem,
+    the content of the TPL and the flag of interest. For each fingerprint
+    the cache remembers the routes of R already executed.
+    A received ETP is a duplicate if its fingerprint is in the cache and
+    all the routes of its R are already remembered with the same rem, i.e.
+    it is an exact copy, or a subset, of what we have already executed.
+
+    The routes installed by an ETP can be changed by a later ETP of the same
+    gateway with a different fingerprint. In this case the first fingerprint
+    is forgotten, so that its next copy is executed again.
+    """
+
+    __slots__ = ['size', 'ttl', 'xtime', 'cache', 'gw_fps', 'order', 'seq']
+
+    def __init__(self, size=settings.ETP_CACHE_SIZE,
+                 ttl=settings.ETP_CACHE_TTL, xtimemod=xtime):
+        """
+        size: maximum number of fingerprints kept in the cache
+        ttl: seconds after which a fingerprint expires
+        """
+        self.size = size
+        self.ttl = ttl
+        self.xtime = xtimemod
+        self.cache = {}             # {fingerprint: (expire time, routes,
+                                    #                touched, seq)}
+                                    # routes is a {(lvl, dst): rem fp} dict,
+                                    # touched the set of the (lvl, dst) of
+                                    # the routes of R and of the TPL.
+        self.gw_fps = {}            # {gw: set of its fingerprints}
+        # the (seq, fingerprint) pairs in insertion order, used to evict the
+        # oldest fingerprint. The pairs whose seq doesn't match the cache
+        # entry are stale: they are skipped and periodically compacted.
+        self.order = deque()
+        self.seq = count()
+
+    def fingerprint(self, gw, gwrem, TPL, flag_of_interest):
+        return (gw, rem_fingerprint(gwrem), tpl_fingerprint(TPL),
+                flag_of_interest)
+
+    def _del(self, fp):
+        del self.cache[fp]
+        fps = self.gw_fps[fp[0]]
+        fps.discard(fp)
+        if not fps:
+            del self.gw_fps[fp[0]]
+
+    def _routes_get(self, fp):
+        entry = self.cache.get(fp)
+        if entry is None:
+            return None
+        if entry[0] <= self.xtime.time():
+            self._del(fp)
+            return None
+        return entry[1]
+
+    def is_dup(self, fp, R):
+        """Returns True if the ETP with fingerprint `fp' and routes `R' is a
+        duplicate"""
+        routes = self._routes_get(fp)
+        if routes is None:
+            return False
+        for lvl in xrange(len(R)):
+            for dst, rem in R[lvl]:
+                if routes.get((lvl, dst)) != rem_fingerprint(rem):
+                    return False
+        return True
+
+    def add(self, fp, R):
+        """Remembers the routes `R' of the ETP with fingerprint `fp'"""
+        touched = set([(lvl, dst) for lvl in xrange(len(R))
+                                    for dst, rem in R[lvl]])
+        for lvl, hops, rems in fp[2]:
+            touched.update([(lvl, ord(hop)) for hop in hops])
+
+        # forget the other ETPs of the same gateway whose routes are changed
+        gw = fp[0]
+        for ofp in list(self.gw_fps.get(gw, ())):
+            if ofp != fp and not touched.isdisjoint(self.cache[ofp][2]):
+                self._del(ofp)
+
+        routes = self._routes_get(fp)
+        if routes is None:
+            routes = {}
+            seq = next(self.seq)
+            self.cache[fp] = (self.xtime.time() + self.ttl*1000, routes, set(),
+                              seq)
+            self.gw_fps.setdefault(gw, set()).add(fp)
+            self.order.append((seq, fp))
+            self._evict()
+        self.cache[fp][2].update(touched)
+        for lvl in xrange(len(R)):
+            for dst, rem in R[lvl]:
+                routes[(lvl, dst)] = rem_fingerprint(rem)
+
+    def _evict(self):
+        """Bounds the cache to self.size fingerprints, evicting the oldest
+        ones"""
+        order = self.order
+        while len(self.cache) > self.size:
+            seq, fp = order.popleft()
+            entry = self.cache.get(fp)
+            if entry is not None and entry[3] == seq:
+                self._del(fp)
+        if len(order) > 2 * self.size:
+            self.order = deque(sorted((e[3], fp)
+                                      for fp, e in self.cache.iteritems()))
+
+    def gw_forget(self, gw):
+        """Forgets all the ETPs received from the gateway `gw'"""
+        for fp in list(self.gw_fps.get(gw, ())):
+            self._del(fp)
+
+    def clear(self):
+        self.cache.clear()
+        self.gw_fps.clear()
+        self.order.clear()
+
+class FlapDamping(object):
+    """Route flap damping of the links with the neighbours.
+
+    Each link has a penalty, which is increased at each flap (a change of
+    its rem, its birth or its death) and which decays exponentially with
+    half life `half_life'. When the penalty exceeds the `suppress'
+    threshold the link is considered unstable and it remains suppressed
+    until its penalty decays below the `reuse' threshold.
+    The links are identified by the ip of the neighbour, since the ids of
+    the neighbours are reassigned when they die.
+    """
+
+    __slots__ = ['half_life', 'suppress', 'reuse', 'max_penalty', 'xtime',
+                 'penalties', 'suppressed']
+
+    def __init__(self, half_life=settings.FLAP_HALF_LIFE,
+                 suppress=settings.FLAP_SUPPRESS, reuse=settings.FLAP_REUSE,
+                 max_penalty=settings.FLAP_MAX_PENALTY, xtimemod=xtime):
+        """
+        half_life: seconds after which the penalty is halved
+        suppress: if 0, the damping is disabled
+        max_penalty: the maximum value of a penalty. It limits the time
+                     a link can be suppressed.
+        """
+        self.half_life = half_life * 1000.
+        self.suppress = suppress
+        self.reuse = reuse
+        self.max_penalty = max_penalty
+        self.xtime = xtimemod
+
+        self.penalties = {} # {ip: (penalty, time of the last update)}
+        self.suppressed = set() # ips of the suppressed links
+
+    def penalty(self, ip):
+        """Returns the current penalty of the link with `ip'"""
+        if ip not in self.penalties:
+            return 0
+        penalty, t = self.penalties[ip]
+        return penalty * 0.5 ** ((self.xtime.time() - t) / self.half_life)
+
+    def flap(self, ip, penalty):
+        """Adds `penalty' to the link with `ip'.
+        Returns True if the link is suppressed."""
+
+        if not self.suppress:
+            return False
+
+        penalty = min(self.penalty(ip) + penalty, self.max_penalty)
+        self.penalties[ip] = (penalty, self.xtime.time())
+        if penalty >= self.suppress:
+            self.suppressed.add(ip)
+        return self.is_suppressed(ip)
+
+    def is_suppressed(self, ip):
+        return self.reuse_time(ip) > 0
+
+    def reuse_time(self, ip):
+        """Returns the ms remaining before the link with `ip' can be reused,
+        or 0 if it isn't suppressed."""
+
+        if ip not in self.suppressed:
+            return 0
+        penalty = self.penalty(ip)
+        if penalty < self.reuse:
+            self.suppressed.discard(ip)
+            return 0
+        return int(self.half_life * log(penalty / self.reuse, 2)) + 1
+
+    def clear(self):
+        """Forgets the penalties of all the links"""
+        self.penalties.clear()
+        self.suppressed.clear()
+
 class Etp(object):
     """Extended Tracer Packet"""
 
@@ -38,22 +540,68 @@ class Etp(object):
         self.neigh = radar.neigh
         self.maproute = maproute
 
+        self.etp_cache = EtpCache(xtimemod=radar.xtime)
+
+        # The ETPs sent to a neighbour are held for `merge_window' ms, so
+        # that the ETPs with the same TPL can be merged in one message.
+        self.merge_window = settings.ETP_MERGE_WINDOW
+        self.etp_queue = {} # {neigh.id: [((TPL fp, flag), R, TPL, flag)]}
+
+        self.send_failures = {} # {neigh.id: number of ETPs not delivered}
+
+        self.damping = FlapDamping(xtimemod=radar.xtime)
+        self.damping_waiting = set() # ips of the suppressed neighbours,
+                                     # waiting to be reused
+
         self.neigh.events.listen('NEIGH_NEW', self.etp_new_changed)
         self.neigh.events.listen('NEIGH_REM_CHGED', self.etp_new_changed)
         self.neigh.events.listen('NEIGH_DELETED', self.etp_new_dead)
 
         self.events = Event(['ETP_EXECUTED', 'NET_COLLISION'])
 
-        self.remotable_funcs = [self.etp_exec]
+        self.stats = Stats(['etp_received', 'etp_forwarded', 'etp_sent',
+                            'etp_send_failed', 'etp_suppressed',
+                            'dropped_dup', 'dropped_collision',
+                            'dropped_atp', 'dropped_uninteresting',
+                            'dropped_rem_type',
+                            'routes_changed'],
+                           ['etp_exec', 'etp_new_changed',
+                            'routes_changed_per_etp'])
+
+        self.peer_codec = {} # {neigh.ip: ETP_CODEC_VERSION, or 0 if the
+                             #  neighbour understands only rencoded ETPs}
+
+        self.remotable_funcs = [self.etp_exec, self.etp_exec_packed,
+                                self.etp_codec_versions, self.stats_get]
+
+    def etp_reset(self):
+        """Forgets the executed and the queued ETPs. Called when our nip
+        changes: they refer to the old one.
+
+        The flap penalties are forgotten too: after the hook all the
+        neighbours are readvertised as new, and those replays aren't flaps
+        of their links."""
+        self.etp_cache.clear()
+        self.etp_queue.clear()
+        self.damping.clear()
 
     @microfunc(True)
     def etp_new_dead(self, neigh):
         """Builds and sends a new ETP for the worsened link case."""
 
+        self.etp_cache.gw_forget(neigh.id)
+        self.send_failures.pop(neigh.id, None)
+        self.peer_codec.pop(neigh.ip, None)
+        # the ETPs queued for the dead neighbour mustn't be sent to the next
+        # neighbour taking its id
+        self.etp_queue.pop(neigh.id, None)
+
+        # The death of a link isn't suppressed: the routes passing through it
+        # must be withdrawn anyway.
+        self.damping.flap(neigh.ip, settings.FLAP_PENALTY_LINK)
+
         ## Create R
-        def gw_is_neigh((dst, gw, rem)):
-            return gw == neigh.id
-        R = self.maproute.bestroutes_get(gw_is_neigh)
+        R = self.maproute.bestroutes_via_gw(neigh.id)
         ##
 
         ## Update the map
@@ -66,13 +614,13 @@ class Etp(object):
             return None
 
         ## Create R2
-        def rem_or_none(r):
-            if r is not None:
-                return r.rem
+        def rem_or_none(n):
+            if n is not None and not n.is_empty():
+                return n.best_route().rem
             return DeadRem()
 
         R2 = [
-              [ (dst, rem_or_none(self.maproute.node_get(lvl, dst).best_route()))
+              [ (dst, rem_or_none(self.maproute.node_peek(lvl, dst)))
                     for (dst,gw,rem) in R[lvl]
               ] for lvl in xrange(self.maproute.levels)
              ]
@@ -80,13 +628,15 @@ class Etp(object):
 
         ## Forward the ETP to the neighbours
         flag_of_interest=1
-        TP = [[self.maproute.me[0], NullRem()]]    # Tracer Packet included in
-        block_lvl = 0                           # the first block of the ETP
-        etp = (R2, [[block_lvl, TP]], flag_of_interest)
+        TP = TPBlock(0, [self.maproute.me[0]], [NullRem()]) # Tracer Packet
+                                                # included in the first block
+                                                # of the ETP
+        etp = (R2, [TP], flag_of_interest)
         self.etp_forward(etp, [neigh.id])
         ##
 
     @microfunc(True)
+    @timed('etp_new_changed')
     def etp_new_changed(self, neigh, oldrem=None):
         """Builds and sends a new ETP for the changed link case
 
@@ -99,30 +649,54 @@ class Etp(object):
             self.maproute.routeneigh_rem(neigh)
         ##
 
-        ## Create R
-        def gw_isnot_neigh((dst, gw, rem)):
-            return gw != neigh.id
+        ## Flap damping
+        if oldrem is None:
+            penalty = settings.FLAP_PENALTY_LINK
+        else:
+            penalty = settings.FLAP_PENALTY_CHANGE
+        if self.damping.flap(neigh.ip, penalty):
+            # The link is unstable, the ETP will be sent when it settles
+            self.stats.incr('etp_suppressed')
+            if neigh.ip not in self.damping_waiting:
+                self.damping_waiting.add(neigh.ip)
+                self.damping_reuse_wait(neigh.ip)
+            return None
+        ##
 
-        R = self.maproute.bestroutes_get(gw_isnot_neigh)
+        self.etp_routes_send(neigh)
 
-        if is_listlist_empty(R):
-            # R is empty: no need to proceed
-            return None
+    @microfunc(True)
+    def damping_reuse_wait(self, ip):
+        """Waits until the link with `ip' is no more suppressed, then sends
+        our routes to the neighbour, if it is still alive"""
+
+        t = self.damping.reuse_time(ip)
+        while t:
+            self.radar.xtime.swait(t)
+            t = self.damping.reuse_time(ip)
+        self.damping_waiting.discard(ip)
+
+        neigh = self.neigh.ip_to_neigh(ip)
+        if neigh is not None:
+            self.etp_routes_send(neigh)
 
-        def takeoff_gw((dst, gw, rem)):
-            return (dst, rem)
+    def etp_routes_send(self, neigh):
+        """Sends to `neigh' an ETP containing our best routes not passing
+        through it"""
 
-        def takeoff_gw_lvl(L):
-            return map(takeoff_gw, L)
+        ## Create R
+        R = self.maproute.bestroutes_export(neigh.id)
 
-        R = map(takeoff_gw_lvl, R)
+        if is_listlist_empty(R):
+            # R is empty: no need to proceed
+            return None
         ##
 
         ## Send the ETP to `neigh'
         flag_of_interest=1
-        TP = [[self.maproute.me[0], NullRem()]]
-        etp = (R, [[0, TP]], flag_of_interest)
-        neigh.ntkd.etp.etp_exec(self.maproute.me, *etp)
+        TP = TPBlock(0, [self.maproute.me[0]], [NullRem()])
+        etp = (R, [TP], flag_of_interest)
+        self.etp_send(neigh, etp)
         ##
 
     @microfunc()
@@ -133,22 +707,62 @@ class Etp(object):
         R  : the set of routes of the ETP
         TPL: the tracer packet of the path covered until now by this ETP.
              This TP may have covered different levels. In general, TPL
-             is a list of blocks. Each block is a (lvl, TP) pair, where lvl is
-             the level of the block and TP is the tracer packet composed
-             during the transit in the level `lvl'.
-             TP is a list of (hop, rem) pairs.
+             is a list of blocks. Each block is a TPBlock, containing the
+             level of the block and the tracer packet composed during the
+             transit in that level, i.e. the (hop, rem) pairs. The older
+             nodes send the blocks in the legacy format, see
+             tpl_to_legacy().
         flag_of_interest: a boolean
         """
+        self._etp_exec(sender_nip, R, tpl_from_legacy(TPL), flag_of_interest)
+
+    def etp_exec_packed(self, sender_nip, data):
+        """Executes a received ETP encoded with etp_pack()"""
+        R, TPL, flag_of_interest = etp_unpack(data)
+        self.etp_exec(sender_nip, R, TPL, flag_of_interest)
+
+    def etp_codec_versions(self):
+        """Returns the versions of the ETP wire codec we understand"""
+        return (ETP_CODEC_VERSION,)
+
+    @timed('etp_exec')
+    def _etp_exec(self, sender_nip, R, TPL, flag_of_interest):
+        """The body of etp_exec(), executed in the caller's microthread"""
+
+        self.stats.incr('etp_received')
+
+        maproute = self.maproute
+        levels = maproute.levels
 
         gwnip = sender_nip
-        neigh = self.neigh.ip_to_neigh(self.maproute.nip_to_ip(gwnip))
+        neigh = self.neigh.ip_to_neigh(maproute.nip_to_ip(gwnip))
         gw = neigh.id
-        gwrem = neigh.rem
+        gwrem = maproute.rem_import(neigh.rem)
+
+        ## Rem check
+        try:
+            R = self.etp_rems_import(R, TPL)
+        except RemError, e:
+            # the ETP was sent by a node using different metrics
+            self.stats.incr('dropped_rem_type')
+            logging.warning("ETP from %s dropped: %s",
+                            ip_to_str(neigh.ip), e)
+            return None
+        ##
+
+        ## Duplicate check
+        fp = self.etp_cache.fingerprint(gw, gwrem, TPL, flag_of_interest)
+        if self.etp_cache.is_dup(fp, R):
+            self.stats.incr('dropped_dup')
+            return None # drop the packet
+        self.etp_cache.add(fp, R)
+        ##
 
         ## Collision check
         colliding, R = self.collision_check(gwnip, neigh, R)
         if colliding:
             # collision detected. rehook.
+            self.stats.incr('dropped_collision')
             self.events.send('NET_COLLISION',
                              ([nr for nr in self.neigh.neigh_list()
                                       if nr.netid == neigh.netid],)
@@ -157,83 +771,69 @@ class Etp(object):
         ##
 
         ## Group rule
-        level = self.maproute.nip_cmp(self.maproute.me, gwnip)
+        level = maproute.nip_cmp(maproute.me, gwnip)
         for block in TPL:
-            lvl = block[0] # the level of the block
+            lvl = block.lvl # the level of the block
             if lvl < level:
-                block[0] = level
-                blockrem = sum([rem for hop, rem in block[1]], NullRem())
-                block[1] = [[gwnip[level], blockrem]]
+                block.collapse(level, gwnip[level])
                 R[lvl] = []
 
-
-        ### Collapse blocks of the same level
-        #Note: we're assuming the two blocks with the same level are one after
-        #      another.
-        TPL2 = [TPL[0]]
-
-        for block in TPL[1:]:
-            if block[0] == TPL2[-1][0]:
-                TPL2[-1][1]+=block[1]
-            else:
-                TPL2.append(block)
-        TPL = TPL2
+        ### Collapse blocks of the same level and remove dups
+        tpl_compact(TPL)
         ###
-
-        ### Remove dups
-        def remove_contiguos_dups_in_TP(L):
-            L2 = []
-            prec = [None, NullRem()]
-            for x in L:
-                if x[0] != prec[0]:
-                    prec = x
-                    L2.append(x)
-                else:
-                    prec[1] += x[1]
-            return L2
-
-        for block in TPL:
-            block[1] = remove_contiguos_dups_in_TP(block[1])
-        ###
-
         ##
 
         ## ATP rule
         for block in TPL:
-            if self.maproute.me[block[0]] in block[1]:
+            if maproute.me[block.lvl] in block:
+                self.stats.incr('dropped_atp')
                 return    # drop the pkt
         ##
 
         ## The rem of the first block is useless.
-        TPL[0][1][0][1] = NullRem()
+        TPL[0].rem_set(0, NullRem())
         ##
 
-        old_node_nb = self.maproute.node_nb[:]
-
-        ## Update the map from the TPL
-        tprem = gwrem
-        TPL_is_interesting = False
-        for block in reversed(TPL):
-                lvl=block[0]
-                for dst, rem in reversed(block[1]):
-                        if self.maproute.route_change(lvl, dst, gw, tprem):
-                                TPL_is_interesting = True
-                        tprem+=rem # TODO: sometimes rem is an integer
-        ##
-
-        ## Update the map from R
-        for lvl in xrange(self.maproute.levels):
-                for dst, rem in R[lvl]:
-                        if not self.maproute.route_rem(lvl, dst, gw, rem+tprem):
-                                self.maproute.route_change(lvl, dst, gw, rem+tprem)
-        ##
+        old_node_nb = maproute.node_nb[:]
+
+        # The route events are sent all together when the map is updated
+        maproute.batch_begin()
+        try:
+            ## Update the map from the TPL
+            tprem = gwrem
+            TPL_is_interesting = False
+            for block in reversed(TPL):
+                    lvl=block.lvl
+                    for dst, rem in reversed(block.items()):
+                            if maproute.route_change(lvl, dst, gw, tprem):
+                                    TPL_is_interesting = True
+                            tprem+=rem # TODO: sometimes rem is an integer
+            ##
+
+            ## Update the map from R
+            for lvl in xrange(levels):
+                    for dst, rem in R[lvl]:
+                            if not maproute.route_rem(lvl, dst, gw, rem+tprem):
+                                    maproute.route_change(lvl, dst, gw, rem+tprem)
+            ##
+        finally:
+            routes_changed = maproute.batch_commit()
+        self.stats.incr('routes_changed', routes_changed)
+        self.stats.add('routes_changed_per_etp', routes_changed)
 
         ## S
-        S = [ [ (dst, r.rem)
-                for dst, rem in R[lvl]
-                    for r in [self.maproute.node_get(lvl, dst).best_route()]
-                        if r.gw != gw
-              ] for lvl in xrange(self.maproute.levels) ]
+        # S[lvl] maps each destination of R[lvl], for which we have a best
+        # route not passing through `gw', to the rem of that route.
+        S = [{} for lvl in xrange(levels)]
+        for lvl in xrange(levels):
+            Slvl = S[lvl]
+            for dst, rem in R[lvl]:
+                n = maproute.node_peek(lvl, dst)
+                if n is None:
+                    continue
+                r = n.best_route()
+                if r is not None and r.gw != gw:
+                    Slvl[dst] = r.rem
 
         #--
         # Step 5 omitted, see qspn.pdf, 4.1 Extended Tracer Packet:
@@ -243,35 +843,60 @@ class Etp(object):
         #       if not is_listlist_empty(S):
         #
         #               Sflag_of_interest=0
-        #               TP = [(self.maproute.me[0], NullRem())]
-        #               etp = (S, [(0, TP)], Sflag_of_interest)
-        #               neigh.ntkd.etp.etp_exec(self.maproute.me, *etp)
+        #               TP = TPBlock(0, [maproute.me[0]], [NullRem()])
+        #               etp = ([Slvl.items() for Slvl in S], [TP],
+        #                      Sflag_of_interest)
+        #               neigh.ntkd.etp.etp_exec(maproute.me, *etp)
         ##
 
         ## R2
         R2 = [ [ (dst, rem)
                 for dst, rem in R[lvl]
-                    if dst not in [d for d, r in S[lvl]]
-              ] for lvl in xrange(self.maproute.levels) ]
+                    if dst not in S[lvl]
+              ] for lvl in xrange(levels) ]
         ##
 
         ## Continue to forward the ETP if it is interesting
 
         if not is_listlist_empty(R2) or TPL_is_interesting:
-            if TPL[-1][0] != 0:
+            if TPL[-1].lvl != 0:
                 # The last block isn't of level 0. Let's add a new block
-                TP = [[self.maproute.me[0], gwrem]]
-                TPL.append([0, TP])
+                TPL.append(TPBlock(0, [maproute.me[0]], [gwrem]))
             else:
                 # The last block is of level 0. We can append our ID
-                TPL[-1][1].append([self.maproute.me[0], gwrem])
+                TPL[-1].append(maproute.me[0], gwrem)
 
 
             etp = (R2, TPL, flag_of_interest)
             self.etp_forward(etp, [neigh.id])
+            self.stats.incr('etp_forwarded')
+        else:
+            self.stats.incr('dropped_uninteresting')
         ##
 
-        self.events.send('ETP_EXECUTED', (old_node_nb, self.maproute.node_nb[:]))
+        self.events.send('ETP_EXECUTED', (old_node_nb, maproute.node_nb[:]))
+
+    def etp_rems_import(self, R, TPL):
+        """Converts the rems of `R' and `TPL' to the Rem type of the map
+        (see MapRoute.rem_import). TPL is modified in place, the new R is
+        returned. Raises RemError if a rem can't be converted."""
+
+        rem_import = self.maproute.rem_import
+        if self.maproute.metrics == 1:
+            # only check, nothing to convert
+            for Rl in R:
+                for dst, rem in Rl:
+                    rem_import(rem)
+            for block in TPL:
+                for rem in block.rems:
+                    rem_import(rem)
+            return R
+
+        for block in TPL:
+            for i in xrange(len(block)):
+                block.rems[i] = rem_import(block.rems[i])
+            block._rem_update()
+        return [ [(dst, rem_import(rem)) for dst, rem in Rl] for Rl in R ]
 
     def etp_forward(self, etp, exclude):
         """Forwards the `etp' to all our neighbours,
@@ -281,7 +906,137 @@ class Etp(object):
 
         for nr in self.neigh.neigh_list():
             if nr.id not in exclude:
-                nr.ntkd.etp.etp_exec(self.maproute.me, *etp)
+                self.etp_send(nr, etp)
+
+    def etp_send(self, neigh, etp):
+        """Sends the `etp' to `neigh'.
+
+        If the merge window is enabled, the ETP is queued and it will be sent,
+        possibly merged with the other ETPs queued for `neigh', when the
+        window expires."""
+
+        if not self.merge_window:
+            self.etp_deliver(neigh, [etp])
+        elif self.etp_queue_add(neigh.id, etp):
+            self.etp_queue_flush(neigh.id)
+
+    def etp_queue_add(self, nid, etp):
+        """Adds `etp' to the queue of the neighbour `nid'.
+
+        If the last queued ETP has the same TPL and flag of interest, the
+        routes of `etp' are merged into it: the rems of `etp' supersede the
+        older ones. Otherwise `etp' is appended: the ETPs are delivered in
+        the order they have been sent, since the receiver keeps the route
+        of the last one it executes. The R of an ETP can't be merged with
+        that of an ETP with a different TPL, because its rems are relative
+        to the start of the TPL.
+
+        Returns True if the queue was empty."""
+
+        R, TPL, flag_of_interest = etp
+        key = (tpl_fingerprint(TPL), flag_of_interest)
+
+        queue = self.etp_queue.get(nid)
+        was_empty = queue is None
+        if was_empty:
+            queue = self.etp_queue[nid] = []
+
+        if not queue or queue[-1][0] != key:
+            queue.append((key, [{} for lvl in xrange(len(R))], TPL,
+                          flag_of_interest))
+        Rq = queue[-1][1]
+        for lvl in xrange(len(R)):
+            Rq[lvl].update(R[lvl])
+
+        return was_empty
+
+    def etp_queue_pop(self, nid):
+        """Removes and returns the list of ETPs queued for `nid', in the
+        order they have been queued"""
+        queue = self.etp_queue.pop(nid, [])
+        return [ ([Rl.items() for Rl in R], TPL, flag_of_interest)
+                    for key, R, TPL, flag_of_interest in queue ]
+
+    @microfunc(True)
+    def etp_queue_flush(self, nid):
+        """Waits the merge window, then sends the ETPs queued for `nid'"""
+
+        self.radar.xtime.swait(self.merge_window)
+
+        etps = self.etp_queue_pop(nid)
+        neigh = self.neigh.id_to_neigh(nid)
+        if neigh is None:
+            # the neighbour died in the meanwhile
+            return
+        self.etp_deliver(neigh, etps)
+
+    @microfunc(True)
+    def etp_deliver(self, neigh, etps):
+        """Delivers the list of `etps' to `neigh'.
+
+        The ETPs are sent with one-way calls to the neighbours supporting
+        them, since the reply of etp_exec is never used. Each call runs in
+        its own microthread, so the delivery to a neighbour doesn't wait the
+        delivery to the previous ones.
+        The failed deliveries are counted in self.send_failures."""
+
+        for i, etp in enumerate(etps):
+            try:
+                self.etp_deliver_one(neigh, etp)
+            except Exception, e:
+                # the connection is broken: the remaining ETPs are lost too
+                self.send_failures[neigh.id] = \
+                        self.send_failures.get(neigh.id, 0) + len(etps) - i
+                self.stats.incr('etp_send_failed', len(etps) - i)
+                logging.warning("ETP not delivered to %s: %s",
+                                ip_to_str(neigh.ip), e)
+                return
+            self.stats.incr('etp_sent')
+
+    def etp_deliver_one(self, neigh, etp):
+        """Sends `etp' to `neigh'.
+
+        A neighbour understanding our codec supports one-way calls too: the
+        ETP is encoded with etp_pack() and sent with a one-way call. The
+        other neighbours are older nodes: they receive it with an ordinary
+        call, whose reply is read and discarded, and with the TPL in the
+        legacy format."""
+
+        if self.peer_codec_get(neigh) == ETP_CODEC_VERSION:
+            try:
+                data = etp_pack(*etp)
+            except EtpCodecError:
+                # f.e. a rem not supported by the codec
+                neigh.ntkd.oneway.etp.etp_exec(self.maproute.me, *etp)
+            else:
+                neigh.ntkd.oneway.etp.etp_exec_packed(self.maproute.me, data)
+        else:
+            R, TPL, flag_of_interest = etp
+            neigh.ntkd.etp.etp_exec(self.maproute.me, R, tpl_to_legacy(TPL),
+                                    flag_of_interest)
+
+    def peer_codec_get(self, neigh):
+        """Returns the version of the ETP codec to use with `neigh', or 0
+        if its ETPs have to be sent with rencode and ordinary calls"""
+
+        if neigh.ip not in self.peer_codec:
+            try:
+                versions = neigh.ntkd.etp.etp_codec_versions()
+            except RPCError:
+                # an old neighbour: etp_codec_versions isn't remotable
+                versions = ()
+            if ETP_CODEC_VERSION in versions:
+                self.peer_codec[neigh.ip] = ETP_CODEC_VERSION
+            else:
+                self.peer_codec[neigh.ip] = 0
+        return self.peer_codec[neigh.ip]
+
+    def stats_get(self):
+        """Returns the counters and the histograms of the ETP activity.
+
+        The histograms etp_exec and etp_new_changed are the execution times,
+        in microseconds, of the respective functions."""
+        return self.stats.values()
 
     def collision_check(self, gwnip, neigh, R):
         """ Checks if we are colliding with the network of `neigh'.
@@ -309,7 +1064,8 @@ class Etp(object):
 
                 ### Remove colliding routes from R
                 R = [[(dst, rem) for dst, rem in R[lvl]
-                        if self.maproute.node_get(lvl, dst).is_empty()
+                        for n in [self.maproute.node_peek(lvl, dst)]
+                            if n is None or n.is_empty()
                      ]
                      for lvl in xrange(self.maproute.levels)
                 ]
@@ -332,7 +1088,7 @@ class Etp(object):
         ## Remove colliding routes directly from our map
         for lvl in xrange(self.maproute.levels):
             for dst, rem in R[lvl]:
-                self.maproute.node_get(lvl, dst).route_reset()
+                self.maproute.node_routes_reset(lvl, dst)
         ##
 
         return (False, R)
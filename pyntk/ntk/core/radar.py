@@ -26,17 +26,20 @@
 # In this way, the other modules of pyntk will be noticed.
 #
 # A radar is fired periodically by Radar.run(), which is started as a
-# microthread.
+# microthread. While the neighbourhood is stable, the scans are sent less
+# often and with smaller bouquets. After a change or a missed reply, they are
+# sent again immediately and with full bouquets (see Radar.schedule_update).
 #
-# TODO: the current statistic is based on the RTT (Round Trip Time)
-# of the packets. However, more refined way can be used and shall be
-# implemented: first of all consider the number of bouquet packets lost, then
-# see NTK_RFC 0002  http://lab.dyne.org/Ntk_bandwidth_measurement
+# The statistic of each link (neighbour, device) is kept by a LinkEstimator
+# across the scans: it combines the RTT (Round Trip Time) of the packets, its
+# jitter and the ratio of the bouquet packets lost.
+# TODO: see NTK_RFC 0002  http://lab.dyne.org/Ntk_bandwidth_measurement
 #
 ##
 
 
 
+from heapq import heapify, heappop, heappush
 from random import randint
 
 import ntk.lib.rpc as rpc
@@ -46,7 +49,8 @@ from ntk.config import settings
 from ntk.core.route import DeadRem, Rtt
 from ntk.lib.event import Event
 from ntk.lib.log import logger as logging
-from ntk.lib.micro import micro
+from ntk.lib.micro import micro, Channel
+from ntk.lib.stats import Stats
 from ntk.network.inet import ip_to_str, str_to_ip
 
 
@@ -98,6 +102,60 @@ class Neigh(object):
                                             if name != 'ntkd']
         return dict(v)
 
+class LinkEstimator(object):
+    """Streaming estimate of the quality of a link (neighbour, device).
+
+    rtt and jitter are exponentially weighted moving averages of the RTT
+    samples and of their deviation, as in RFC 2988. The loss ratio is
+    computed on the last `window' packets sent to the neighbour."""
+
+    __slots__ = ['rtt', 'jitter', 'window', 'received', 'sent']
+
+    def __init__(self, window=settings.LOSS_WINDOW):
+        self.rtt = None
+        self.jitter = 0.
+        self.window = window
+        # bitmap of the last `window' packets: a set bit is a reply
+        self.received = 0
+        # number of packets sent, up to `window'
+        self.sent = 0
+
+    def sample(self, rtt):
+        """Adds a RTT sample, in milliseconds"""
+        if self.rtt is None:
+            self.rtt = float(rtt)
+        else:
+            self.jitter += (abs(rtt - self.rtt) - self.jitter) / 4
+            self.rtt += (rtt - self.rtt) / 8
+
+    def bouquet(self, sent, replies):
+        """Records that `replies' of the `sent' packets of a bouquet have
+        been answered"""
+        replies = min(replies, sent)
+        mask = (1 << self.window) - 1
+        if sent >= self.window:
+            self.received = (1 << min(replies, self.window)) - 1
+        else:
+            self.received = ((self.received << sent) |
+                             ((1 << replies) - 1)) & mask
+        self.sent = min(self.sent + sent, self.window)
+
+    def loss(self):
+        """Returns the ratio of the packets lost in the window"""
+        if not self.sent:
+            return 0.
+        return 1 - bin(self.received).count('1') / float(self.sent)
+
+    def value(self):
+        """Returns the rtt of the link, in milliseconds, penalised by its
+        jitter and its loss ratio. The result is at least 1."""
+        if self.rtt is None:
+            return None
+        received = 1 - self.loss()
+        if not received:
+            return None
+        return max(1, int(round((self.rtt + self.jitter) / received)))
+
 class Neighbour(object):
     """ This class manages all neighbours """
 
@@ -106,10 +164,15 @@ class Neighbour(object):
                  'ip_table',
                  'ntk_client',
                  'translation_table',
+                 'id_table',
+                 'free_ids',
                  'netid_table',
                  'events',
                  'remotable_funcs',
-                 'xtime']
+                 'xtime',
+                 '_neigh_views',
+                 '_ip_views',
+                 '_id_views']
 
     def __init__(self, max_neigh=settings.MAX_NEIGH, xtimemod=xtime):
         """  max_neigh: maximum number of neighbours we can have """
@@ -123,6 +186,11 @@ class Neighbour(object):
         self.ntk_client = {}  # ip : rpc.TCPClient(ipstr)
         # IP => ID translation table
         self.translation_table = {}
+        # ID => IP, the inverse of translation_table
+        self.id_table = {}
+        # heap of the IDs not yet assigned
+        self.free_ids = range(1, self.max_neigh + 1)
+        heapify(self.free_ids)
         # IP => netid
         self.netid_table = {}
         # the events we raise
@@ -132,17 +200,49 @@ class Neighbour(object):
 
         self.remotable_funcs = [self.ip_change]
 
-    def neigh_list(self):
-        """ return the list of neighbours """
+        # Cached Neigh views of the table, see _views_update()
+        self._views_reset()
+
+    def _views_reset(self):
+        """Invalidates the cached Neigh views. They will be rebuilt by the
+        next neigh_list(), ip_to_neigh() or id_to_neigh()"""
+        self._neigh_views = None
+        self._ip_views = {}
+        self._id_views = {}
+
+    def _views_update(self):
+        """Rebuilds the cached Neigh views, if they have been invalidated.
+
+        The same Neigh instances are returned to all the callers until the
+        table changes, thus they must be treated as read-only."""
+        if self._neigh_views is not None:
+            return
         nlist = []
-        for key, val in self.ip_table.items():
+        for key, val in self.ip_table.iteritems():
+            if key not in self.translation_table:
+                # it is being deleted by store()
+                continue
             nlist.append(Neigh(bestdev=val.bestdev,
                                devs=val.devs,
                                idn=self.translation_table[key],
                                ip=key,
                                netid=self.netid_table[key],
                                ntkd=self.ntk_client[key]))
-        return nlist
+        self._neigh_views = tuple(nlist)
+        self._ip_views = dict([(n.ip, n) for n in nlist])
+        self._id_views = dict([(n.id, n) for n in nlist])
+
+    def _view_is_stale(self, ip, nodeinfo):
+        """Returns True if the cached view of `ip' doesn't match the new
+        entry `nodeinfo' of the ip_table"""
+        v = self._ip_views.get(ip)
+        return (v is None or v.bestdev != nodeinfo.bestdev or
+                v.devs != nodeinfo.devs or v.netid != self.netid_table.get(ip))
+
+    def neigh_list(self):
+        """ return the tuple of neighbours """
+        self._views_update()
+        return self._neigh_views
 
     def ip_to_id(self, ipn):
         """ if ipn is in the translation table, return the associated id;
@@ -152,39 +252,30 @@ class Neighbour(object):
 
         if ipn in self.translation_table:
             return self.translation_table[ipn]
-        new_id = self._find_hole_in_tt()
-        if new_id:
-            self.translation_table[ipn] = new_id
-            return new_id
-        else:
+        if not self.free_ids:
             return False
+        new_id = heappop(self.free_ids)
+        self.translation_table[ipn] = new_id
+        self.id_table[new_id] = ipn
+        return new_id
 
     def ip_to_neigh(self, ip):
         """ ip: neighbour's ip
             return a Neigh object from an ip
         """
-        if ip not in self.translation_table:
-            return None
-        else:
-            return Neigh(bestdev=self.ip_table[ip].bestdev,
-                         devs=self.ip_table[ip].devs,
-                         idn=self.translation_table[ip],
-                         ip=ip,
-                         netid=self.netid_table[ip],
-                         ntkd=self.ntk_client[ip])
+        self._views_update()
+        return self._ip_views.get(ip)
 
     def id_to_ip(self, id):
         """Returns the IP associated to `id'.
         If not found, returns None
         """
-        for ip in self.translation_table:
-            if self.translation_table[ip] == id:
-                return ip
-        return None
+        return self.id_table.get(id)
 
     def id_to_neigh(self, id):
         """Returns a Neigh object from an id"""
-        return self.ip_to_neigh(self.id_to_ip(id))
+        self._views_update()
+        return self._id_views.get(id)
 
     def _truncate(self, ip_table):
         """ip_table: an {IP => NodeInfo};
@@ -226,9 +317,8 @@ class Neighbour(object):
 
     def _find_hole_in_tt(self):
         """Find the first available index in translation_table"""
-        for i in xrange(1, self.max_neigh + 1):
-            if i not in self.translation_table.values():
-                return i
+        if self.free_ids:
+            return self.free_ids[0]
         return False
 
     def store(self, ip_table):
@@ -236,12 +326,18 @@ class Neighbour(object):
         changes
 
         ip_table: the new ip_table;
+
+        Returns True if at least one event has been sent.
         """
 
         # the rows deleted during truncation
         died_ip_list = []
 
+        # True if the cached views have to be rebuilt
+        changed = self._neigh_views is None
+
         ip_table, died_ip_list = self._truncate(ip_table)
+        notified = bool(died_ip_list)
 
         # first of all we cycle through the old ip_table
         # looking for nodes that aren't in the new one
@@ -251,11 +347,14 @@ class Neighbour(object):
             # during truncation
             if not key in ip_table and not key in died_ip_list:
                 self.delete(key, remove_from_iptable=False)
+                notified = True
 
         # now we cycle through the new ip_table
         # looking for nodes who weren't in the old one
         # or whose rtt has sensibly changed
         for key in ip_table:
+            if not changed and self._view_is_stale(key, ip_table[key]):
+                changed = True
             # if a node has been added
             if not key in self.ip_table:
                 # generate an id and add the entry in translation_table
@@ -263,6 +362,7 @@ class Neighbour(object):
                 # create a TCP connection to the neighbour
                 self.ntk_client[key] = rpc.TCPClient(ip_to_str(key))
                 # send a message notifying we added a node
+                notified = True
                 self.events.send('NEIGH_NEW',
                                  (Neigh(bestdev=ip_table[key].bestdev,
                                         devs=ip_table[key].devs,
@@ -278,6 +378,7 @@ class Neighbour(object):
                 rtt_variation = abs(new_rtt - old_rtt) / float(old_rtt)
                 if rtt_variation > self.rtt_variation_threshold:
                     # send a message notifying the node's rtt changed
+                    notified = True
                     self.events.send('NEIGH_REM_CHGED',
                                      (Neigh(bestdev=self.ip_table[key].bestdev,
                                             devs=self.ip_table[key].devs,
@@ -288,7 +389,10 @@ class Neighbour(object):
                                       Rtt(new_rtt)))
 
         # finally, update the ip_table
+        if changed or len(ip_table) != len(self.ip_table):
+            self._views_reset()
         self.ip_table = ip_table
+        return notified
 
     def readvertise(self):
         """Sends a NEIGH_NEW event for each stored neighbour"""
@@ -307,6 +411,7 @@ class Neighbour(object):
 
         logging.info("Deleting neighbour %s", ip_to_str(ip))
 
+        self._views_reset()
         if remove_from_iptable:
             del self.ip_table[ip]
 
@@ -316,6 +421,10 @@ class Neighbour(object):
 
         # delete the entry from the translation table...
         old_id = self.translation_table.pop(ip)
+        # ...and release the id, unless ip_change() passed it to the new IP
+        if self.id_table.get(old_id) == ip:
+            del self.id_table[old_id]
+            heappush(self.free_ids, old_id)
         # ...and from the netid_table
         old_netid = self.netid_table.pop(ip)
         # send a message notifying we deleted the entry
@@ -337,10 +446,12 @@ class Neighbour(object):
                                                             ip_to_str(newip)))
         self.ip_table[newip] = self.ip_table[oldip]
         self.translation_table[newip] = self.translation_table[oldip]
+        self.id_table[self.translation_table[newip]] = newip
         self.netid_table[newip] = self.netid_table[oldip]
 
         # we have to create a new TCP connection
         self.ntk_client[newip] = rpc.TCPClient(ip_to_str(newip))
+        self._views_reset()
 
         self.events.send('NEIGH_NEW',
                          (Neigh(bestdev=self.ip_table[newip].bestdev,
@@ -355,9 +466,12 @@ class Neighbour(object):
 
 class Radar(object):
     __slots__ = [ 'bouquet_numb', 'bcast_send_time', 'xtime',
-                  'bcast_arrival_time', 'max_bouquet', 'max_wait_time',
+                  'bcast_replies', 'links', 'max_bouquet', 'max_wait_time',
                   'broadcast', 'neigh', 'events', 'netid', 'do_reply',
-                  'remotable_funcs', 'ntkd_id', 'radar_id', 'max_neigh']
+                  'remotable_funcs', 'ntkd_id', 'radar_id', 'max_neigh',
+                  'min_bouquet', 'max_interval', 'bouquet_size',
+                  'scan_interval', 'stable_scans', 'grace_time', 'scan_chan',
+                  'scan_time', 'stats', 'reply_clients']
 
     def __init__(self, broadcast, xtime):
         """
@@ -372,12 +486,27 @@ class Radar(object):
         self.bouquet_numb = 0
         # when we sent the broadcast packets
         self.bcast_send_time = 0
-        # when the replies arrived
-        self.bcast_arrival_time = {}
+        # how many replies arrived: {ip: {dev: n}}
+        self.bcast_replies = {}
+        # the LinkEstimators of the links: {ip: {dev: LinkEstimator}}
+        self.links = {}
         # max_bouquet: how many packets does each bouquet contain?
         self.max_bouquet = settings.MAX_BOUQUET
+        # min_bouquet: the size of the bouquets sent while the neighbourhood
+        # is stable
+        self.min_bouquet = min(settings.MIN_BOUQUET, self.max_bouquet)
+        # max_interval: the maximum pause between two scans, in seconds
+        self.max_interval = settings.MAX_SCAN_INTERVAL
         # max_wait_time: the maximum time we can wait for a reply, in seconds
         self.max_wait_time = settings.MAX_WAIT_TIME
+        # grace_time: how long we still wait for new neighbours once all the
+        # known ones have replied, in milliseconds
+        self.grace_time = settings.SCAN_GRACE_TIME
+        # time_register() signals on this channel when the current scan
+        # becomes complete, see scan_wait()
+        self.scan_chan = None
+        # how long the last scan took, in milliseconds
+        self.scan_time = 0
         # max_neigh: maximum number of neighbours we can have
         self.max_neigh = settings.MAX_NEIGH
         # our neighbours
@@ -393,10 +522,21 @@ class Radar(object):
         # If set to True, this module will reply to radar queries sent by our
         # neighbours.
         self.do_reply = False
+        # the broadcast clients used to reply, one for each device
+        self.reply_clients = {}
 
-        self.remotable_funcs = [self.reply, self.time_register]
+        self.stats = Stats(['scans', 'scans_early'], ['scan_time'])
+
+        self.remotable_funcs = [self.reply, self.time_register, self.stats_get]
 
         self.ntkd_id = randint(0, 2**32-1)
+        # the id of the current scan
+        self.radar_id = None
+
+        # The scan schedule, see schedule_update()
+        self.stable_scans = 0
+        self.bouquet_size = self.max_bouquet
+        self.scan_interval = 0
 
     def run(self, started=0):
         if not started:
@@ -404,25 +544,35 @@ class Radar(object):
         else:
             while True:
                 self.radar()
+                if self.scan_interval:
+                    self.xtime.swait(self.scan_interval)
 
     def radar(self):
         """ Send broadcast packets and store the results in neigh """
 
         self.radar_id = randint(0, 2**32-1)
+        self.scan_chan = Channel(prefer_sender=True)
         logging.debug('radar scan %s' % self.radar_id)
 
         # we're sending the broadcast packets NOW
         self.bcast_send_time = self.xtime.time()
 
         # send all packets in the bouquet
-        for i in xrange(self.max_bouquet):
+        for i in xrange(self.bouquet_size):
             self.broadcast.radar.reply(self.ntkd_id, self.radar_id)
 
-        # then wait
-        self.xtime.swait(self.max_wait_time * 1000)
+        # then wait the replies
+        self.scan_wait()
+        self.scan_time = self.xtime.time() - self.bcast_send_time
+        self.stats.incr('scans')
+        self.stats.add('scan_time', self.scan_time)
+        logging.debug('radar scan %s done in %dms' % (self.radar_id,
+                                                     self.scan_time))
 
         # update the neighbours' ip_table
-        self.neigh.store(self.get_all_avg_rtt())
+        missed = self.replies_missed()
+        self.links_update()
+        changed = self.neigh.store(self.get_all_avg_rtt())
 
         # Send the event
         self.bouquet_numb += 1
@@ -430,19 +580,143 @@ class Radar(object):
 
         # We're done. Reset.
         self.radar_reset()
+        self.schedule_update(changed or missed)
+
+    def scan_wait(self):
+        """Waits the replies to the current bouquet.
+
+        The wait ends after max_wait_time seconds, or earlier, when all the
+        neighbours have replied to all the packets and no new neighbour has
+        shown up during the following grace_time. A new neighbour makes the
+        scan incomplete: the grace_time starts again once it has replied to
+        all the packets.
+
+        We sleep on self.scan_chan, which receives the alarms set by
+        _scan_alarm() and the completion signals of time_register()."""
+
+        chan = self.scan_chan
+        deadline = self.bcast_send_time + self.max_wait_time * 1000
+        micro(self._scan_alarm, (chan, deadline - self.xtime.time(), deadline))
+        grace_end = None
+        if self.scan_complete():
+            chan.sendq('complete')
+        while True:
+            msg = chan.recvq()
+            now = self.xtime.time()
+            if msg == deadline or now >= deadline:
+                return
+            elif msg == 'complete':
+                # (re)start the grace period
+                grace_end = now + self.grace_time
+                if grace_end < deadline:
+                    micro(self._scan_alarm, (chan, self.grace_time, grace_end))
+            elif msg == grace_end and self.scan_complete():
+                self.stats.incr('scans_early')
+                return
+
+    def _scan_alarm(self, chan, t, msg):
+        """Sends `msg' to the channel `chan' after `t' milliseconds"""
+        self.xtime.swait(t)
+        chan.sendq(msg)
+
+    def _replies(self, ip):
+        """Returns the number of replies received from `ip' on its best
+        device"""
+        if ip not in self.bcast_replies:
+            return 0
+        return max(self.bcast_replies[ip].itervalues())
+
+    def replies_missed(self):
+        """Returns True if a known neighbour hasn't replied to all the
+        packets of the bouquet"""
+        for ip in self.neigh.ip_table:
+            if self._replies(ip) < self.bouquet_size:
+                return True
+        return False
+
+    def scan_complete(self):
+        """Returns True if all the known neighbours and all the new ones
+        have replied to all the packets of the bouquet"""
+        if self.replies_missed():
+            return False
+        for ip in self.bcast_replies:
+            if self._replies(ip) < self.bouquet_size:
+                return False
+        return True
+
+    def links_update(self):
+        """Updates the loss ratio of the links with the replies to the
+        current bouquet.
+
+        The links of the neighbours which haven't replied at all are
+        forgotten: they are going to be deleted."""
+        for ip in self.links.keys():
+            if ip not in self.bcast_replies:
+                del self.links[ip]
+        for ip, devs in self.links.iteritems():
+            replies = self.bcast_replies[ip]
+            for dev, link in devs.iteritems():
+                link.bouquet(self.bouquet_size, replies.get(dev, 0))
+
+    def schedule_update(self, changed):
+        """Adapts the next scans to the state of the neighbourhood.
+
+        If `changed' is True, the next scan is started immediately with a
+        full bouquet. Otherwise, at each stable scan the bouquet is halved,
+        down to min_bouquet, and the pause between two scans is doubled,
+        starting from 500ms, up to max_interval.
+
+        The pause delays the detection of a dead neighbour, thus it is kept
+        short: most of the traffic is saved by the smaller bouquets."""
+
+        if changed:
+            self.stable_scans = 0
+            self.bouquet_size = self.max_bouquet
+            self.scan_interval = 0
+            return
+
+        self.stable_scans += 1
+        # the shift is bounded, the result is anyway capped
+        shift = min(self.stable_scans, 16)
+        self.bouquet_size = max(self.min_bouquet, self.max_bouquet >> shift)
+        self.scan_interval = min(self.max_interval * 1000, 500 << (shift - 1))
 
     def radar_reset(self):
         ''' Clean the objects needed by radar()'''
         # Clean some stuff
-        self.bcast_arrival_time = {}
+        self.bcast_replies = {}
+        # drop the late replies
+        self.radar_id = None
+        self.scan_chan = None
 
         # Reset the broadcast sockets
         self.broadcast.reset()
+        self.reply_clients_close()
+
+    def reply_clients_close(self):
+        """Closes the sockets used to reply.
+
+        They are connected UDP sockets, whose source address has been fixed
+        by connect(): they must be closed each time our address changes."""
+        for client in self.reply_clients.itervalues():
+            client.close()
+        self.reply_clients.clear()
 
     def reply(self, _rpc_caller, ntkd_id, radar_id):
         """ As answer we'll return our netid """
         if self.do_reply and ntkd_id != self.ntkd_id:
-            rpc.BcastClient(devs=[_rpc_caller.dev], xtimemod=self.xtime).radar.time_register(radar_id, self.netid)
+            dev = _rpc_caller.dev
+            if dev not in self.reply_clients:
+                self.reply_clients[dev] = rpc.BcastClient(devs=[dev],
+                                                         xtimemod=self.xtime)
+            try:
+                self.reply_clients[dev].radar.time_register(radar_id,
+                                                            self.netid)
+            except:
+                # the device may be gone: the socket will be recreated by
+                # the next reply
+                self.reply_clients.pop(dev).close()
+                raise
             return self.netid
 
     def time_register(self, _rpc_caller, radar_id, netid):
@@ -457,23 +731,35 @@ class Radar(object):
 
         # this is the rtt
         time_elapsed = int((self.xtime.time() - self.bcast_send_time) / 2)
-        # let's store it in the bcast_arrival_time table
-        if ip in self.bcast_arrival_time:
-            if net_device in self.bcast_arrival_time[ip]:
-                self.bcast_arrival_time[ip][net_device].append(time_elapsed)
-            else:
-                self.bcast_arrival_time[ip][net_device] = [time_elapsed]
+        # let's count the reply and feed the rtt to the link estimator
+        if ip in self.bcast_replies:
+            replies = self.bcast_replies[ip]
+            replies[net_device] = replies.get(net_device, 0) + 1
         else:
-            self.bcast_arrival_time[ip] = {}
-            self.bcast_arrival_time[ip][net_device] = [time_elapsed]
+            replies = self.bcast_replies[ip] = {net_device: 1}
             logging.info("Radar: new IP %s detected", ip_to_str(ip))
+        if replies[net_device] == self.bouquet_size and self.scan_complete():
+            # wake up scan_wait()
+            self.scan_chan.sendq('complete')
+        devs = self.links.setdefault(ip, {})
+        if net_device not in devs:
+            devs[net_device] = LinkEstimator()
+        devs[net_device].sample(time_elapsed)
 
         self.neigh.netid_table[ip] = netid
 
 
+    def stats_get(self):
+        """Returns the counters and the histograms of the radar.
+
+        The histogram scan_time is the duration of the scans, in
+        milliseconds."""
+        return self.stats.values()
+
     def get_avg_rtt(self, ip):
         """ ip: an ip;
-            Calculates the average rtt of IP for each device
+            Returns the estimated rtt of IP for each device which replied
+            to the current bouquet (see LinkEstimator.value)
 
             Returns the ordered list [(dev, avgrtt)], the first element has
             the best average rtt.
@@ -482,9 +768,8 @@ class Radar(object):
         devlist = []
 
         # for each NIC
-        for dev in self.bcast_arrival_time[ip]:
-            avg = sum(self.bcast_arrival_time[ip][dev]) / len(self.bcast_arrival_time[ip][dev])
-            devlist.append( (dev, avg) )
+        for dev in self.bcast_replies[ip]:
+            devlist.append( (dev, self.links[ip][dev].value()) )
 
         # sort the devices, the best is the first
         def second_element((x,y)): return y
@@ -497,7 +782,7 @@ class Radar(object):
 
         all_avg = {}
         # for each ip
-        for ip in self.bcast_arrival_time:
+        for ip in self.bcast_replies:
             devs = self.get_avg_rtt(ip)
             all_avg[ip] = Neigh(bestdev=devs[0], devs=dict(devs))
         return all_avg
@@ -17,6 +17,8 @@
 # Free Software Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
 ##
 
+from bisect import bisect_left, bisect_right
+
 from ntk.core.map import Map
 from ntk.lib.event import Event
 from ntk.lib.rencode import serializable
@@ -36,14 +38,19 @@ class RouteGwError(Exception):
 class Rem(object):
     """Route Efficiency Measure.
 
-    This is a base class for different metrics (rtt, bandwidth, ...)"""
+    This is a base class for different metrics (rtt, bandwidth, ...)
+
+    self.key is the sort key of the rem, computed once: the greater the key,
+    the better the rem. Rems are compared and ordered by their keys.
+    Rem instances must be considered immutable."""
 
-    __slots__ = ['value', 'max_value', 'avgcoeff']
+    __slots__ = ['value', 'max_value', 'avgcoeff', 'key']
 
     def __init__(self, value=None, max_value=0, avgcoeff=1):
         self.value = value
         self.max_value = max_value        # Maximum value assumed by this REM
         self.avgcoeff = avgcoeff          # Coefficient used for the average
+        self.key = value
 
     def _pack(self):
         return (self.value, self.max_value, self.avgcoeff)
@@ -60,7 +67,7 @@ class Rem(object):
         want to sort it in decrescent order of efficiency, than you
         have to reverse sort it: list.sort(reverse=1)
         """
-        return (self.value > b.value) - (self.value < b.value)
+        return cmp(self.key, b.key)
 
     def __add__(self, b):
         """It sums two REMs.
@@ -72,7 +79,13 @@ class Rem(object):
         return '<%s: %s>' % (self.__class__.__name__, self.value)
 
 class NullRem(Rem):
-    """The equivalent of None for the REM"""
+    """The equivalent of None for the REM. It is better than any other rem"""
+
+    __slots__ = []
+
+    def __init__(self, value=None, max_value=0, avgcoeff=1):
+        Rem.__init__(self, value, max_value, avgcoeff)
+        self.key = float('inf')
 
     def __add__(self, b):
             return b
@@ -82,38 +95,39 @@ class NullRem(Rem):
 serializable.register(NullRem)
 
 class DeadRem(Rem):
-    """A route with this rem is dead"""
+    """A route with this rem is dead. It is worse than any other rem"""
+
+    __slots__ = []
+
+    def __init__(self, value=None, max_value=0, avgcoeff=1):
+        Rem.__init__(self, value, max_value, avgcoeff)
+        self.key = float('-inf')
+
     def __add__(self, b):
         return self
 
 serializable.register(DeadRem)
 
 class Rtt(Rem):
-    """Round Trip Time"""
-
-    def __init__(self, value, max_value=60*1000, avgcoeff=1): # 1 minute in ms
-        Rem.__init__(self, value, max_value, avgcoeff)
-
-    def __cmp__(self, b):
-        """rtt comparison
+    """Round Trip Time
 
-        The comparison's semantic is reversed:
-        if the first rtt is worse (bigger) than the second we will have:
-        rem(rtt1) < rem(rtt2)
+    The comparison's semantic is reversed: if the first rtt is worse (bigger)
+    than the second we will have: rem(rtt1) < rem(rtt2). Thus its key is
+    -value."""
 
-        self.value <  b.value   1   ->  The rtt `self' is better than `b' -> self > b
-        self.value >  b.value  -1   ->  The rtt `self' is worse  than `b' -> self < b
-        self.value == b.value   0   ->  They are the same -> self == b"""
+    __slots__ = []
 
-        return (self.value < b.value) - (self.value > b.value)
+    def __init__(self, value, max_value=60*1000, avgcoeff=1): # 1 minute in ms
+        Rem.__init__(self, value, max_value, avgcoeff)
+        self.key = -value
 
     def __add__(self, b):
-        if isinstance(b, DeadRem):
+        if b.__class__ is Rtt:
+            return Rtt(self.value+b.value, self.max_value, self.avgcoeff)
+        elif isinstance(b, DeadRem):
             return b + self
         elif isinstance(b, NullRem):
             return b + self
-        elif isinstance(b, Rtt):
-            return Rtt(self.value+b.value, self.max_value, self.avgcoeff)
         else:
             return NotImplemented
 
@@ -154,9 +168,13 @@ class Bw(Rem):
         else:
             return NotImplemented
 
+serializable.register(Bw)
+
 class Avg(Rem):
     """Average"""
 
+    __slots__ = []
+
     def __init__(self, rems):
         """Calculates the average of different REMs.
 
@@ -177,6 +195,47 @@ class Avg(Rem):
         raise AvgSumError('the Avg metric cannot be summed.'
                           ' It must be computed each time')
 
+class MultiRem(Rem):
+    """The rems of different metrics of a same route.
+
+    `rems' is a tuple of Rem instances, one for each metric, f.e.
+    (Rtt(...), Bw(...)). The first one is the primary metric: it gives
+    the value and the key of the MultiRem, so it decides if a route is
+    better than another. The other metrics are ordered separately by
+    RouteNode, see RouteNode.best_route().
+    """
+
+    __slots__ = ['rems']
+
+    def __init__(self, rems):
+        self.rems = tuple(rems)
+        Rem.__init__(self, self.rems[0].value)
+        self.key = self.rems[0].key
+
+    def _pack(self):
+        return (self.rems,)
+
+    def __cmp__(self, b):
+        """Compares the primary metrics, then the others in order"""
+        if isinstance(b, MultiRem):
+            return cmp([r.key for r in self.rems], [r.key for r in b.rems])
+        return Rem.__cmp__(self, b)
+
+    def __add__(self, b):
+        if isinstance(b, DeadRem):
+            return b + self
+        elif isinstance(b, NullRem):
+            return b + self
+        elif isinstance(b, MultiRem):
+            return MultiRem([x + y for x, y in zip(self.rems, b.rems)])
+        else:
+            return NotImplemented
+
+    def __repr__(self):
+        return '<MultiRem: %s>' % (self.rems,)
+
+serializable.register(MultiRem)
+
 class RouteGw(object):
     """A route to a known destination.
 
@@ -230,15 +289,29 @@ class RouteNode(object):
 
     Note: for each gateway G there's only one route in self.routes,
           which has the same gateway G
+
+    self.routes is kept ordered incrementally: a new or changed route is
+    moved to its place with a binary search, so it is never re-sorted.
+    self.keys[i] is -self.routes[i].rem.key, thus it is in ascending order
+    and can be searched with bisect.
+    self.gws is the {gw: RouteGw} dict of the same routes.
+
+    If the routes have MultiRem rems, self.routes is ordered by the primary
+    metric and self.morders[m-1] = (keys, routes) is the same ordering for
+    the metric m. A route with a single rem (f.e. a NullRem) is ordered by
+    that rem in each ordering.
     """
 
-    __slots__ = ['routes', 'routes_tobe_synced']
+    __slots__ = ['routes', 'keys', 'gws', 'morders', 'routes_tobe_synced']
 
     def __init__(self,
                  lvl=None, id=None  # these are mandatory for Map.__init__(),
                                     # but they aren't used
                 ):
         self.routes = []
+        self.keys = []
+        self.gws = {}
+        self.morders = None
         self.routes_tobe_synced = 0 # number of routes to update in the kernel
         #TODO: keep the right track of `self.routes_tobe_synced'
         #      maybe it's better to use "self.routes_tobe_synced+-=1" before
@@ -246,10 +319,54 @@ class RouteNode(object):
 
     def route_getby_gw(self, gw):
         """Returns the route having as gateway `gw'"""
-        for r in self.routes:
-            if r.gw == gw:
-                return r
-        return None
+        return self.gws.get(gw)
+
+    def _insert(self, r):
+        """Inserts the route `r' in self.routes, after all the routes which
+        are better or equal to it"""
+        k = -r.rem.key
+        i = bisect_right(self.keys, k)
+        self.keys.insert(i, k)
+        self.routes.insert(i, r)
+
+        if self.morders is None:
+            if not isinstance(r.rem, MultiRem):
+                return
+            # the first MultiRem: order all the routes by the other metrics
+            self.morders = [([], []) for m in r.rem.rems[1:]]
+            for r2 in self.routes:
+                self._minsert(r2)
+        else:
+            self._minsert(r)
+
+    def _mkeys(self, rem):
+        """Returns the keys of `rem' in the orderings of self.morders"""
+        if isinstance(rem, MultiRem):
+            if len(rem.rems) != len(self.morders) + 1:
+                raise RemError('MultiRem with %d metrics in a node with %d' %
+                               (len(rem.rems), len(self.morders) + 1))
+            return [-m.key for m in rem.rems[1:]]
+        return [-rem.key] * len(self.morders)
+
+    def _minsert(self, r):
+        for (keys, routes), k in zip(self.morders, self._mkeys(r.rem)):
+            i = bisect_right(keys, k)
+            keys.insert(i, k)
+            routes.insert(i, r)
+
+    def _remove(self, r):
+        """Removes the route `r' from self.routes. Its rem must not have been
+        changed since it was inserted"""
+        orders = [(self.keys, self.routes, -r.rem.key)]
+        if self.morders is not None:
+            orders += [(keys, routes, k) for (keys, routes), k
+                                    in zip(self.morders, self._mkeys(r.rem))]
+        for keys, routes, k in orders:
+            i = bisect_left(keys, k)
+            while routes[i] is not r:
+                i += 1
+            del routes[i]
+            del keys[i]
 
     def route_rem(self, gw, newrem):
         """Changes the rem of the route with gateway `gw'
@@ -261,8 +378,9 @@ class RouteNode(object):
         if r is None:
             return (0, None)
 
+        self._remove(r)
         oldrem = r.rem_modify(newrem)
-        self.sort()
+        self._insert(r)
         self.routes_tobe_synced += 1
         return (1, oldrem)
 
@@ -281,14 +399,18 @@ class RouteNode(object):
         val = None
         oldr = self.route_getby_gw(gw)
 
-        if self.is_empty() or oldr is None:
+        if oldr is None:
             # If it is a new route, add it
-            self.routes.append(RouteGw(gw, rem))
+            r = RouteGw(gw, rem)
+            self.gws[gw] = r
+            self._insert(r)
             ret = 1
-        elif oldr is not None and rem > oldr.rem:
+        elif rem > oldr.rem:
             # We already have a route with gateway `gw'. However, the new
             # route is better. Let's update the rem.
+            self._remove(oldr)
             oldrem = oldr.rem_modify(rem)
+            self._insert(oldr)
             val = oldrem
             ret = 2
         else:
@@ -296,8 +418,6 @@ class RouteNode(object):
 
         self.routes_tobe_synced+=1
 
-        self.sort()
-
         return (ret, val) # good route
 
     def route_del(self, gw):
@@ -305,27 +425,33 @@ class RouteNode(object):
 
         Returns 1 if the route has been deleted, otherwise 0"""
 
-        r = self.route_getby_gw(gw)
+        r = self.gws.pop(gw, None)
         if r is not None:
             self.routes_tobe_synced+=1
-            self.routes.remove(r)
+            self._remove(r)
             return 1
         return 0
 
     def route_reset(self):
         """Delete all the routes"""
         self.routes = []
+        self.keys = []
+        self.gws = {}
+        self.morders = None
 
     def sort(self):
         '''Order the routes
 
         Order the routes in decrescent order of efficiency, so that
-        self.routes[0] is the best one
+        self.routes[0] is the best one.
+        Note: self.routes is already kept ordered by route_add(),
+        route_rem() and route_del()
         '''
         self.routes.sort(reverse=1)
+        self.keys = [-r.rem.key for r in self.routes]
 
     def is_empty(self):
-        return self.routes == []
+        return not self.routes
 
     def is_free(self):
         '''Override the is_free() method of DataClass (see map.py)'''
@@ -338,11 +464,19 @@ class RouteNode(object):
         # Note: it can be < 0
         return len(self.routes) - self.routes_tobe_synced
 
-    def best_route(self):
+    def best_route(self, metric=0):
+        """Returns the best route. If the routes have MultiRem rems, `metric'
+        is the index of the metric to use. If they have a single metric, the
+        best route of that metric is returned for any `metric'"""
         if self.is_empty():
             return None
-        else:
+        elif metric == 0 or self.morders is None:
             return self.routes[0]
+        elif metric > len(self.morders):
+            raise RemError('the routes have only %d metrics' %
+                           (len(self.morders) + 1))
+        else:
+            return self.morders[metric-1][1][0]
 
     def __repr__(self):
         return '<RouteNode: %s>' % self.routes
@@ -353,14 +487,44 @@ def ftrue(*args):
 class MapRoute(Map):
     """Map of routes, all of a same Rem type.
 
+    If the map is created with metrics > 1, the Rem type is MultiRem: each
+    route carries `metrics' metrics and the best routes can be asked for each
+    of them (see the `metric' parameter of bestroutes_get()). The rems
+    coming from the neighbours and the ETPs are converted with rem_import().
+
     MapRoute.node[lvl][id] is a RouteNode class, i.e. a list of routes
-    having as destination the node (lvl, id)"""
+    having as destination the node (lvl, id). The map is sparse: only the
+    destinations having at least one route are stored.
+
+    MapRoute.dsts[lvl] is the set of destinations of level lvl having at
+    least one route.
+    MapRoute.gw_routes[gw] is the set of (lvl, dst) pairs of the routes
+    having `gw' as gateway.
+    MapRoute.best[lvl] is a {dst: (gw, rem)} dict of the best route of each
+    destination of level lvl. It is kept updated at each route change, see
+    bestroutes_export().
+
+    Changes can be grouped with batch_begin()/batch_commit(): during a
+    batch no ROUTE_* event is sent; at commit time only the net effect of
+    the batch is notified, see batch_commit()."""
 
-    __slots__ = Map.__slots__ + ['remotable_funcs']
+    __slots__ = Map.__slots__ + ['remotable_funcs', 'dsts', 'gw_routes',
+                                 'best', 'batch', 'batch_depth', 'metrics']
 
-    def __init__(self, levels, gsize, me):
+    def __init__(self, levels, gsize, me, metrics=1):
 
-        Map.__init__(self, levels, gsize, RouteNode, me)
+        Map.__init__(self, levels, gsize, RouteNode, me, sparse=True)
+
+        self.metrics = metrics
+
+        self.dsts = [set() for l in xrange(self.levels)]
+        self.gw_routes = {}
+        self.best = [{} for l in xrange(self.levels)]
+
+        # {(lvl, dst): [routes_tobe_synced, {gw: rem}]}, where rem is the rem
+        # of the route before the batch (None if the route didn't exist)
+        self.batch = None
+        self.batch_depth = 0
 
         self.events.add( [  'ROUTE_NEW',
                             'ROUTE_DELETED',
@@ -368,45 +532,187 @@ class MapRoute(Map):
                          ] )
         self.remotable_funcs = [self.free_nodes_nb]
 
+    def batch_begin(self):
+        """Starts a batch of route changes. Batches can be nested: only the
+        outermost batch_commit() sends the events"""
+        if not self.batch_depth:
+            self.batch = {}
+        self.batch_depth += 1
+
+    def batch_commit(self):
+        """Ends a batch of route changes and sends the ROUTE_* events
+        describing its net effect.
+
+        For each changed (lvl, dst, gw) route, at most one event is sent:
+        ROUTE_NEW if the route didn't exist before the batch, ROUTE_DELETED
+        if it doesn't exist anymore, ROUTE_REM_CHGED if its rem is changed.
+        A route added and then deleted, or restored to its old rem, doesn't
+        generate any event.
+
+        Returns the number of events sent."""
+
+        self.batch_depth -= 1
+        if self.batch_depth:
+            return 0
+        batch, self.batch = self.batch, None
+
+        evs = []
+        for lvl, dst in sorted(batch):
+            tobe_synced, gws = batch[lvl, dst]
+            n = self.node_peek(lvl, dst)
+            nev = len(evs)
+            for gw, oldrem in gws.iteritems():
+                r = None
+                if n is not None:
+                    r = n.route_getby_gw(gw)
+                if oldrem is None:
+                    if r is not None:
+                        evs.append(('ROUTE_NEW', (lvl, dst, gw, r.rem)))
+                elif r is None:
+                    evs.append(('ROUTE_DELETED', (lvl, dst, gw)))
+                elif r.rem != oldrem:
+                    evs.append(('ROUTE_REM_CHGED',
+                                (lvl, dst, gw, r.rem, oldrem)))
+            if n is not None:
+                # only the notified changes have to be synced
+                n.routes_tobe_synced = tobe_synced + len(evs) - nev
+
+        for ev, msg in evs:
+            self.events.send(ev, msg)
+        return len(evs)
+
+    def _batch_record(self, lvl, dst, gw, n):
+        """Remembers the state of the route (lvl, dst, gw) before its first
+        change in the current batch. `n' is the node (lvl, dst) or None"""
+        if (lvl, dst) not in self.batch:
+            tobe_synced = 0
+            if n is not None:
+                tobe_synced = n.routes_tobe_synced
+            self.batch[lvl, dst] = [tobe_synced, {}]
+        gws = self.batch[lvl, dst][1]
+        if gw not in gws:
+            gws[gw] = None
+            if n is not None:
+                r = n.route_getby_gw(gw)
+                if r is not None:
+                    gws[gw] = r.rem
+
+    def _route_event(self, event, msg):
+        if self.batch is None:
+            self.events.send(event, msg)
+
     def route_add(self, lvl, dst, gw, rem, silent=0):
         '''Add a new route'''
-        n = self.node_get(lvl, dst)
+        n = self.node_get_or_create(lvl, dst)
+        if self.batch is not None and not silent:
+            self._batch_record(lvl, dst, gw, n)
         ret, val = n.route_add(lvl, dst, gw, rem)
+        if ret:
+            self.dsts[lvl].add(dst)
+            self._best_update(lvl, dst, n)
+        if ret == 1:
+            self.gw_routes.setdefault(gw, set()).add((lvl, dst))
         if not silent:
             if ret == 1:
-                self.events.send('ROUTE_NEW', (lvl, dst, gw, rem))
+                self._route_event('ROUTE_NEW', (lvl, dst, gw, rem))
                 if n.nroutes() == 1:
                     # The node is new
                     self.node_add(lvl, dst)
             elif ret == 2:
                 oldrem = val
-                self.events.send('ROUTE_REM_CHGED', (lvl, dst, gw, rem, oldrem))
+                self._route_event('ROUTE_REM_CHGED',
+                                  (lvl, dst, gw, rem, oldrem))
         return ret
 
     def route_del(self, lvl, dst, gw, silent=0):
-        d = self.node_get(lvl, dst)
-        d.route_del(gw)
+        d = self.node_peek(lvl, dst)
+        if d is None:
+            # We don't have any route to (lvl, dst)
+            return
+
+        if self.batch is not None and not silent:
+            self._batch_record(lvl, dst, gw, d)
+        if d.route_del(gw):
+            self._gw_routes_discard(gw, lvl, dst)
+            self._best_update(lvl, dst, d)
 
         if not silent:
-            self.events.send('ROUTE_DELETED', (lvl, dst, gw))
+            self._route_event('ROUTE_DELETED', (lvl, dst, gw))
 
         if d.is_empty():
             # No more routes to reach the node (lvl, dst).
             # Consider it dead
             self.node_del(lvl, dst)
 
+    def _best_update(self, lvl, dst, n):
+        """Updates self.best after a change of the routes of the node
+        `n' = (lvl, dst)"""
+        br = n.best_route()
+        if br is None:
+            self.best[lvl].pop(dst, None)
+        else:
+            self.best[lvl][dst] = (br.gw, br.rem)
+
+    def _gw_routes_discard(self, gw, lvl, dst):
+        routes = self.gw_routes.get(gw)
+        if routes is not None:
+            routes.discard((lvl, dst))
+            if not routes:
+                del self.gw_routes[gw]
+
+    def node_del(self, lvl, id, silent=0):
+        n = self.node_peek(lvl, id)
+        if n is not None:
+            for r in n.routes:
+                self._gw_routes_discard(r.gw, lvl, id)
+        Map.node_del(self, lvl, id, silent)
+        self.dsts[lvl].discard(id)
+        self.best[lvl].pop(id, None)
+
+    def node_routes_reset(self, lvl, dst):
+        """Silently deletes all the routes to (lvl, dst), without deleting
+        the node itself"""
+        n = self.node_peek(lvl, dst)
+        if n is None:
+            return
+        for r in n.routes:
+            self._gw_routes_discard(r.gw, lvl, dst)
+        n.route_reset()
+        self.dsts[lvl].discard(dst)
+        self.best[lvl].pop(dst, None)
+
+    def level_reset(self, level):
+        Map.level_reset(self, level)
+        self.dsts[level] = set()
+        self.best[level] = {}
+        for gw in self.gw_routes.keys():
+            for lvl, dst in list(self.gw_routes[gw]):
+                if lvl == level:
+                    self._gw_routes_discard(gw, lvl, dst)
+
     def route_rem(self, lvl, dst, gw, newrem, silent=0):
-        """Changes the rem of the route with gateway `gw'
+        """Changes the rem of the route with gateway `gw'.
+        If `newrem' is a DeadRem, the route is deleted.
 
         Returns 0 if the route doesn't exists, 1 else."""
 
-        d = self.node_get(lvl, dst)
+        d = self.node_peek(lvl, dst)
+        if d is None:
+            return 0
+        if isinstance(newrem, DeadRem):
+            if d.route_getby_gw(gw) is None:
+                return 0
+            self.route_del(lvl, dst, gw, silent)
+            return 1
+        if self.batch is not None and not silent:
+            self._batch_record(lvl, dst, gw, d)
         ret, val = d.route_rem(gw, newrem)
         if ret:
             oldrem = val
+            self._best_update(lvl, dst, d)
             if not silent:
-                self.events.send('ROUTE_REM_CHGED',
-                                 (lvl, dst, gw, newrem, oldrem))
+                self._route_event('ROUTE_REM_CHGED',
+                                  (lvl, dst, gw, newrem, oldrem))
             return 1
         else:
             return 0
@@ -420,33 +726,51 @@ class MapRoute(Map):
             return self.route_add(lvl, dst, gw, newrem)
 
 
+    def rem_import(self, rem):
+        """Converts `rem' to the Rem type of the map.
+
+        With metrics > 1, a single rem (f.e. the Rtt of a neighbour) becomes
+        the primary metric of a MultiRem whose other metrics are NullRems,
+        i.e. they don't change the sums.
+        Raises RemError if `rem' can't be converted."""
+
+        if isinstance(rem, MultiRem):
+            if len(rem.rems) != self.metrics:
+                raise RemError('MultiRem with %d metrics in a map with %d' %
+                               (len(rem.rems), self.metrics))
+            return rem
+        if self.metrics == 1 or isinstance(rem, (NullRem, DeadRem)):
+            return rem
+        return MultiRem([rem] + [NullRem()] * (self.metrics - 1))
+
 ## Neighbour stuff
 
     def routeneigh_del(self, neigh):
         """Delete from the MapRoute all the routes passing from the
            gateway `neigh.id' and delete the node `neigh' itself (if present)"""
 
-        for lvl in xrange(self.levels):
-            for dst in xrange(self.gsize):
-                self.route_del(lvl, dst, neigh.id, silent=1)
+        for lvl, dst in list(self.gw_routes.get(neigh.id, ())):
+            self.route_del(lvl, dst, neigh.id, silent=1)
 
     def routeneigh_add(self, neigh, silent=0):
         """Add a route to reach the neighbour `neigh'"""
         lvl, nid = self.routeneigh_get(neigh)
-        return self.route_add(lvl, nid, neigh.id, neigh.rem, silent)
+        return self.route_add(lvl, nid, neigh.id, self.rem_import(neigh.rem),
+                              silent)
 
     def routeneigh_rem(self, neigh, silent=0):
         lvl, nid = self.routeneigh_get(neigh)
-        return self.route_rem(lvl, nid, neigh.id, neigh.rem, silent)
+        return self.route_rem(lvl, nid, neigh.id, self.rem_import(neigh.rem),
+                              silent)
 
 
     def routeneigh_get(self, neigh):
         """Converts a neighbour to a (g)node of the map"""
-        neigh.nip = self.ip_to_nip(neigh.ip)   # TODO: refactoring Neigh
-        lvl = self.nip_cmp(self.me, neigh.nip)
-        return (lvl, neigh.nip[lvl])
+        nip = self.ip_to_nip(neigh.ip)
+        lvl = self.nip_cmp(self.me, nip)
+        return (lvl, nip[lvl])
 
-    def bestroutes_get(self, f=ftrue):
+    def bestroutes_get(self, f=ftrue, metric=0):
         """Returns the list of all the best routes of the map.
 
            Let L be the returned list, then L[lvl] is the list of all the best
@@ -456,11 +780,48 @@ class MapRoute(Map):
 
            If a function `f' has been specified, then each element L[lvl][i]
            in L is such that f(L[lvl][i])==True
+
+           If the map holds MultiRem rems, `metric' is the index of the
+           metric used to choose the best routes.
+
+           Only the destinations in self.dsts are visited.
            """
         return [
                 [ (dst, br.gw, br.rem)
-                        for dst in xrange(self.gsize)
-                            for br in [self.node_get(lvl, dst).best_route()]
+                        for dst in sorted(self.dsts[lvl])
+                            for br in [self.node[lvl][dst].best_route(metric)]
                                 if br is not None and f((dst, br.gw, br.rem))
                 ] for lvl in xrange(self.levels)
                ]
+
+    def bestroutes_export(self, gw):
+        """Returns the best routes not having `gw' as gateway, in the form
+        used by the R set of an ETP: L[lvl] is a list of (dst, rem) pairs.
+
+        It is the same of
+            [ [(dst, rem) for dst, gw, rem in L] for L in
+                    bestroutes_get(lambda (dst, g, rem): g != gw) ]
+        but the routes are read from self.best, without visiting the
+        nodes of the map."""
+
+        return [ [ (dst, rem) for dst, (g, rem) in self.best[lvl].iteritems()
+                                if g != gw ]
+                 for lvl in xrange(self.levels) ]
+
+    def routes_via_gw(self, gw):
+        """Returns the ordered list of the (lvl, dst) pairs of the routes
+        having `gw' as gateway"""
+        return sorted(self.gw_routes.get(gw, ()))
+
+    def bestroutes_via_gw(self, gw):
+        """The same of bestroutes_get(), but only the best routes having `gw'
+        as gateway are returned.
+
+        Only the routes in self.gw_routes[gw] are visited."""
+
+        L = [[] for lvl in xrange(self.levels)]
+        for lvl, dst in self.routes_via_gw(gw):
+            br = self.node[lvl][dst].best_route()
+            if br is not None and br.gw == gw:
+                L[lvl].append((dst, br.gw, br.rem))
+        return L
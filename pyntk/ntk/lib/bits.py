@@ -0,0 +1,32 @@
+##
+# This file is part of Netsukuku
+# (c) Copyright 2009 Andrea Lo Pumo aka AlpT <alpt@freaknet.org>
+#
+# This source code is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation; either version 2 of the License,
+# or (at your option) any later version.
+#
+# This source code is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# Please refer to the GNU Public License for more details.
+#
+# You should have received a copy of the GNU Public License along with
+# this source code; if not, write to:
+# Free Software Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+##
+#
+# Bit manipulation helpers, usable with Python 2.6
+#
+
+def bit_length(n):
+    """Returns the number of bits needed to represent the integer n,
+    without the sign, i.e. int.bit_length() of Python 2.7"""
+    if not n:
+        return 0
+    return len(bin(abs(n))) - 2
+
+def bit_count(n):
+    """Returns the number of bits set in the integer n >= 0"""
+    return bin(n).count('1')
@@ -57,6 +57,11 @@ import rpc
  # something trickier
  n, nn = client, client.nestmod
  result = n.square(n.mul(x, nn.add(x, 10)))
+
+ # one-way call: the reply is not waited, the result is lost.
+ # Use it only with servers known to support one-way calls: an older
+ # server can't parse the request.
+ client.oneway.nestmod.add(x, 9)
 """
 
 ## TODO
@@ -200,48 +205,69 @@ class RPCDispatcher(object):
             logging.debug("dispatch response: "+str(response))
         return response
 
-    def marshalled_dispatch(self, caller, data):
-        '''Dispatches a RPC function from marshalled data'''
+    def marshalled_dispatch(self, caller, data, oneway=False):
+        '''Dispatches a RPC function from marshalled data
+
+        The data is a (func_name, params) pair. If `oneway' is true, the
+        caller doesn't wait for a reply and None is returned, even if the
+        data is malformed.'''
         error=0
         try:
                 unpacked = rencode.loads(data)
-        except ValueError:
+        except (ValueError, IndexError, KeyError, TypeError):
+                # rencode raises any of these on a corrupted packet
                 error=1
-        if error or not isinstance(unpacked, tuple) or not len(unpacked) == 2:
+        if error or not isinstance(unpacked, tuple) or len(unpacked) != 2:
             e = 'Malformed packet received from '+caller.ip
             logging.debug(e)
             response = ('rmt_error', str(e))
         else:
             response = self.dispatch(caller, *unpacked)
 
+        if oneway:
+            return None
         return rencode.dumps(response)
 
 ### Code taken from examples/networking/rpc.py of stackless python
 #
 #
 _data_hdr_sz = struct.calcsize("I")
-def _data_pack(data):
-    return struct.pack("I", len(data)) + data
+def _data_pack(data, oneway=False):
+    hdr = len(data)
+    if oneway:
+        hdr |= _ONEWAY_FLAG
+    return struct.pack("I", hdr) + data
 
 def _data_unpack_from_stream_socket(socket):
+    return _frame_unpack_from_stream_socket(socket)[0]
+
+def _frame_unpack_from_stream_socket(socket):
+    '''Returns the (data, oneway) pair of the next frame. `data' is "" if
+    the connection has been closed'''
     readBuffer = ""
     while True:
         rawPacket = socket.recv(_data_hdr_sz-len(readBuffer))
         if not rawPacket:
-            return ""
+            return "", False
         readBuffer += rawPacket
         if len(readBuffer) == _data_hdr_sz:
-            dataLength = struct.unpack("I", readBuffer)[0]
+            hdr = struct.unpack("I", readBuffer)[0]
+            dataLength = hdr & ~_ONEWAY_FLAG
             readBuffer = ""
             while len(readBuffer) != dataLength:
                 rawPacket = socket.recv(dataLength - len(readBuffer))
                 if not rawPacket:
-                    return ""
+                    return "", False
                 readBuffer += rawPacket
-            return readBuffer
+            return readBuffer, bool(hdr & _ONEWAY_FLAG)
 #
 ###
 
+# The highest bit of the length of a stream frame marks a one-way request,
+# whose reply must not be sent. It is set only for the servers known to
+# support it: an older server would read it as a huge length.
+_ONEWAY_FLAG = 1 << 31
+
 def _data_unpack_from_buffer(buffer):
     readBuffer = ""
     buflen = len(buffer)
@@ -258,15 +284,19 @@ def stream_request_handler(sock, clientaddr, dev, rpcdispatcher):
     logging.debug('Connected from %s, dev %s', clientaddr, dev)
     caller = CallerInfo(clientaddr[0], clientaddr[1], dev, sock)
     while True:
+        response = None
         try:
-            data = _data_unpack_from_stream_socket(sock)
+            data, oneway = _frame_unpack_from_stream_socket(sock)
             if not data: break
             logging.debug('Handling data: %s', data)
-            response = rpcdispatcher.marshalled_dispatch(caller, data)
+            response = rpcdispatcher.marshalled_dispatch(caller, data, oneway)
             logging.debug('Response: %s', response)
         except RPCError:
             logging.debug('An error occurred during request handling')
 
+        if response is None:
+            # one-way call
+            continue
         sock.send(_data_pack(response))
         #self.request.close()
         logging.debug('Response sent')
@@ -344,6 +374,32 @@ class TCPClient(FakeRmt):
 
         return recv_data
 
+    def rpc_call_oneway(self, func_name, params):
+        '''Performs a one-way rpc call: the request is sent, but the reply
+        isn't waited (the remote side doesn't send it).
+        The remote side must support one-way calls.
+
+        @param func_name: name of the remote callable
+        @param params: a tuple of arguments to pass to the remote callable
+        '''
+
+        while not self.connected:
+            self.connect()
+            self.xtime.swait(500)
+
+        data = rencode.dumps((func_name, params))
+        self.socket.sendall(_data_pack(data, oneway=True))
+
+    def _get_oneway(self):
+        '''A FakeRmt performing one-way calls, i.e.
+           client.oneway.mod.func(params) is the one-way version of
+           client.mod.func(params)'''
+        fr = FakeRmt()
+        fr.rmt = self.rmt_oneway
+        return fr
+
+    oneway = property(_get_oneway)
+
     def connect(self):
         socket = self.sockfactory(net=self.net, me=self.me)
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -361,6 +417,9 @@ class TCPClient(FakeRmt):
     def rmt(self, func_name, *params):
         return self.rpc_call(func_name, params)
 
+    def rmt_oneway(self, func_name, *params):
+        return self.rpc_call_oneway(func_name, params)
+
     def __del__(self):
         if self.connected:
             self.close()
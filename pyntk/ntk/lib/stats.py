@@ -0,0 +1,139 @@
+##
+# This file is part of Netsukuku
+# (c) Copyright 2009 Andrea Lo Pumo aka AlpT <alpt@freaknet.org>
+#
+# This source code is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation; either version 2 of the License,
+# or (at your option) any later version.
+#
+# This source code is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# Please refer to the GNU Public License for more details.
+#
+# You should have received a copy of the GNU Public License along with
+# this source code; if not, write to:
+# Free Software Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+##
+#
+# Counters and histograms used to instrument the daemon
+#
+"""
+# Usage example
+
+ class M:
+     def __init__(self):
+         self.stats = Stats(['pkt_received'], ['pkt_exec'])
+
+     @timed('pkt_exec')    # the execution time is added to 'pkt_exec'
+     def pkt_exec(self, pkt):
+         self.stats.incr('pkt_received')
+         ...
+
+ m.stats.values()  # {'pkt_received': 1, 'pkt_exec': {...}}
+ m.stats.dump('/tmp/m.stats')
+"""
+
+import functools
+import time
+
+from ntk.lib.bits import bit_length
+
+class StatsError(Exception):pass
+
+class Histogram(object):
+    """Histogram with logarithmic buckets.
+
+    The i-th bucket counts the values v such that 2^(i-1) <= v < 2^i, the
+    0-th bucket counts the zeros. The last bucket counts also all the values
+    greater than its upper bound."""
+
+    __slots__ = ['count', 'total', 'max', 'buckets']
+
+    def __init__(self, nbuckets=25):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.buckets = [0] * nbuckets
+
+    def add(self, value):
+        value = int(value)
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        self.buckets[min(bit_length(value), len(self.buckets)-1)] += 1
+
+    def values(self):
+        return dict(count=self.count, total=self.total, max=self.max,
+                    buckets=self.buckets[:])
+
+class Stats(object):
+    """A set of named counters and histograms"""
+
+    def __init__(self, counters=[], histograms=[]):
+        self.counters = dict.fromkeys(counters, 0)
+        self.histograms = dict([(h, Histogram()) for h in histograms])
+
+    def incr(self, counter, n=1):
+        if counter not in self.counters:
+            raise StatsError('"' + counter + '" is not a registered counter')
+        self.counters[counter] += n
+
+    def add(self, histogram, value):
+        if histogram not in self.histograms:
+            raise StatsError('"' + histogram +
+                             '" is not a registered histogram')
+        self.histograms[histogram].add(value)
+
+    def time_add(self, histogram, start):
+        """Adds to `histogram' the microseconds elapsed since `start',
+        a time.time() value"""
+        self.add(histogram, (time.time() - start) * 1000000)
+
+    def values(self):
+        """Returns a {name: value} dict of all the counters and histograms.
+        The value of an histogram is the dict returned by Histogram.values"""
+        v = dict(self.counters)
+        for h in self.histograms:
+            v[h] = self.histograms[h].values()
+        return v
+
+    def dump(self, filename):
+        """Writes the counters and histograms to `filename', one per line"""
+        f = open(filename, 'w')
+        try:
+            for c in sorted(self.counters):
+                f.write('%s %d\n' % (c, self.counters[c]))
+            for h in sorted(self.histograms):
+                hist = self.histograms[h]
+                f.write('%s count=%d total=%d max=%d buckets=%s\n' %
+                        (h, hist.count, hist.total, hist.max,
+                         ','.join(map(str, hist.buckets))))
+        finally:
+            f.close()
+
+    def reset(self):
+        for c in self.counters:
+            self.counters[c] = 0
+        for h in self.histograms:
+            self.histograms[h] = Histogram()
+
+def timed(histogram):
+    '''Decorator of the methods of a class having a `stats' attribute:
+    the execution time of each call, in microseconds, is added to
+    self.stats' histogram `histogram'.'''
+
+    def decorate(func):
+
+        @functools.wraps(func)
+        def ftimed(self, *args, **kwargs):
+            start = time.time()
+            try:
+                return func(self, *args, **kwargs)
+            finally:
+                self.stats.time_add(histogram, start)
+
+        return ftimed
+
+    return decorate
@@ -25,8 +25,11 @@
 
 
 import socket
+import struct
 import sys
 
+from itertools import count
+
 from ntk.config import settings
 
 
@@ -56,13 +59,23 @@ def lvl_to_bits(lvl):
     ''' Returns bits corresponding to `lvl' '''
     return ipbit[settings.IP_VERSION] - lvl*settings.BITS_PER_LEVEL
 
+_u32 = struct.Struct('!I')
+_u64x2 = struct.Struct('!QQ')
+_mask64 = 2**64 - 1
+
 def pip_to_ip(pip):
+    if len(pip) == 4:
+        return _u32.unpack(pip)[0]
+    elif len(pip) == 16:
+        hi, lo = _u64x2.unpack(pip)
+        return (hi << 64) | lo
     ps = pip[::-1]
-    return sum(ord(ps[i]) * 256**i for i in xrange(len(ps)))
+    return sum(ord(ps[i]) << 8*i for i in xrange(len(ps)))
 
 def ip_to_pip(ip):
-    ver = settings.IP_VERSION
-    return ''.join([chr( (ip % 256**(i+1))/256**i ) for i in reversed(xrange(ipbit[ver]/8))])
+    if settings.IP_VERSION == ipv4:
+        return _u32.pack(ip)
+    return _u64x2.pack(ip >> 64, ip & _mask64)
 
 def pip_to_str(pip):
     return socket.inet_ntop(ipfamily[settings.IP_VERSION], pip)
@@ -70,8 +83,30 @@ def pip_to_str(pip):
 def str_to_pip(ipstr):
     return socket.inet_pton(ipfamily[settings.IP_VERSION], ipstr)
 
+# Cache of the last converted ips, used by ip_to_str()
+IP_STR_CACHE_SIZE = 256
+_ip_str_cache = {}          # {(ip version, ip): [ipstr, time of last use]}
+_ip_str_clock = count()
+
+def _ip_str_cache_shrink():
+    """Forgets the least recently used half of the ip_to_str() cache"""
+    keys = sorted(_ip_str_cache, key=lambda k: _ip_str_cache[k][1])
+    for key in keys[:len(keys)/2]:
+        del _ip_str_cache[key]
+
 def ip_to_str(ip):
-    return pip_to_str(ip_to_pip(ip))
+    key = (settings.IP_VERSION, ip)
+    entry = _ip_str_cache.get(key)
+    if entry is None:
+        if len(_ip_str_cache) >= IP_STR_CACHE_SIZE:
+            _ip_str_cache_shrink()
+        entry = _ip_str_cache[key] = [pip_to_str(ip_to_pip(ip)), 0]
+    entry[1] = next(_ip_str_clock)
+    return entry[0]
+
+def ips_to_str(ips):
+    """Converts a list of ips to a list of strings"""
+    return map(ip_to_str, ips)
 
 def str_to_ip(ipstr):
     return pip_to_ip(str_to_pip(ipstr))
@@ -69,7 +69,8 @@ class NtkNode(object):
                                          sockmodgen=self.simsock)
         self.radar = radar.Radar(rpcbcastclient, xtimemod)
         self.neighbour = self.radar.neigh
-        self.maproute = maproute.MapRoute(settings.LEVELS, self.gsize, None)
+        self.maproute = maproute.MapRoute(settings.LEVELS, self.gsize, None,
+                                          settings.METRICS)
         self.etp = qspn.Etp(self.radar, self.maproute)
 
         self.p2p = p2p.P2PAll(self.radar, self.maproute)
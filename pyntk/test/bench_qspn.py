@@ -0,0 +1,110 @@
+##
+# This file is part of Netsukuku
+# (c) Copyright 2009 Andrea Lo Pumo aka AlpT <alpt@freaknet.org>
+#
+# This source code is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation; either version 2 of the License,
+# or (at your option) any later version.
+#
+# This source code is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# Please refer to the GNU Public License for more details.
+#
+# You should have received a copy of the GNU Public License along with
+# this source code; if not, write to:
+# Free Software Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+##
+#
+# Micro-benchmark of ntk.core.qspn.Etp.etp_exec
+#
+# Usage: python bench_qspn.py [-r rounds] [-s seed] [-o file] [file]
+#
+# The ETPs are loaded from `file' if given (a pickled list of
+# (sender_nip, R, TPL, flag_of_interest) tuples, as recorded with -o),
+# otherwise they are randomly generated with a size similar to the ETPs
+# exchanged in a network of a few thousands of nodes.
+#
+
+import sys
+sys.path.append('..')
+
+import cPickle
+import gc
+import getopt
+import random
+import time
+from copy import deepcopy
+
+from ntk.core.qspn import TPBlock
+from ntk.core.route import NullRem, Rtt
+from ntk.lib.micro import allmicro_run
+
+from test_qspn import etp_setup
+
+LEVELS = 4
+GSIZE  = 256
+ME     = [1, 1, 1, 1]
+NEIGHS = [[2, 1, 1, 1], [3, 1, 1, 1], [4, 1, 1, 1], [1, 2, 1, 1]]
+
+def etp_random(rnd, sender_nip):
+    '''Returns a random ETP sent by `sender_nip'.'''
+
+    routes = [rnd.randint(32, 200), rnd.randint(4, 40), rnd.randint(1, 8), 1]
+    R = [ [ (dst, Rtt(rnd.randint(1, 2000)))
+            for dst in rnd.sample(xrange(GSIZE), routes[lvl]) ]
+          for lvl in xrange(LEVELS) ]
+
+    TPL = []
+    for lvl in reversed(xrange(rnd.randint(1, LEVELS))):
+        nhops = rnd.randint(1, 12)
+        TPL.append(TPBlock(lvl,
+                           [rnd.randrange(GSIZE) for i in xrange(nhops)],
+                           [Rtt(rnd.randint(1, 500)) for i in xrange(nhops)]))
+    TPL[-1].append(sender_nip[0], NullRem())
+    return (sender_nip, R, TPL, 1)
+
+def etps_random(n, seed):
+    rnd = random.Random(seed)
+    return [etp_random(rnd, rnd.choice(NEIGHS)) for i in xrange(n)]
+
+def bench(etps, rounds):
+    best = None
+    for i in xrange(rounds):
+        etp, neighs = etp_setup(LEVELS, GSIZE, ME, NEIGHS)
+        todo = deepcopy(etps)
+
+        gc.collect()
+        start = time.time()
+        for args in todo:
+            etp._etp_exec(*args)
+        allmicro_run() # deliver the forwarded ETPs
+        elapsed = time.time() - start
+
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def main():
+    opts, args = getopt.getopt(sys.argv[1:], 'r:s:o:n:')
+    opts = dict(opts)
+    rounds = int(opts.get('-r', 5))
+    seed = int(opts.get('-s', 1))
+    n = int(opts.get('-n', 500))
+
+    if args:
+        etps = cPickle.load(open(args[0], 'rb'))
+    else:
+        etps = etps_random(n, seed)
+
+    if '-o' in opts:
+        cPickle.dump(etps, open(opts['-o'], 'wb'), 2)
+
+    best = bench(etps, rounds)
+    nroutes = sum(len(Rl) for sender, R, TPL, f in etps for Rl in R)
+    print '%d ETPs, %d routes: best of %d rounds %.3fs, %.1f us/ETP' % (
+            len(etps), nroutes, rounds, best, best * 1e6 / len(etps))
+
+if __name__ == '__main__':
+    main()
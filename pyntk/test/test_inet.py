@@ -63,6 +63,30 @@ class TestInet(unittest.TestCase):
         ip = inet.pip_to_ip(inet.str_to_pip(self.ps))
         self.assertEqual(inet.ip_to_str(ip), self.ps)
 
+    def testPip6ToIP(self):
+        ''' Test conversion of an IPv6 pip --> ip '''
+        pip = '\x80' + '\x00'*13 + '\xff\x01'
+        self.assertEqual(inet.pip_to_ip(pip), 2**127 + 0xff01)
+
+    def testIPsToStr(self):
+        ''' Test conversion of a list of ips --> str, twice (cached) '''
+        ips = [16909060, 84281096]
+        for i in xrange(2):
+            self.assertEqual(inet.ips_to_str(ips), [self.ps, '5.6.7.8'])
+
+    def testIPToStrCache(self):
+        ''' The ip --> str cache keeps the most recently used ips '''
+        size = inet.IP_STR_CACHE_SIZE
+        inet.ip_to_str(16909060)
+        for ip in xrange(size + 1):
+            inet.ip_to_str(ip)
+            inet.ip_to_str(16909060)
+        self.failUnless(len(inet._ip_str_cache) <= size)
+        self.failUnless((settings.IP_VERSION, 16909060) in inet._ip_str_cache)
+        self.failUnless((settings.IP_VERSION, size) in inet._ip_str_cache)
+        self.failIf((settings.IP_VERSION, 0) in inet._ip_str_cache)
+        self.assertEqual(inet.ip_to_str(16909060), self.ps)
+
     def testStrToIP(self):
         ''' Test conversion str --> ip '''
         self.assertEqual(inet.str_to_ip(self.ps), 16909060)
@@ -68,6 +68,30 @@ class TestMap(unittest.TestCase):
         '''Free nodes of specified level'''
         self.assertEqual(self.map.free_nodes_list(lvl=0), range(self.gsize))
 
+    def test_free_nodes_bitmap(self):
+        '''Free nodes are tracked by node_add, node_del and level_reset'''
+        self.map.node_add(lvl=1, id=3)
+        self.map.node_add(lvl=1, id=3)
+        self.map.node_add(lvl=1, id=255)
+        self.assertEqual(self.map.free_nodes_nb(lvl=1), self.gsize - 2)
+        self.assertEqual(self.map.free_nodes_list(lvl=1),
+                         [i for i in range(self.gsize) if i not in (3, 255)])
+
+        self.map.node_del(lvl=1, id=3)
+        self.map.node_del(lvl=1, id=3)
+        self.assertEqual(self.map.free_nodes_nb(lvl=1), self.gsize - 1)
+        self.assertEqual(self.map.free_nodes_list(lvl=1), range(self.gsize-1))
+
+        self.map.level_reset(1)
+        self.assertEqual(self.map.free_nodes_list(lvl=1), range(self.gsize))
+
+    def test_free_level_highest(self):
+        '''Highest level with free nodes'''
+        self.assertEqual(self.map.free_level_highest(), self.levels - 1)
+        for id in xrange(self.gsize):
+            self.map.node_add(lvl=self.levels - 1, id=id, silent=1)
+        self.assertEqual(self.map.free_level_highest(), self.levels - 2)
+
     def test_is_in_level(self):
         '''Node nip belongs to our gnode of level'''
         self.assertEqual(self.map.is_in_level(self.map.me, 0), True)
@@ -80,9 +104,127 @@ class TestMap(unittest.TestCase):
         '''Conversion IP -> NIP (Netsukuku IP)'''
         self.assertEqual(self.map.nip_to_ip([127, 0, 0, 0]), 127)
 
+    def test_ip_nip_conversion(self):
+        '''Conversion IP <-> NIP, with 4 and 16 levels'''
+        ip = 0x01020304
+        self.assertEqual(self.map.ip_to_nip(ip), [4, 3, 2, 1])
+        self.assertEqual(self.map.nips_to_ips(self.map.ips_to_nips([ip, 7])),
+                         [ip, 7])
+
+        map6 = Map(16, self.gsize, self.dataclass)
+        ip6 = 2**127 + 0xff01
+        nip6 = map6.ip_to_nip(ip6)
+        self.assertEqual(nip6, [1, 255] + [0]*13 + [128])
+        self.assertEqual(map6.nip_to_ip(nip6), ip6)
+
+        map10 = Map(3, 10, self.dataclass)
+        self.assertEqual(map10.ip_to_nip(123), [3, 2, 1])
+        self.assertEqual(map10.nip_to_ip([3, 2, 1]), 123)
+
     def test_nip_cmp(self):
         '''Comparing two NIP'''
         self.assertEqual(self.map.nip_cmp([127, 0, 0, 1], [127, 0, 0, 0]), 3)
 
+    def test_map_delta(self):
+        '''Delta export and apply'''
+        class Node(DataClass):
+            def is_free(self):
+                return False
+
+        src = Map(self.levels, self.gsize, Node, me=[1, 6, 3, 4],
+                  changelog=True)
+        dst = Map(self.levels, self.gsize, Node, me=[5, 2, 3, 4])
+
+        src.node_add(lvl=1, id=7)
+        src.node_add(lvl=2, id=9)
+        src.node_add(lvl=0, id=3)
+        ver = dst.map_delta_apply(src.map_delta_since())
+        self.assertEqual(dst.free_nodes_nb(1), self.gsize - 1)
+        self.assertEqual(dst.free_nodes_nb(2), self.gsize - 1)
+        # the level 0 isn't shared
+        self.assertEqual(dst.node_peek(0, 3), None)
+
+        src.node_del(lvl=1, id=7)
+        src.node_add(lvl=3, id=1)
+        src.node_add(lvl=3, id=2)
+        nip, srcver, resets, changes, nblist = src.map_delta_since(ver)
+        self.assertEqual(resets, [])
+        self.assertEqual([(l, id) for l, id, n in changes],
+                         [(1, 7), (3, 1), (3, 2)])
+
+        ver = dst.map_delta_apply(src.map_delta_since(ver))
+        self.assertEqual(ver, (src.epoch, src.version))
+        self.assertEqual(dst.node_peek(1, 7), None)
+        self.assertEqual(dst.free_nodes_list(3), [0] + range(3, self.gsize))
+
+        # a reset level is sent entirely
+        src.level_reset(2)
+        nip, srcver, resets, changes, nblist = src.map_delta_since(ver)
+        self.assertEqual(resets, [2])
+        ver = dst.map_delta_apply((nip, srcver, resets, changes, nblist))
+        self.assertEqual(dst.free_nodes_nb(2), self.gsize)
+
+        # the source has been restarted: its versions are of another epoch
+        src = Map(self.levels, self.gsize, Node, me=[1, 6, 3, 4],
+                  changelog=True)
+        for id in xrange(src.version, ver[1] + 2):
+            src.node_add(lvl=3, id=id)
+        nip, srcver, resets, changes, nblist = src.map_delta_since(ver)
+        self.assertEqual(resets, range(self.levels))
+
+        # without a change log, the whole map is always sent
+        self.assertEqual(dst.version, 0)
+        self.assertEqual(dst.log, [])
+        resets = dst.map_delta_since((dst.epoch, 1))[2]
+        self.assertEqual(resets, range(self.levels))
+
+class TestSparseMap(TestMap):
+
+    def setUp(self):
+        self.levels = 4
+        self.gsize  = 256
+        self.dataclass = DataClass
+
+        self.map = Map(self.levels, self.gsize, self.dataclass, sparse=True)
+
+    def test_node_peek(self):
+        '''Peeking an absent node doesn't allocate it'''
+        self.assertEqual(self.map.node_peek(1, 3), None)
+        self.assertEqual(len(self.map.node[1]), 0)
+        self.map.node_add(lvl=1, id=3)
+        self.failUnless(isinstance(self.map.node_peek(1, 3), DataClass))
+
+    def test_free_nodes_list_no_alloc(self):
+        '''Free nodes list doesn't allocate absent nodes'''
+        self.map.free_nodes_list(lvl=0)
+        self.assertEqual(len(self.map.node[0]), 0)
+
+    def test_map_data_merge(self):
+        '''Pack and merge a sparse map'''
+        self.map.node_add(lvl=3, id=7)
+        other = Map(self.levels, self.gsize, self.dataclass, me=self.map.me,
+                    sparse=True)
+        other.map_data_merge(self.map.map_data_pack())
+        self.failUnless(isinstance(other.node_peek(3, 7), DataClass))
+        self.assertEqual(len(other.node[3]), 1)
+        # the node count agrees with the free nodes list: DataClass nodes
+        # are free
+        self.assertEqual(other.node_nb[3], 0)
+        self.assertEqual(other.free_nodes_nb(3), len(other.free_nodes_list(3)))
+
+        class Node(DataClass):
+            def is_free(self):
+                return False
+
+        src = Map(self.levels, self.gsize, Node, sparse=True)
+        src.node_add(lvl=3, id=7)
+        other = Map(self.levels, self.gsize, Node, me=src.me, sparse=True)
+        me, plist, nblist = src.map_data_pack()
+        other.map_data_merge((me, plist, [5] * self.levels))
+        self.assertEqual(other.node_nb[3], 1)
+        for l in xrange(self.levels):
+            self.assertEqual(other.free_nodes_nb(l),
+                             len(other.free_nodes_list(l)))
+
 if __name__ == '__main__':
     unittest.main()
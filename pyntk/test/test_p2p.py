@@ -138,9 +138,10 @@ class TestP2P(unittest.TestCase):
 
         self.p2p.participate()
 
-        for l in range(self.p2p.mapp2p.levels):
-            self.failUnlessEqual(self.p2p.mapp2p.free_nodes_nb(l),
-                                 self.p2p.mapp2p.gsize)
+        mp = self.p2p.mapp2p
+        for l in range(mp.levels):
+            self.failUnlessEqual(mp.free_nodes_nb(l), mp.gsize - 1)
+            self.failIf(mp.me[l] in mp.free_nodes_list(l))
 
     def testNeighGet(self):
         '''Getting the neighbour reach the hash node'''
@@ -192,6 +193,14 @@ class TestP2PAll(unittest.TestCase):
         self.assertFalse(1234 in self.p2pall.service)
         self.failUnlessEqual(self.p2pall.service, {})
 
+    def testNeighDeleted(self):
+        '''The versions of the maps of a dead neighbour are forgotten'''
+        self.p2pall.peer_versions[5] = ([8, 19, 82, 84], 1, {1234: (7, 3)})
+        self.p2pall.peer_versions[6] = ([8, 19, 82, 84], 1, {1234: (8, 2)})
+        nr = Neigh(bestdev=None, devs=None, idn=1, ip=5, netid=1)
+        self.p2pall.neigh.events.send('NEIGH_DELETED', (nr,))
+        self.failUnlessEqual(self.p2pall.peer_versions.keys(), [6])
+
     #def testPidGetAll(self):
         #'''Get all P2P id'''
         #self.failUnlessEqual(self.p2pall.pid_getall(), [])
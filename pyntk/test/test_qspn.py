@@ -0,0 +1,610 @@
+##
+# This file is part of Netsukuku
+# (c) Copyright 2009 Andrea Lo Pumo aka AlpT <alpt@freaknet.org>
+#
+# This source code is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation; either version 2 of the License,
+# or (at your option) any later version.
+#
+# This source code is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# Please refer to the GNU Public License for more details.
+#
+# You should have received a copy of the GNU Public License along with
+# this source code; if not, write to:
+# Free Software Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+##
+#
+# Tests for ntk.core.qspn
+#
+
+
+import sys
+import unittest
+sys.path.append('..')
+
+from copy import deepcopy
+from math import log
+
+import ntk.lib.rencode as rencode
+from ntk.core.qspn import (Etp, EtpCache, FlapDamping, TPBlock, tpl_compact,
+                           tpl_from_legacy, etp_pack, etp_unpack,
+                           EtpCodecError,
+                           ETP_CODEC_VERSION)
+from ntk.core.radar import Neigh
+from ntk.core.route import NullRem, DeadRem, Rtt, Bw, Avg, MultiRem, MapRoute
+from ntk.lib.event import Event
+from ntk.lib.micro import allmicro_run
+from ntk.lib.rpc import RPCError
+
+class FakeEtpStub(object):
+    '''Records the ETPs sent to a neighbour'''
+
+    def __init__(self):
+        self.received = []
+        self.broken = False
+        self.codec = True # False for a neighbour not knowing the ETP codec
+        self.packed = 0
+        self.oneway = 0   # number of one-way calls received
+
+    def etp_exec(self, sender_nip, R, TPL, flag_of_interest):
+        if self.broken:
+            raise IOError('Connection closed')
+        self.received.append((sender_nip, R, TPL, flag_of_interest))
+
+    def etp_exec_packed(self, sender_nip, data):
+        self.packed += 1
+        self.etp_exec(sender_nip, *etp_unpack(data))
+
+    def etp_codec_versions(self):
+        if not self.codec:
+            raise RPCError('Function etp.etp_codec_versions is not remotable')
+        return (ETP_CODEC_VERSION,)
+
+class FakeOnewayEtpStub(object):
+    '''Counts the one-way calls to a FakeEtpStub'''
+
+    def __init__(self, stub):
+        self.stub = stub
+
+    def etp_exec(self, *args):
+        self.stub.oneway += 1
+        self.stub.etp_exec(*args)
+
+    def etp_exec_packed(self, *args):
+        self.stub.oneway += 1
+        self.stub.etp_exec_packed(*args)
+
+class FakeNtkd(object):
+
+    def __init__(self):
+        self.etp = FakeEtpStub()
+        self.oneway = FakeOnewayNtkd(self.etp)
+
+class FakeOnewayNtkd(object):
+
+    def __init__(self, stub):
+        self.etp = FakeOnewayEtpStub(stub)
+
+class FakeNeighbour(object):
+    '''A minimal ntk.core.radar.Neighbour'''
+
+    def __init__(self, neighs=[]):
+        self.events = Event(['NEIGH_NEW', 'NEIGH_DELETED', 'NEIGH_REM_CHGED'])
+        self.neighs = neighs
+
+    def neigh_list(self):
+        return self.neighs
+
+    def ip_to_neigh(self, ip):
+        for nr in self.neighs:
+            if nr.ip == ip:
+                return nr
+        return None
+
+    def id_to_neigh(self, id):
+        for nr in self.neighs:
+            if nr.id == id:
+                return nr
+        return None
+
+class FakeXtime(object):
+    '''A ntk.wrap.xtime module whose time is set by hand'''
+
+    def __init__(self):
+        self.now = 0
+
+    def time(self):
+        return self.now
+
+    def swait(self, t):
+        self.now += t
+
+class FakeRadar(object):
+
+    def __init__(self, neigh):
+        self.neigh = neigh
+        self.netid = -1
+        self.xtime = FakeXtime()
+
+def etp_setup(levels, gsize, me, neighs_nip, rtt=100, metrics=1):
+    '''Returns an Etp instance of the node `me', whose neighbours are
+    `neighs_nip'. Each neighbour has a FakeNtkd.'''
+
+    maproute = MapRoute(levels, gsize, me, metrics)
+    neighs = []
+    for i, nip in enumerate(neighs_nip):
+        nr = Neigh(bestdev=('eth0', rtt), devs={'eth0': rtt}, idn=i+1,
+                   ip=maproute.nip_to_ip(nip), netid=1, ntkd=FakeNtkd())
+        nr.nip = nip
+        maproute.routeneigh_add(nr)
+        neighs.append(nr)
+    etp = Etp(FakeRadar(FakeNeighbour(neighs)), maproute)
+    etp.merge_window = 0 # send the ETPs immediately
+    return etp, neighs
+
+def tpb(lvl, *hops):
+    """Returns a TPBlock of level `lvl' with the (hop, rem) pairs `hops'"""
+    return TPBlock(lvl, [hop for hop, rem in hops], [rem for hop, rem in hops])
+
+class TestTPBlock(unittest.TestCase):
+
+    def testBlock(self):
+        block = tpb(0, (4, Rtt(1)), (200, Rtt(2)))
+        self.failUnlessEqual(block.items(), [(4, Rtt(1)), (200, Rtt(2))])
+        self.failUnlessEqual(len(block), 2)
+        self.failUnlessEqual(block.rem, Rtt(3))
+        self.failUnless(4 in block and 200 in block)
+        self.failIf(5 in block or 0 in block)
+
+        block.append(5, Rtt(3))
+        self.failUnless(5 in block)
+        self.failUnlessEqual(block.rem, Rtt(6))
+        block.rem_set(0, NullRem())
+        self.failUnlessEqual(block.rem, Rtt(5))
+
+        block.collapse(2, 7)
+        self.failUnlessEqual(block, tpb(2, (7, Rtt(5))))
+        self.failIf(4 in block)
+
+    def testPack(self):
+        block = tpb(1, (4, Rtt(1)), (200, NullRem()))
+        lvl, hops, rems = block._pack()[1:]
+        self.failUnlessEqual(hops, '\x04\xc8')
+        self.failUnlessEqual(TPBlock(lvl, hops, rems), block)
+        self.failUnlessEqual(TPBlock(lvl, hops, rems).rem, Rtt(1))
+
+class TestTplCompact(unittest.TestCase):
+
+    def testCollapse(self):
+        TPL = [tpb(1, (4, Rtt(1))), tpb(1, (5, Rtt(2))), tpb(0, (6, Rtt(3)))]
+        self.failUnlessEqual(tpl_compact(TPL),
+                             [tpb(1, (4, Rtt(1)), (5, Rtt(2))),
+                              tpb(0, (6, Rtt(3)))])
+        self.failUnless(5 in TPL[0])
+
+    def testDups(self):
+        TPL = [tpb(0, (4, Rtt(1)), (4, Rtt(2)), (5, Rtt(3)), (4, Rtt(4)))]
+        tpl_compact(TPL)
+        self.failUnlessEqual(TPL, [tpb(0, (4, Rtt(3)), (5, Rtt(3)),
+                                          (4, Rtt(4)))])
+        self.failUnlessEqual(TPL[0].rem, Rtt(10))
+
+        TPL = [tpb(1, (4, Rtt(1))), tpb(1, (4, Rtt(2)))]
+        tpl_compact(TPL)
+        self.failUnlessEqual(TPL, [tpb(1, (4, Rtt(3)))])
+
+class TestEtpExec(unittest.TestCase):
+
+    def setUp(self):
+        # we are [1,1,1,1], our neighbours are [2,1,1,1] and [3,1,1,1]
+        self.etp, self.neighs = etp_setup(4, 16, [1, 1, 1, 1],
+                                          [[2, 1, 1, 1], [3, 1, 1, 1]])
+        self.maproute = self.etp.maproute
+
+    def etp_exec(self, *etp):
+        self.etp._etp_exec(*etp)
+        # wait the delivery of the forwarded ETPs
+        allmicro_run()
+
+    def testExec(self):
+        gw, other = self.neighs
+        R = [[(7, Rtt(10))], [(9, Rtt(20))], [], []]
+        TPL = [tpb(0, (gw.nip[0], NullRem()))]
+        self.etp_exec(gw.nip, R, TPL, 1)
+
+        self.failUnlessEqual(self.maproute.node_get(0, 7).best_route().gw,
+                             gw.id)
+        self.failUnlessEqual(self.maproute.node_get(1, 9).best_route().rem,
+                             Rtt(120))
+
+        # the ETP is forwarded to the other neighbour only
+        self.failIf(gw.ntkd.etp.received)
+        sender, R2, TPL2, foi = other.ntkd.etp.received[0]
+        self.failUnlessEqual(sender, [1, 1, 1, 1])
+        self.failUnlessEqual(R2, R)
+        self.failUnlessEqual(TPL2, [tpb(0, (2, NullRem()), (1, gw.rem))])
+
+        stats = self.etp.stats_get()
+        self.failUnlessEqual(stats['etp_received'], 1)
+        self.failUnlessEqual(stats['etp_forwarded'], 1)
+        self.failUnlessEqual(stats['etp_sent'], 1)
+        self.failUnlessEqual(stats['routes_changed'], 2)
+        self.failUnlessEqual(stats['etp_exec']['count'], 1)
+
+    def testDeadRoute(self):
+        gw, other = self.neighs
+        TPL = lambda: [tpb(0, (gw.nip[0], NullRem()))]
+        self.etp_exec(gw.nip, [[(7, Rtt(10))], [], [], []], TPL(), 1)
+        self.failUnlessEqual(self.maproute.node_get(0, 7).best_route().gw,
+                             gw.id)
+
+        # the route to 7 through gw is dead
+        self.etp_exec(gw.nip, [[(7, DeadRem())], [], [], []], TPL(), 1)
+        self.failUnlessEqual(self.maproute.node_peek(0, 7), None)
+        self.failIf((0, 7) in self.maproute.gw_routes.get(gw.id, ()))
+        # the node still executes the following ETPs
+        self.etp_exec(gw.nip, [[(8, Rtt(10))], [], [], []], TPL(), 1)
+        self.failUnlessEqual(self.maproute.node_get(0, 8).best_route().gw,
+                             gw.id)
+
+    def testRemType(self):
+        gw, other = self.neighs
+        TPL = lambda: [tpb(0, (gw.nip[0], NullRem()))]
+        # we use only one metric: the MultiRem rems are rejected
+        R = [[(7, MultiRem([Rtt(10), Bw(10, 1, 1)]))], [], [], []]
+        self.etp_exec(gw.nip, R, TPL(), 1)
+        self.failUnlessEqual(self.maproute.node_peek(0, 7), None)
+        self.failUnlessEqual(self.etp.stats_get()['dropped_rem_type'], 1)
+
+        # a map with two metrics converts the Rtt rems of its neighbours
+        self.etp, self.neighs = etp_setup(4, 16, [1, 1, 1, 1],
+                                          [[2, 1, 1, 1], [3, 1, 1, 1]],
+                                          metrics=2)
+        self.maproute = self.etp.maproute
+        gw, other = self.neighs
+        self.etp_exec(gw.nip, R, TPL(), 1)
+        node = self.maproute.node_get(0, 7)
+        self.failUnlessEqual(node.best_route().rem.rems[0], Rtt(110))
+        self.failUnlessEqual(node.best_route(metric=1).gw, gw.id)
+        self.failUnlessEqual(self.etp.stats_get()['dropped_rem_type'], 0)
+
+    def testATP(self):
+        gw, other = self.neighs
+        # the ETP has already crossed us: it is dropped
+        R = [[(7, Rtt(10))], [], [], []]
+        TPL = [tpb(0, (1, NullRem()), (4, Rtt(5)), (gw.nip[0], Rtt(5)))]
+        self.etp_exec(gw.nip, R, TPL, 1)
+        self.failIf(other.ntkd.etp.received)
+        self.failUnlessEqual(self.maproute.node_peek(0, 7), None)
+        self.failUnlessEqual(self.etp.stats_get()['dropped_atp'], 1)
+
+    def testCodec(self):
+        gw, other = self.neighs
+        R = [[(7, Rtt(10))], [], [], []]
+        self.etp_exec(gw.nip, R, [tpb(0, (gw.nip[0], NullRem()))], 1)
+        self.failUnlessEqual(other.ntkd.etp.packed, 1)
+        self.failUnlessEqual(other.ntkd.etp.oneway, 1)
+
+        # `other' doesn't know the codec: the ETP is sent with rencode,
+        # through an ordinary call and with a legacy TPL
+        other.ntkd.etp.codec = False
+        self.etp.peer_codec.clear()
+        R = [[(8, Rtt(10))], [], [], []]
+        self.etp_exec(gw.nip, R, [tpb(0, (gw.nip[0], NullRem()))], 1)
+        self.failUnlessEqual(other.ntkd.etp.packed, 1)
+        self.failUnlessEqual(other.ntkd.etp.oneway, 1)
+        TPL = other.ntkd.etp.received[-1][2]
+        self.failUnlessEqual(TPL, [[0, [[gw.nip[0], NullRem()],
+                                        [1, gw.rem]]]])
+
+        # the legacy TPLs of the old nodes are understood
+        self.failUnlessEqual(tpl_from_legacy(TPL),
+                             [tpb(0, (gw.nip[0], NullRem()), (1, gw.rem))])
+        self.failUnlessEqual(len(other.ntkd.etp.received), 2)
+        self.failUnlessEqual(self.etp.peer_codec[other.ip], 0)
+
+    def testR2(self):
+        gw, other = self.neighs
+        # we already reach 7 with a better route through `other'
+        self.maproute.route_change(0, 7, other.id, Rtt(50))
+        R = [[(7, Rtt(10)), (8, Rtt(10))], [], [], []]
+        TPL = [tpb(0, (gw.nip[0], NullRem()))]
+        self.etp_exec(gw.nip, R, TPL, 1)
+
+        sender, R2, TPL2, foi = other.ntkd.etp.received[0]
+        self.failUnlessEqual(R2, [[(8, Rtt(10))], [], [], []])
+
+    def testDuplicate(self):
+        gw, other = self.neighs
+        R = [[(7, Rtt(10)), (8, Rtt(10))], [], [], []]
+        TPL = [tpb(0, (gw.nip[0], NullRem()))]
+        etp = (R, TPL, 1)
+        self.etp_exec(gw.nip, *deepcopy(etp))
+        self.failUnlessEqual(len(other.ntkd.etp.received), 1)
+
+        # an exact copy is dropped
+        self.etp_exec(gw.nip, *deepcopy(etp))
+        self.failUnlessEqual(len(other.ntkd.etp.received), 1)
+        self.failUnlessEqual(self.etp.stats_get()['dropped_dup'], 1)
+
+        # a subset too
+        R2 = [[(8, Rtt(10))], [], [], []]
+        self.etp_exec(gw.nip, R2, deepcopy(TPL), 1)
+        self.failUnlessEqual(len(other.ntkd.etp.received), 1)
+
+        # a changed rem is not a duplicate
+        R3 = [[(8, Rtt(30))], [], [], []]
+        self.etp_exec(gw.nip, R3, deepcopy(TPL), 1)
+        self.failUnlessEqual(len(other.ntkd.etp.received), 2)
+        self.failUnlessEqual(self.maproute.node_get(0, 8).best_route().rem,
+                             Rtt(130))
+
+        # neither is an ETP received after the expire time
+        self.etp.radar.xtime.swait(self.etp.etp_cache.ttl*1000)
+        self.etp_exec(gw.nip, *deepcopy(etp))
+        self.failUnlessEqual(len(other.ntkd.etp.received), 3)
+
+        # a copy of an ETP whose routes have been changed by another ETP of
+        # the same gateway, with a different TPL, is executed again
+        R4 = [[(7, Rtt(900))], [], [], []]
+        TPL4 = [tpb(0, (gw.nip[0], NullRem()), (5, Rtt(3)))]
+        self.etp_exec(gw.nip, R4, TPL4, 1)
+        self.failUnlessEqual(self.maproute.node_get(0, 7).best_route().rem,
+                             Rtt(1003))
+        dropped = self.etp.stats_get()['dropped_dup']
+        self.etp_exec(gw.nip, *deepcopy(etp))
+        self.failUnlessEqual(self.etp.stats_get()['dropped_dup'], dropped)
+        self.failUnlessEqual(self.maproute.node_get(0, 7).best_route().rem,
+                             Rtt(110))
+
+    def testQueue(self):
+        gw, other = self.neighs
+        TPL = [tpb(0, (gw.nip[0], NullRem()))]
+        TPL2 = [tpb(0, (gw.nip[0], NullRem()), (1, Rtt(3)))]
+
+        self.failUnless(self.etp.etp_queue_add(other.id,
+                ([[(7, Rtt(10)), (8, Rtt(10))], []], TPL, 1)))
+        self.failIf(self.etp.etp_queue_add(other.id,
+                ([[(8, Rtt(20))], [(3, Rtt(5))]], deepcopy(TPL), 1)))
+        self.failIf(self.etp.etp_queue_add(other.id,
+                ([[(8, Rtt(30))], []], TPL2, 1)))
+        self.failIf(self.etp.etp_queue_add(other.id,
+                ([[(8, Rtt(40))], []], TPL, 0)))
+
+        etps = self.etp.etp_queue_pop(other.id)
+        self.failIf(self.etp.etp_queue_pop(other.id))
+        self.failUnlessEqual(len(etps), 3)
+        for R, T, flag in etps:
+            for Rl in R:
+                Rl.sort()
+        self.failUnlessEqual(etps,
+                [([[(7, Rtt(10)), (8, Rtt(20))], [(3, Rtt(5))]], TPL, 1),
+                 ([[(8, Rtt(30))], []], TPL2, 1),
+                 ([[(8, Rtt(40))], []], TPL, 0)])
+
+        # the ETPs are delivered in order: only the last ETP is merged
+        self.etp.etp_queue_add(other.id, ([[(7, Rtt(5))], []], TPL, 1))
+        self.etp.etp_queue_add(other.id, ([[(7, DeadRem())], []], TPL2, 1))
+        self.etp.etp_queue_add(other.id, ([[(7, Rtt(6))], []], TPL, 1))
+        self.failUnlessEqual(self.etp.etp_queue_pop(other.id),
+                [([[(7, Rtt(5))], []], TPL, 1),
+                 ([[(7, DeadRem())], []], TPL2, 1),
+                 ([[(7, Rtt(6))], []], TPL, 1)])
+
+        # nothing is kept after a reset
+        self.etp.etp_queue_add(other.id, ([[(7, Rtt(10))], []], TPL, 1))
+        self.etp.etp_cache.add(self.etp.etp_cache.fingerprint(gw.id, gw.rem,
+                                                              TPL, 1),
+                               [[(7, Rtt(10))], []])
+        self.etp.etp_reset()
+        self.failIf(self.etp.etp_queue or self.etp.etp_cache.cache)
+
+        # the queue of a dead neighbour is dropped
+        self.etp.etp_queue_add(other.id, ([[(7, Rtt(10))], []], TPL, 1))
+        self.etp.etp_new_dead(other)
+        allmicro_run()
+        self.failIf(self.etp.etp_queue_pop(other.id))
+
+    def testDeliveryFailure(self):
+        gw, other = self.neighs
+        other.ntkd.etp.broken = True
+        R = [[(7, Rtt(10))], [], [], []]
+        TPL = [tpb(0, (gw.nip[0], NullRem()))]
+        self.etp_exec(gw.nip, R, TPL, 1)
+        self.failUnlessEqual(self.etp.send_failures, {other.id: 1})
+
+        self.etp.etp_new_dead(other)
+        allmicro_run()
+        self.failIf(self.etp.send_failures)
+
+    def testDamping(self):
+        gw, other = self.neighs
+        damping = self.etp.damping
+        received = gw.ntkd.etp.received
+        R = [[(7, Rtt(10))], [], [], []]
+        TPL = [tpb(0, (other.nip[0], NullRem()))]
+        self.etp_exec(other.nip, R, TPL, 1)
+        del received[:]
+
+        # gw is new: its link has a penalty of FLAP_PENALTY_LINK
+        self.etp.etp_new_changed(gw)
+        allmicro_run()
+        self.failUnlessEqual(len(received), 1)
+
+        # the first rem change is sent, the second one is suppressed
+        self.etp.etp_new_changed(gw, gw.rem)
+        allmicro_run()
+        self.failUnlessEqual(len(received), 2)
+        start = self.etp.radar.xtime.time()
+        self.etp.etp_new_changed(gw, gw.rem)
+        allmicro_run()
+
+        # the routes are sent only when the link has settled
+        self.failUnlessEqual(len(received), 3)
+        self.failIf(damping.is_suppressed(gw.ip))
+        self.failUnless(self.etp.radar.xtime.time() - start >=
+                        damping.half_life)
+        self.failIf(self.etp.damping_waiting)
+
+    def testDampingRehook(self):
+        gw, other = self.neighs
+        received = gw.ntkd.etp.received
+        R = [[(7, Rtt(10))], [], [], []]
+        TPL = [tpb(0, (other.nip[0], NullRem()))]
+        self.etp_exec(other.nip, R, TPL, 1)
+        del received[:]
+
+        # gw is new and its rem changes once
+        self.etp.etp_new_changed(gw)
+        self.etp.etp_new_changed(gw, gw.rem)
+        allmicro_run()
+
+        # after a rehook gw is readvertised: it isn't a flap of its link
+        self.etp.etp_reset()
+        self.etp.etp_new_changed(gw)
+        allmicro_run()
+        self.failUnlessEqual(len(received), 3)
+        self.failUnlessEqual(self.etp.stats_get()['etp_suppressed'], 0)
+
+class TestFlapDamping(unittest.TestCase):
+
+    def setUp(self):
+        self.xtime = FakeXtime()
+        self.damping = FlapDamping(half_life=1, suppress=2000, reuse=750,
+                                   max_penalty=4000, xtimemod=self.xtime)
+
+    def testDecay(self):
+        self.failUnlessEqual(self.damping.penalty(1), 0)
+        self.failIf(self.damping.flap(1, 1000))
+        self.failUnlessEqual(self.damping.penalty(1), 1000)
+        self.xtime.swait(1000)
+        self.failUnlessAlmostEqual(self.damping.penalty(1), 500)
+        self.xtime.swait(1000)
+        self.failUnlessAlmostEqual(self.damping.penalty(1), 250)
+
+    def testSuppress(self):
+        self.failIf(self.damping.flap(1, 1000))
+        self.failUnless(self.damping.flap(1, 1000))
+        self.failIf(self.damping.is_suppressed(2))
+
+        # still suppressed below the suppress threshold
+        self.xtime.swait(1000)
+        self.failUnless(self.damping.is_suppressed(1))
+        t = self.damping.reuse_time(1)
+        self.failUnless(0 < t <= 1000)
+        self.xtime.swait(t)
+        self.failIf(self.damping.is_suppressed(1))
+        self.failIf(self.damping.flap(1, 1000))
+
+    def testMaxPenalty(self):
+        for i in xrange(10):
+            self.damping.flap(1, 1000)
+        self.failUnlessEqual(self.damping.penalty(1), 4000)
+        self.failUnless(self.damping.reuse_time(1) <= 1000*log(4000/750., 2)+1)
+
+    def testDisabled(self):
+        damping = FlapDamping(suppress=0, xtimemod=self.xtime)
+        for i in xrange(10):
+            self.failIf(damping.flap(1, 1000))
+
+class TestEtpCodec(unittest.TestCase):
+
+    def setUp(self):
+        self.R = [[(0, Rtt(10)), (255, Rtt(100000))],
+                  [(3, DeadRem()), (4, Bw(100, 1, 20))],
+                  [(9, MultiRem([Rtt(5), Bw(7, 0, 1)]))],
+                  []]
+        self.TPL = [tpb(2, (1, NullRem())),
+                    tpb(0, (7, Rtt(3)), (200, Rtt(1000)))]
+
+    def testRoundTrip(self):
+        data = etp_pack(self.R, self.TPL, 1)
+        R, TPL, flag_of_interest = etp_unpack(data)
+        self.failUnlessEqual(flag_of_interest, 1)
+        self.failUnlessEqual(TPL, self.TPL)
+        self.failUnlessEqual(len(R), len(self.R))
+        for Rl, Rl2 in zip(R, self.R):
+            self.failUnlessEqual([(dst, rem.__class__, rem._pack()[1:])
+                                    for dst, rem in Rl],
+                                 [(dst, rem.__class__, rem._pack()[1:])
+                                    for dst, rem in Rl2])
+
+        self.failUnless(len(data) * 3 < len(rencode.dumps((self.R, self.TPL,
+                                                            1))))
+
+    def testErrors(self):
+        self.failUnlessRaises(EtpCodecError, etp_pack,
+                              [[(1, Rtt(10, max_value=5))]], self.TPL, 1)
+        self.failUnlessRaises(EtpCodecError, etp_pack,
+                              [[(1, Avg([Rtt(10)]))]], self.TPL, 1)
+        self.failUnlessRaises(EtpCodecError, etp_pack,
+                              [[(256, Rtt(10))]], self.TPL, 1)
+        self.failUnlessRaises(EtpCodecError, etp_pack, self.R,
+                              [TPBlock(0, [i % 256 for i in xrange(256)],
+                                       [Rtt(1)] * 256)], 1)
+
+        data = etp_pack(self.R, self.TPL, 1)
+        self.failUnlessRaises(EtpCodecError, etp_unpack, data[:-1])
+        self.failUnlessRaises(EtpCodecError, etp_unpack, data + '\x00')
+        self.failUnlessRaises(EtpCodecError, etp_unpack,
+                              chr(ETP_CODEC_VERSION+1) + data[1:])
+
+class TestEtpCache(unittest.TestCase):
+
+    def setUp(self):
+        self.xtime = FakeXtime()
+        self.cache = EtpCache(size=2, ttl=1, xtimemod=self.xtime)
+        self.TPL = [tpb(0, (2, NullRem()))]
+        self.R = [[(1, Rtt(10))], [(3, Rtt(20))]]
+
+    def testFingerprint(self):
+        fp = self.cache.fingerprint(1, Rtt(5), self.TPL, 1)
+        self.failUnlessEqual(fp,
+                        self.cache.fingerprint(1, Rtt(5), deepcopy(self.TPL), 1))
+        self.failIfEqual(fp, self.cache.fingerprint(2, Rtt(5), self.TPL, 1))
+        self.failIfEqual(fp, self.cache.fingerprint(1, Rtt(6), self.TPL, 1))
+        self.failIfEqual(fp, self.cache.fingerprint(1, Rtt(5), self.TPL, 0))
+        self.failIfEqual(fp, self.cache.fingerprint(1, Rtt(5),
+                                            [tpb(0, (2, Rtt(1)))], 1))
+
+    def testDup(self):
+        fp = self.cache.fingerprint(1, Rtt(5), self.TPL, 1)
+        self.failIf(self.cache.is_dup(fp, self.R))
+        self.cache.add(fp, self.R)
+        self.failUnless(self.cache.is_dup(fp, self.R))
+        self.failUnless(self.cache.is_dup(fp, [[], [(3, Rtt(20))]]))
+        self.failIf(self.cache.is_dup(fp, [[], [(3, Rtt(21))]]))
+        self.failIf(self.cache.is_dup(fp, [[(2, Rtt(10))], []]))
+
+        self.xtime.swait(1000)
+        self.failIf(self.cache.is_dup(fp, self.R))
+        self.failIf(self.cache.cache)
+
+    def testBounded(self):
+        fps = [self.cache.fingerprint(gw, Rtt(5), self.TPL, 1)
+                for gw in xrange(3)]
+        for fp in fps:
+            self.cache.add(fp, self.R)
+        self.failUnlessEqual(len(self.cache.cache), 2)
+        self.failIf(self.cache.is_dup(fps[0], self.R))
+        self.failUnless(self.cache.is_dup(fps[2], self.R))
+
+        self.cache.gw_forget(2)
+        self.failIf(self.cache.is_dup(fps[2], self.R))
+        self.failUnless(self.cache.is_dup(fps[1], self.R))
+
+        # a fingerprint forgotten and added again is the newest one
+        self.cache.add(fps[2], self.R)
+        self.cache.gw_forget(1)
+        self.cache.add(fps[1], self.R)
+        self.cache.add(fps[0], self.R)
+        self.failIf(self.cache.is_dup(fps[2], self.R))
+        self.failUnless(self.cache.is_dup(fps[1], self.R))
+        self.failUnless(self.cache.is_dup(fps[0], self.R))
+        self.failUnless(len(self.cache.order) <= 2 * self.cache.size)
+
+if __name__ == '__main__':
+    unittest.main()
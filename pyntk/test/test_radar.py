@@ -22,14 +22,20 @@
 
 
 import copy
+import socket
 import sys
 import unittest
 
+from heapq import heappop, heappush
 from random import randint
 sys.path.append('..')
 
-from ntk.core.radar import Neigh, Neighbour
+import ntk.core.radar as radar
+from ntk.config import settings
+from ntk.core.radar import LinkEstimator, Neigh, Neighbour, Radar
 from ntk.core.route import DeadRem
+from ntk.lib.micro import micro, allmicro_run, Channel
+from ntk.network.inet import ip_to_str
 
 from utils import BaseObserver
 
@@ -63,7 +69,7 @@ class TestNeighbour(unittest.TestCase):
 
     def testEmptyNeighbourList(self):
         '''Empty neighbour list'''
-        self.failUnlessEqual(self.neighbour.neigh_list(), [])
+        self.failUnlessEqual(self.neighbour.neigh_list(), ())
         self.failUnlessEqual(self.neighbour.ip_to_neigh(IP), None)
 
     def testAddNeighbour(self):
@@ -86,7 +92,7 @@ class TestNeighbour(unittest.TestCase):
         self.testAddNeighbour()
 
         self.neighbour.delete(IP)
-        self.failUnlessEqual(self.neighbour.neigh_list(), [])
+        self.failUnlessEqual(self.neighbour.neigh_list(), ())
 
         deleted_neighbour = copy.copy(NEIGH)
         deleted_neighbour.devs = deleted_neighbour.bestdev = None
@@ -129,12 +135,60 @@ class TestNeighbour(unittest.TestCase):
         self.failUnlessEqual(new_neighbour.values(),
                              self.observer.neigh_new_event.values())
 
+    def testCachedViews(self):
+        '''Neighbour views are rebuilt only when the table changes'''
+        self.testAddNeighbour()
+        n = self.neighbour.neigh_list()[0]
+        self.failUnless(self.neighbour.ip_to_neigh(IP) is n)
+        self.failUnless(self.neighbour.id_to_neigh(1) is n)
+        self.failUnlessEqual(self.neighbour.id_to_neigh(2), None)
+
+        # same rtt: nothing changed
+        self.neighbour.store({IP: Neigh(bestdev=('eth0', 42),
+                                        devs={'eth0': 42})})
+        self.failUnless(self.neighbour.neigh_list()[0] is n)
+
+        # small rtt variation: no event, but the view is updated
+        self.neighbour.store({IP: Neigh(bestdev=('eth0', 44),
+                                        devs={'eth0': 44})})
+        m = self.neighbour.ip_to_neigh(IP)
+        self.failIf(m is n)
+        self.failUnlessEqual(m.rem.value, 44)
+        self.failUnless(self.neighbour.id_to_neigh(1) is m)
+
+        self.neighbour.delete(IP)
+        self.failUnlessEqual(self.neighbour.ip_to_neigh(IP), None)
+        self.failUnlessEqual(self.neighbour.id_to_neigh(1), None)
+
     def testFindHoleInTranslationTable(self):
         '''Find hole in traslation table'''
         self.failUnlessEqual(self.neighbour._find_hole_in_tt(), 1)
         self.testAddNeighbour()
         self.failUnlessEqual(self.neighbour._find_hole_in_tt(), 2)
 
+    def testIdAllocation(self):
+        '''Neighbour ids are allocated and released'''
+        ips = range(IP, IP + MAX_NEIGHBOUR)
+        for i, ip in enumerate(ips):
+            self.failUnlessEqual(self.neighbour.ip_to_id(ip), i + 1)
+            self.failUnlessEqual(self.neighbour.id_to_ip(i + 1), ip)
+        self.failUnlessEqual(self.neighbour.ip_to_id(ips[1]), 2)
+        # the table is full
+        self.failUnlessEqual(self.neighbour._find_hole_in_tt(), False)
+        self.failUnlessEqual(self.neighbour.ip_to_id(IP - 1), False)
+
+        self.testAddNeighbour()
+        self.neighbour.ip_change(IP, IP - 1)
+        # the id has been passed to the new ip
+        self.failUnlessEqual(self.neighbour.ip_to_id(IP - 1), 1)
+        self.failUnlessEqual(self.neighbour.id_to_ip(1), IP - 1)
+        self.failUnlessEqual(self.neighbour._find_hole_in_tt(), False)
+
+        self.neighbour.delete(IP - 1)
+        self.failUnlessEqual(self.neighbour.id_to_ip(1), None)
+        self.failUnlessEqual(self.neighbour._find_hole_in_tt(), 1)
+        self.failUnlessEqual(self.neighbour.ip_to_id(IP - 2), 1)
+
     def testTruncate(self):
         '''Truncate ip_table'''
         neighbours = [Neigh(bestdev=('eth0', randint(1,100)),
@@ -156,5 +210,258 @@ class TestNeighbour(unittest.TestCase):
 
         self.failUnlessEqual(trunc_ip_table, best_neighbours_ip_table)
 
+class TestLinkEstimator(unittest.TestCase):
+
+    def testRtt(self):
+        '''Link RTT and jitter'''
+        link = LinkEstimator()
+        self.failUnlessEqual(link.value(), None)
+        link.sample(10)
+        self.failUnlessEqual((link.rtt, link.jitter), (10, 0))
+        link.sample(18)
+        self.failUnlessEqual((link.rtt, link.jitter), (11, 2))
+        link.bouquet(2, 2)
+        self.failUnlessEqual(link.value(), 13)
+
+        # a zero rtt is still a valid rem
+        link = LinkEstimator()
+        link.sample(0)
+        link.bouquet(1, 1)
+        self.failUnlessEqual(link.value(), 1)
+
+    def testLoss(self):
+        '''Link loss ratio on a sliding window'''
+        link = LinkEstimator(window=8)
+        link.sample(10)
+        self.failUnlessEqual(link.loss(), 0)
+        link.bouquet(4, 2)
+        self.failUnlessEqual(link.loss(), 0.5)
+        self.failUnlessEqual(link.value(), 20)
+        link.bouquet(4, 4)
+        self.failUnlessEqual(link.loss(), 0.25)
+        # the first bouquet slides out of the window
+        link.bouquet(4, 4)
+        self.failUnlessEqual(link.loss(), 0)
+        link.bouquet(16, 12)
+        self.failUnlessEqual(link.loss(), 0)
+        link.bouquet(16, 0)
+        self.failUnlessEqual(link.loss(), 1)
+        self.failUnlessEqual(link.value(), None)
+
+class FakeXtime(object):
+    '''Simulated clock: swait() sleeps until run() advances the clock'''
+
+    def __init__(self):
+        self.t = 0
+        self.alarms = [] # heap of (time, n, Channel)
+        self.n = 0
+
+    def time(self):
+        return self.t
+
+    def swait(self, t):
+        chan = Channel()
+        self.n += 1
+        heappush(self.alarms, (self.t + t, self.n, chan))
+        chan.recv()
+
+    def run(self, func, *args):
+        '''Runs func(*args) in a new microthread and advances the clock
+        until it returns'''
+        done = []
+        micro(lambda: done.append(func(*args)))
+        while True:
+            allmicro_run()
+            if done:
+                return done[0]
+            self.t, n, chan = heappop(self.alarms)
+            chan.send(None)
+
+class FakeCaller(object):
+    def __init__(self, ip, dev='eth0'):
+        self.ip = ip_to_str(ip)
+        self.dev = dev
+
+class FakeBroadcast(object):
+    '''Each probe is answered by the neighbours in `neighs', after 10ms'''
+
+    def __init__(self):
+        self.radar = self
+        self.neighs = []
+        self.sent = 0
+        self.lost = 0
+
+    def reply(self, ntkd_id, radar_id):
+        self.sent += 1
+        if self.lost:
+            self.lost -= 1
+            return
+        self.xtime.t += 20
+        for ip in self.neighs:
+            self.rdr.time_register(FakeCaller(ip), radar_id, NETID)
+        self.xtime.t -= 20
+
+    def reset(self):
+        pass
+
+class FakeBcastClient(object):
+    '''Records the replies sent by Radar.reply'''
+
+    instances = []
+
+    def __init__(self, devs, xtimemod):
+        self.devs = devs
+        self.radar = self
+        self.sent = []
+        self.closed = False
+        self.broken = False
+        FakeBcastClient.instances.append(self)
+
+    def time_register(self, radar_id, netid):
+        if self.broken:
+            raise socket.error('Network is down')
+        self.sent.append((radar_id, netid))
+
+    def close(self):
+        self.closed = True
+
+class TestRadar(unittest.TestCase):
+
+    def setUp(self):
+        self.BcastClient = radar.rpc.BcastClient
+        radar.rpc.BcastClient = FakeBcastClient
+        FakeBcastClient.instances = []
+        self.bcast = FakeBroadcast()
+        self.bcast.xtime = FakeXtime()
+        self.radar = Radar(self.bcast, self.bcast.xtime)
+        self.bcast.rdr = self.radar
+
+    def tearDown(self):
+        radar.rpc.BcastClient = self.BcastClient
+
+    def scan(self):
+        self.bcast.sent = 0
+        self.bcast.xtime.run(self.radar.radar)
+        return self.bcast.sent
+
+    def testAdaptiveSchedule(self):
+        '''The scans are adapted to the stability of the neighbourhood'''
+        max_bouquet = self.radar.max_bouquet
+
+        self.bcast.neighs = [IP]
+        self.failUnlessEqual(self.scan(), max_bouquet)
+        # new neighbour: scan again immediately
+        self.failUnlessEqual(self.radar.scan_interval, 0)
+        self.failUnlessEqual(self.radar.neigh.ip_to_neigh(IP).rem.value, 10)
+
+        self.failUnlessEqual(self.scan(), max_bouquet)
+        self.failUnlessEqual(self.radar.bouquet_size, max_bouquet / 2)
+        self.failUnlessEqual(self.radar.scan_interval, 500)
+
+        for i in xrange(10):
+            self.scan()
+        self.failUnlessEqual(self.radar.bouquet_size, self.radar.min_bouquet)
+        self.failUnlessEqual(self.radar.scan_interval,
+                             settings.MAX_SCAN_INTERVAL * 1000)
+
+        # the neighbour died
+        self.bcast.neighs = []
+        self.failUnlessEqual(self.scan(), self.radar.min_bouquet)
+        self.failUnlessEqual(self.radar.neigh.neigh_list(), ())
+        self.failUnlessEqual(self.radar.bouquet_size, max_bouquet)
+        self.failUnlessEqual(self.radar.scan_interval, 0)
+
+    def testEarlyCompletion(self):
+        '''The scan ends when all the neighbours have replied'''
+        self.bcast.neighs = [IP]
+        self.scan()
+        self.failUnlessEqual(self.radar.scan_time, self.radar.grace_time)
+        self.scan()
+        self.failUnlessEqual(self.radar.scan_time, self.radar.grace_time)
+        self.failUnlessEqual(self.radar.stats.counters['scans_early'], 2)
+
+        # a lost probe: wait until the timeout
+        self.bcast.lost = 1
+        self.scan()
+        self.failUnlessEqual(self.radar.scan_time,
+                             self.radar.max_wait_time * 1000)
+        stats = self.radar.stats_get()
+        self.failUnlessEqual(stats['scans'], 3)
+        self.failUnlessEqual(stats['scans_early'], 2)
+        self.failUnlessEqual(stats['scan_time']['count'], 3)
+
+    def testNewNeighbour(self):
+        '''A new neighbour restarts the grace time'''
+        IP2 = IP + 1
+        def late_replies():
+            self.bcast.xtime.swait(1000)
+            for i in xrange(self.radar.bouquet_size):
+                self.radar.time_register(FakeCaller(IP2), self.radar.radar_id,
+                                         NETID)
+
+        self.bcast.neighs = [IP]
+        micro(late_replies)
+        self.scan()
+        self.failUnlessEqual(self.radar.scan_time,
+                             1000 + self.radar.grace_time)
+        self.failUnlessEqual(len(self.radar.neigh.neigh_list()), 2)
+        self.failUnlessEqual(self.radar.stats.counters['scans_early'], 1)
+
+        # no neighbours at all
+        self.bcast.neighs = []
+        self.radar.neigh.ip_table.clear()
+        self.scan()
+        self.failUnlessEqual(self.radar.scan_time, self.radar.grace_time)
+
+    def testReplySockets(self):
+        '''The reply sockets are reused'''
+        self.radar.do_reply = True
+        self.radar.netid = NETID
+        for i in xrange(16):
+            self.failUnlessEqual(self.radar.reply(FakeCaller(IP), 1, i),
+                                 NETID)
+        self.radar.reply(FakeCaller(IP, 'eth1'), 1, 16)
+        # our own probes aren't answered
+        self.radar.reply(FakeCaller(IP), self.radar.ntkd_id, 17)
+
+        eth0, eth1 = FakeBcastClient.instances
+        self.failUnlessEqual(eth0.devs, ['eth0'])
+        self.failUnlessEqual(eth0.sent, [(i, NETID) for i in xrange(16)])
+        self.failUnlessEqual(eth1.sent, [(16, NETID)])
+
+        # a broken socket is replaced
+        eth0.broken = True
+        self.failUnlessRaises(socket.error, self.radar.reply,
+                              FakeCaller(IP), 1, 18)
+        self.failUnless(eth0.closed)
+        self.radar.reply(FakeCaller(IP), 1, 19)
+        self.failUnlessEqual(len(FakeBcastClient.instances), 3)
+        self.failUnlessEqual(FakeBcastClient.instances[2].sent, [(19, NETID)])
+
+        # the sockets are closed at the end of each scan, since our address
+        # may have changed
+        self.scan()
+        self.failUnless(eth1.closed and FakeBcastClient.instances[2].closed)
+        self.failUnlessEqual(self.radar.reply_clients, {})
+
+    def testMissedReply(self):
+        '''A missed reply triggers a dense scan'''
+        self.bcast.neighs = [IP]
+        self.scan()
+        self.scan()
+        self.failIfEqual(self.radar.scan_interval, 0)
+
+        self.bcast.lost = 1
+        self.scan()
+        self.failUnlessEqual(self.radar.bouquet_size, self.radar.max_bouquet)
+        self.failUnlessEqual(self.radar.scan_interval, 0)
+
+        # the lost probe is remembered by the following scans
+        self.failUnless(self.radar.links[IP]['eth0'].loss() > 0)
+
+        # late replies are dropped
+        self.radar.time_register(FakeCaller(IP), 1, NETID)
+        self.failUnlessEqual(self.radar.bcast_replies, {})
+
 if __name__ == '__main__':
     unittest.main()
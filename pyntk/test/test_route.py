@@ -21,6 +21,7 @@
 #
 
 
+import random
 import sys
 import unittest
 sys.path.append('..')
@@ -28,9 +29,28 @@ sys.path.append('..')
 from operator import add
 
 from ntk.core.radar import Neigh
-from ntk.core.route import (NullRem, DeadRem, Rtt, Bw, Avg, RemError,
-                            AvgSumError, RouteGw, RouteGwError, RouteNode,
-                            MapRoute)
+from ntk.core.route import (NullRem, DeadRem, Rtt, Bw, Avg, MultiRem,
+                            RemError, AvgSumError, RouteGw, RouteGwError,
+                            RouteNode, MapRoute)
+
+from utils import BaseObserver
+
+class MapRouteObserver(BaseObserver):
+
+    EVENTS = ['ROUTE_NEW', 'ROUTE_DELETED', 'ROUTE_REM_CHGED']
+
+    def __init__(self, who=None):
+        BaseObserver.__init__(self, who)
+        self.received = []
+
+    def route_new(self, *args):
+        self.received.append(('ROUTE_NEW', args))
+
+    def route_deleted(self, *args):
+        self.received.append(('ROUTE_DELETED', args))
+
+    def route_rem_chged(self, *args):
+        self.received.append(('ROUTE_REM_CHGED', args))
 
 
 class TestRouteEfficiencyMeasure(unittest.TestCase):
@@ -74,6 +94,14 @@ class TestRouteEfficiencyMeasure(unittest.TestCase):
         # self.rtt and Rtt(1) are the same
         self.failUnless(Rtt(1) == self.rtt)
 
+    def testRemKey(self):
+        ''' Rems are ordered by their sort key '''
+        rems = [Rtt(5), Rtt(1), Rtt(3)]
+        self.failUnlessEqual([r.key for r in rems], [-5, -1, -3])
+        self.failUnlessEqual(sorted(rems, reverse=1), [Rtt(1), Rtt(3), Rtt(5)])
+        self.failUnlessEqual(Bw(5, 1, 1).key, 5)
+        self.failUnlessEqual((self.rtt + Rtt(2)).key, -3)
+
     def testAddBwNullRem(self):
         ''' Sum a Bw with a NullRem '''
         new_bw = self.bw + self.null_rem
@@ -197,6 +225,24 @@ class TestRouteNode(unittest.TestCase):
         res = self.route_node.route_del(4)
         self.failUnless(self.route_node.is_empty())
 
+    def testRoutesOrder(self):
+        ''' Routes are kept ordered by route_add, route_rem, route_del '''
+        for gw, rtt in [(1, 30), (2, 10), (3, 20), (4, 5), (5, 20)]:
+            self.route_node.route_add(lvl=0, dst=123, gw=gw, rem=Rtt(rtt))
+        self.failUnlessEqual([r.gw for r in self.route_node.routes],
+                             [4, 2, 3, 5, 1])
+
+        self.route_node.route_rem(4, Rtt(25))
+        self.failUnlessEqual([r.gw for r in self.route_node.routes],
+                             [2, 3, 5, 4, 1])
+        self.route_node.route_add(lvl=0, dst=123, gw=1, rem=Rtt(1))
+        self.failUnlessEqual(self.route_node.best_route().gw, 1)
+
+        self.route_node.route_del(3)
+        self.failUnlessEqual([r.gw for r in self.route_node.routes],
+                             [1, 2, 5, 4])
+        self.failUnlessEqual(self.route_node.route_getby_gw(3), None)
+
     def testIsEmpty(self):
         '''Check if a RouteNode instance is empty '''
         self.failUnlessEqual(self.route_node.is_empty(), True)
@@ -277,5 +323,167 @@ class TestMapRoute(unittest.TestCase):
         res = self.map.bestroutes_get()
         self.failUnless(res == [[(self.neigh.ip, 0, self.neigh.rem)]])
 
+    def testDstsIndex(self):
+        ''' MapRoute: index of the destinations having routes '''
+        self.map.route_add(lvl=0, dst=200, gw=5, rem=Rtt(1))
+        self.map.route_add(lvl=0, dst=7, gw=5, rem=Rtt(3))
+        self.map.route_add(lvl=0, dst=7, gw=6, rem=Rtt(2))
+        self.failUnlessEqual(self.map.dsts[0], set([7, 200]))
+        self.failUnlessEqual([(dst, gw) for dst, gw, rem
+                                in self.map.bestroutes_get()[0]],
+                             [(7, 6), (200, 5)])
+
+        self.map.route_del(lvl=0, dst=7, gw=6)
+        self.failUnlessEqual(self.map.dsts[0], set([7, 200]))
+        self.map.route_del(lvl=0, dst=7, gw=5)
+        self.failUnlessEqual(self.map.dsts[0], set([200]))
+
+        self.map.level_reset(0)
+        self.failUnlessEqual(self.map.dsts[0], set())
+        self.failUnlessEqual(self.map.bestroutes_get(), [[]])
+
+    def testGwRoutesIndex(self):
+        ''' MapRoute: index of the routes passing by a gateway '''
+        self.map.route_add(lvl=0, dst=200, gw=5, rem=Rtt(1))
+        self.map.route_add(lvl=0, dst=7, gw=5, rem=Rtt(3))
+        self.map.route_add(lvl=0, dst=7, gw=6, rem=Rtt(2))
+        self.failUnlessEqual(self.map.routes_via_gw(5), [(0, 7), (0, 200)])
+        self.failUnlessEqual(self.map.routes_via_gw(6), [(0, 7)])
+
+        # the best route to 7 passes by 6
+        res = self.map.bestroutes_via_gw(5)
+        self.failUnlessEqual([(dst, gw) for dst, gw, rem in res[0]],
+                             [(200, 5)])
+
+        self.map.route_del(lvl=0, dst=7, gw=6)
+        self.failUnlessEqual(self.map.routes_via_gw(6), [])
+        self.failIf(6 in self.map.gw_routes)
+
+        self.map.node_routes_reset(lvl=0, dst=200)
+        self.failUnlessEqual(self.map.routes_via_gw(5), [(0, 7)])
+
+    def testBestExport(self):
+        ''' MapRoute: incremental export of the best routes '''
+        def export(gw):
+            L = self.map.bestroutes_get(lambda (dst, g, rem): g != gw)
+            return [[(dst, rem) for dst, g, rem in Ll] for Ll in L]
+        def check():
+            for gw in xrange(8):
+                self.failUnlessEqual(
+                        [sorted(Rl) for Rl in self.map.bestroutes_export(gw)],
+                        export(gw))
+
+        random.seed(3)
+        for i in xrange(300):
+            dst, gw = random.randrange(16), random.randrange(8)
+            op = random.randrange(10)
+            if op < 5:
+                self.map.route_add(0, dst, gw, Rtt(random.randint(1, 50)))
+            elif op < 7:
+                self.map.route_rem(0, dst, gw, Rtt(random.randint(1, 50)))
+            elif op < 9:
+                self.map.route_del(0, dst, gw)
+            else:
+                self.map.node_routes_reset(0, dst)
+            check()
+
+        self.neigh.id = 3
+        self.map.routeneigh_del(self.neigh)
+        check()
+        self.map.level_reset(0)
+        self.failUnlessEqual(self.map.bestroutes_export(1), [[]])
+
+    def testBatch(self):
+        ''' MapRoute: a batch sends only the net route changes '''
+        self.map.route_add(lvl=0, dst=9, gw=1, rem=Rtt(10))
+        self.map.route_add(lvl=0, dst=8, gw=1, rem=Rtt(10))
+        observer = MapRouteObserver(who=self.map)
+
+        self.map.batch_begin()
+        # new route, then improved: one ROUTE_NEW
+        self.map.route_add(lvl=0, dst=200, gw=5, rem=Rtt(10))
+        self.map.route_add(lvl=0, dst=200, gw=5, rem=Rtt(2))
+        # new route, then deleted: nothing
+        self.map.route_add(lvl=0, dst=100, gw=5, rem=Rtt(1))
+        self.map.route_del(lvl=0, dst=100, gw=5)
+        # rem changed and restored: nothing
+        self.map.route_rem(lvl=0, dst=9, gw=1, newrem=Rtt(4))
+        self.map.route_rem(lvl=0, dst=9, gw=1, newrem=Rtt(10))
+        # rem changed twice: one ROUTE_REM_CHGED
+        self.map.batch_begin()
+        self.map.route_rem(lvl=0, dst=8, gw=1, newrem=Rtt(4))
+        self.map.route_rem(lvl=0, dst=8, gw=1, newrem=Rtt(3))
+        self.failUnlessEqual(self.map.batch_commit(), 0)
+        self.failUnlessEqual(observer.received, [])
+        self.failUnlessEqual(self.map.batch_commit(), 2)
+
+        self.failUnlessEqual(observer.received,
+                [('ROUTE_REM_CHGED', (0, 8, 1, Rtt(3), Rtt(10))),
+                 ('ROUTE_NEW', (0, 200, 5, Rtt(2)))])
+        self.failUnlessEqual(self.map.node_peek(0, 200).routes_tobe_synced, 1)
+        self.failUnlessEqual(self.map.node_peek(0, 100), None)
+
+    def testMultiMetric(self):
+        ''' MapRoute: best routes for each metric of MultiRem rems '''
+        def mrem(rtt, bw):
+            return MultiRem([Rtt(rtt), Bw(bw, 1, 1)])
+
+        self.map = MapRoute(levels=1, gsize=256, me=[3], metrics=2)
+        self.map.route_add(lvl=0, dst=200, gw=5, rem=mrem(10, 100))
+        self.map.route_add(lvl=0, dst=200, gw=6, rem=mrem(2, 10))
+        self.map.route_add(lvl=0, dst=200, gw=7, rem=mrem(5, 50))
+
+        node = self.map.node_peek(0, 200)
+        self.failUnlessEqual(node.best_route().gw, 6)
+        self.failUnlessEqual(node.best_route(metric=1).gw, 5)
+        self.failUnlessEqual(self.map.bestroutes_get(metric=1)[0][0][:2],
+                             (200, 5))
+
+        self.map.route_rem(lvl=0, dst=200, gw=7, newrem=mrem(5, 500))
+        self.failUnlessEqual(node.best_route(metric=1).gw, 7)
+        self.map.route_del(lvl=0, dst=200, gw=7)
+        self.failUnlessEqual(node.best_route(metric=1).gw, 5)
+        self.failUnlessEqual(node.nroutes(), 2)
+
+        rem = mrem(3, 20) + mrem(4, 10)
+        self.failUnlessEqual((rem.rems[0].value, rem.rems[1].value), (7, 10))
+
+        # the single rems are converted
+        rem = self.map.rem_import(Rtt(4))
+        self.failUnlessEqual(rem.rems, (Rtt(4), NullRem()))
+        rem += mrem(3, 20)
+        self.failUnlessEqual((rem.rems[0].value, rem.rems[1].value), (7, 20))
+        self.failUnless(isinstance(self.map.rem_import(DeadRem()), DeadRem))
+        self.failUnlessRaises(RemError, self.map.rem_import,
+                              MultiRem([Rtt(1), Bw(1, 1, 1), Rtt(1)]))
+        self.failUnlessRaises(RemError, node.best_route, 2)
+
+    def testSingleMetric(self):
+        ''' MapRoute: single metric maps '''
+        self.map.route_add(lvl=0, dst=200, gw=5, rem=Rtt(10))
+        self.map.route_add(lvl=0, dst=200, gw=6, rem=Rtt(2))
+        node = self.map.node_peek(0, 200)
+        # there is only one metric
+        self.failUnlessEqual(node.best_route(metric=1).gw, 6)
+        self.failUnlessEqual(self.map.bestroutes_get(metric=1)[0][0][:2],
+                             (200, 6))
+
+        self.failUnlessEqual(self.map.rem_import(Rtt(3)), Rtt(3))
+        self.failUnlessRaises(RemError, self.map.rem_import,
+                              MultiRem([Rtt(1), Bw(1, 1, 1)]))
+
+    def testSparseStorage(self):
+        ''' MapRoute: reading absent destinations doesn't allocate '''
+        self.map.bestroutes_get()
+        self.map.route_rem(lvl=0, dst=200, gw=5, newrem=Rtt(5))
+        self.map.route_del(lvl=0, dst=200, gw=5)
+        self.failUnlessEqual(len(self.map.node[0]), 0)
+
+        self.map.route_add(lvl=0, dst=200, gw=5, rem=Rtt(1))
+        self.failUnlessEqual(len(self.map.node[0]), 1)
+        self.map.route_del(lvl=0, dst=200, gw=5)
+        self.failUnlessEqual(self.map.node_peek(0, 200), None)
+        self.failUnlessEqual(len(self.map.node[0]), 0)
+
 if __name__ == '__main__':
     unittest.main()
@@ -121,6 +121,12 @@ class ThreadedRPCClient(threading.Thread):
 
         assert (1,2) == client.caller_test(1,2)
 
+        # one-way calls: no reply is sent, so the following call receives
+        # its own reply
+        client.oneway.void_func()
+        client.oneway.nestmod.add(x, 9)
+        assert client.square(x) == 25
+
         try:
             # should crash now
             client.private_func()
@@ -0,0 +1,92 @@
+##
+# This file is part of Netsukuku
+# (c) Copyright 2009 Andrea Lo Pumo aka AlpT <alpt@freaknet.org>
+#
+# This source code is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation; either version 2 of the License,
+# or (at your option) any later version.
+#
+# This source code is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# Please refer to the GNU Public License for more details.
+#
+# You should have received a copy of the GNU Public License along with
+# this source code; if not, write to:
+# Free Software Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+##
+#
+# Tests for ntk.lib.stats
+#
+
+import os
+import sys
+import tempfile
+import unittest
+sys.path.append('..')
+
+from ntk.lib.stats import Histogram, Stats, StatsError, timed
+
+class Foo(object):
+
+    def __init__(self):
+        self.stats = Stats(['calls'], ['bar'])
+
+    @timed('bar')
+    def bar(self, x):
+        self.stats.incr('calls')
+        if x is None:
+            raise ValueError
+        return x*2
+
+class TestStats(unittest.TestCase):
+
+    def testHistogram(self):
+        h = Histogram(nbuckets=4)
+        for v in [0, 1, 2, 3, 4, 100]:
+            h.add(v)
+        self.failUnlessEqual(h.values(),
+                dict(count=6, total=110, max=100, buckets=[1, 1, 2, 2]))
+
+    def testCounters(self):
+        s = Stats(['a', 'b'], ['h'])
+        s.incr('a')
+        s.incr('a', 3)
+        s.add('h', 5)
+        self.failUnlessEqual(s.values(),
+                dict(a=4, b=0,
+                     h=dict(count=1, total=5, max=5, buckets=[0,0,0,1]+[0]*21)))
+        self.failUnlessRaises(StatsError, s.incr, 'c')
+        self.failUnlessRaises(StatsError, s.add, 'c', 1)
+
+        s.reset()
+        self.failUnlessEqual(s.values()['a'], 0)
+        self.failUnlessEqual(s.values()['h']['count'], 0)
+
+    def testTimed(self):
+        foo = Foo()
+        self.failUnlessEqual(foo.bar(2), 4)
+        self.failUnlessRaises(ValueError, foo.bar, None)
+        self.failUnlessEqual(foo.bar.__name__, 'bar')
+        v = foo.stats.values()
+        self.failUnlessEqual(v['calls'], 2)
+        self.failUnlessEqual(v['bar']['count'], 2)
+
+    def testDump(self):
+        s = Stats(['a'], ['h'])
+        s.incr('a', 2)
+        s.add('h', 3)
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            s.dump(filename)
+            lines = open(filename).read().splitlines()
+        finally:
+            os.remove(filename)
+        self.failUnlessEqual(lines[0], 'a 2')
+        self.failUnless(lines[1].startswith('h count=1 total=3 max=3 '
+                                            'buckets=0,0,1,0,'))
+
+if __name__ == '__main__':
+    unittest.main()